@@ -12,6 +12,8 @@ if str(project_root) not in sys.path:
 from food2recipe.core.settings import load_settings
 from food2recipe.retrieval.recommender import RecipeRecommender
 from food2recipe.retrieval.related_engine import SessionManager
+from food2recipe.retrieval.inference_executor import QueueFullError
+from food2recipe.serving.client import InferenceClient, ServerBusyError
 
 from food2recipe.app.ui_components import render_recipe_food_style
 
@@ -103,12 +105,20 @@ def get_recommender():
     settings = load_settings()
     rec = RecipeRecommender(settings)
     try:
-        rec.load_resources()
+        # With a remote inference server, only recipes / related dishes are loaded locally
+        rec.load_resources(include_model=not settings.INFERENCE_SERVER_URL)
         return rec
     except Exception as e:
         st.error(f"Không load được hệ thống: {e}")
         return None
 
+@st.cache_resource
+def get_inference_client():
+    settings = load_settings()
+    if not settings.INFERENCE_SERVER_URL:
+        return None
+    return InferenceClient(settings.INFERENCE_SERVER_URL)
+
 def get_vietnamese_label(recommender, food_key):
     """
     Returns the Vietnamese name if available, otherwise a prettified text.
@@ -239,8 +249,6 @@ def main():
     if not recommender:
         st.warning("Hệ thống chưa sẵn sàng. Bạn nhớ chạy `python -m food2recipe.scripts.build_index` trước nha.")
         return
-        
-    recommender.settings.CONFIDENCE_THRESHOLD = confidence_threshold
 
     # -------- UPLOAD --------
     uploaded_file = st.file_uploader(
@@ -258,13 +266,22 @@ def main():
     if file_id != st.session_state.last_upload_id:
         with st.spinner("Đang ngó nghiêng món ăn..."):
             try:
-                result = recommender.predict(uploaded_file)
+                client = get_inference_client()
+                if client:
+                    result = client.predict(uploaded_file, confidence_threshold=confidence_threshold)
+                else:
+                    # Through the recommender's shared executor: sessions are micro-batched,
+                    # and the threshold applies to this request only
+                    result = recommender.submit(uploaded_file, confidence_threshold=confidence_threshold)
                 st.session_state.prediction_result = result
                 st.session_state.last_upload_id = file_id
                 # Reset per-image states
                 st.session_state.current_view_item = result["predicted_food"]
                 st.session_state.force_correct_item = None
                 st.session_state.show_correction_ui = False
+            except (QueueFullError, ServerBusyError):
+                st.warning("Hệ thống đang bận, bạn thử lại sau vài giây nha.")
+                return
             except Exception as e:
                 st.error(f"Lỗi: {e}")
                 return
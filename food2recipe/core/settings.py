@@ -1,8 +1,9 @@
 # File: food2recipe/core/settings.py
 import os
+import functools
 from pathlib import Path
-from typing import List, Optional, Dict
-from pydantic_settings import BaseSettings
+from typing import List, Literal, Optional, Dict
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
 
 class Settings(BaseSettings):
@@ -10,7 +11,13 @@ class Settings(BaseSettings):
     Project configuration settings.
     Reads from environment variables or .env file.
     Default paths assume the script logic runs relative to the project root.
+    Immutable: derive variants with settings.model_copy(update={...}).
     """
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore", frozen=True)
+
+    # full: build + evaluate + serve, needs the dataset tree.
+    # serving: needs only ARTIFACTS_DIR (and the recipes CSV unless BUNDLE_PATH is set).
+    PROFILE: str = Field(default="full", description="full or serving")
     
     # --- Paths ---
     # Default: assumes project root is where the script is run or 2 levels up from this file
@@ -28,18 +35,92 @@ class Settings(BaseSettings):
     REPORTS_DIR: Optional[Path] = Field(default=None)
 
     # --- Model Config ---
-    MODEL_BACKEND: str = Field(default="open_clip", description="open_clip or timm")
+    MODEL_BACKEND: str = Field(default="open_clip", description="open_clip, timm or onnx")
     MODEL_NAME: str = Field(default="ViT-B-32", description="Model architecture name")
     PRETRAINED_DATASET: str = Field(default="laion2b_s34b_b79k", description="Pretrained weights tag")
     DEVICE: str = Field(default="cpu")
+    # ONNX Runtime backend (MODEL_BACKEND=onnx): exported once from ONNX_SOURCE_BACKEND into ARTIFACTS_DIR/onnx
+    ONNX_SOURCE_BACKEND: str = Field(default="open_clip", description="open_clip or timm model to export")
+    ONNX_QUANTIZE: bool = False  # Use a dynamically quantized int8 model
+    ONNX_PARITY_MIN_COSINE: float = 0.99  # Exported models must match PyTorch embeddings at least this well
+    ONNX_OPSET: int = 17
+
+    # --- CPU Inference Tuning ---
+    TORCH_NUM_THREADS: int = 0  # Intra-op threads per process, 0 = torch default (all cores)
+    TORCH_NUM_INTEROP_THREADS: int = 0  # 0 = torch default
+    USE_INFERENCE_MODE: bool = True  # torch.inference_mode instead of no_grad
+    USE_BF16: bool = False  # bf16 autocast, only applied on CPUs with native bf16
+    CHANNELS_LAST: bool = False
+    COMPILE_MODE: str = Field(default="none", description="none, compile (torch.compile) or trace (TorchScript)")
+    WARMUP_ITERS: int = 1  # Dummy forward passes at load time
     
     # --- Processing ---
     IMAGE_SIZE: int = 224
+    DECODE_WORKERS: int = 4  # Threads used to decode images in RecipeRecommender.predict_batch
+    PREPROCESS_MODE: str = Field(default="standard", description="standard (torchvision) or fast (JPEG draft decode + uint8 resize)")
+    MAX_IMAGE_PIXELS: int = 64_000_000  # Larger uploads are rejected before decoding, 0 = no limit
+
+    # --- Index Build ---
+    BUILD_BATCH_SIZE: int = 32
+    BUILD_NUM_WORKERS: int = 4  # DataLoader decode workers (0 = decode in the main process)
+    BUILD_PREFETCH_FACTOR: int = 2  # Batches prefetched per worker
+    BUILD_CHUNK_SIZE: int = 8192  # Manifest rows read, encoded and checkpointed per step
+    BUILD_ENCODE_WORKERS: int = 0  # Encoder processes (0 = encode in the main process)
+    BUILD_THREADS_PER_WORKER: int = 1  # torch threads pinned in each encoder process
+    CENTROID_PROTOTYPES: int = 0  # k-means prototypes per class stored with the centroids (0 = class means only)
+    RELATED_TOP_K: int = 10  # Similar dishes precomputed per class in the related-dish graph
+    EMBED_CACHE: bool = True  # Reuse embeddings of unchanged images across rebuilds
+    EMBED_CACHE_KEY: str = Field(default="stat", description="stat (path+size+mtime) or content (sha1 of bytes)")
+    PIXEL_SHARDS: bool = False  # Feed build/eval from preprocessed crops (scripts/build_pixel_shards.py) when present
+    PIXEL_SHARD_SIZE: int = 4096  # Images per shard file
     
     # --- Retrieval ---
     USE_FAISS: bool = True
+    INDEX_TYPE: str = Field(default="flat", description="flat, ivf_flat, ivf_pq, hnsw or opq_pq (FAISS only)")
+    IVF_NLIST: int = 0  # Number of IVF lists, 0 = auto (~4*sqrt(N))
+    PQ_M: int = 16  # PQ sub-quantizers, must divide the embedding dim
+    PQ_NBITS: int = 8
+    HNSW_M: int = 32
+    HNSW_EF_CONSTRUCTION: int = 200
+    INDEX_TRAIN_SAMPLE: int = 100_000  # Vectors used to train IVF / PQ / OPQ (and fit PCA)
+    REDUCE_DIM: int = 0  # PCA the stored vectors and queries down to this dimension at build time (0 = off)
+    REDUCE_WHITEN: bool = False  # Whiten the PCA components (vectors are re-normalized either way)
+    INDEX_KEEP_VERSIONS: int = 3  # Published index versions kept under artifacts/indexes/ (0 = keep all)
+    INDEX_WATCH_INTERVAL_S: float = 0.0  # Poll the 'current' pointer and hot-swap new versions (0 = off)
+    BUILD_BUNDLE: bool = False  # Also pack each index build into one memory-mappable bundle.f2r
+    BUNDLE_PATH: Optional[Path] = Field(default=None)  # Serve from this bundle file alone (no index folder / recipes CSV)
+    NPROBE: int = 16  # IVF lists visited per query
+    EF_SEARCH: int = 64  # HNSW candidate list size per query
+    NUMPY_INDEX_DTYPE: str = Field(default="float32", description="float32, float16 or int8 (NumPy backend storage)")
+    NUMPY_SEARCH_BLOCK: int = 65536  # Rows per block when scoring (NumPy backend) or adding vectors to FAISS
     TOP_K: int = 5
-    CONFIDENCE_THRESHOLD: float = 0.6  # If similarity < threshold -> Uncertain
+    MAX_TOP_K: int = 100  # Largest per-request top_k accepted (predict / submit / POST /predict)
+    CONFIDENCE_THRESHOLD: float = 0.6  # If top-1 neighbour similarity < threshold -> Uncertain
+    PREDICTION_MODE: Literal["knn", "cascade", "linear"] = Field(default="knn", description="knn, cascade (class centroids first, kNN when ambiguous) or linear (trained probe)")
+    CENTROID_CONFIDENCE_THRESHOLD: float = 0.6  # Same, for the centroid cosine of cascade fast-path votes
+    PROBE_CONFIDENCE_THRESHOLD: float = 0.6  # Same, for the calibrated probability of linear-mode votes
+    CASCADE_MARGIN: float = 0.05  # Centroid top-1 minus top-2 cosine needed to skip the kNN search
+    CASCADE_TOP_M: int = 0  # Classes the escalated kNN vote is restricted to (0 = all)
+    PREDICTION_CACHE_SIZE: int = 1024  # Entries per cache (embeddings / search results), 0 = disabled
+    PREDICTION_CACHE_TTL_S: float = 3600.0  # 0 = no expiry
+    SEMANTIC_CACHE_SIZE: int = 256  # Recent query embeddings kept for near-duplicate hits, 0 = disabled
+    SEMANTIC_CACHE_THRESHOLD: float = 0.995  # Cosine similarity above which a cached result is reused
+    SEMANTIC_CACHE_VERSIONS: int = 8  # (index, top_k, mode) combinations cached side by side, LRU beyond that
+    # Shared in-process executor (RecipeRecommender.submit), e.g. for concurrent Streamlit sessions
+    EXECUTOR_MAX_BATCH_SIZE: int = 8  # Requests micro-batched into one forward pass / search
+    EXECUTOR_MAX_WAIT_MS: float = 5.0  # How long the first request of a batch waits for company
+    EXECUTOR_MAX_QUEUE_SIZE: int = 32  # Requests beyond this are rejected (QueueFullError)
+    EXECUTOR_TIMEOUT_S: float = 60.0  # A caller gives up (and its queued request is dropped) after this
+
+    # --- Inference Server ---
+    SERVER_HOST: str = "127.0.0.1"
+    SERVER_PORT: int = 8765
+    SERVER_MAX_BATCH_SIZE: int = 16  # Dispatch a micro-batch once it has this many images...
+    SERVER_MAX_WAIT_MS: float = 10.0  # ...or once the oldest request waited this long
+    SERVER_MAX_QUEUE_SIZE: int = 64  # Requests beyond this are rejected with 503
+    SERVER_MAX_UPLOAD_MB: float = 10.0
+    SERVER_WORKERS: int = 1  # >1: load once, then fork workers sharing the model and index pages (Linux)
+    INFERENCE_SERVER_URL: Optional[str] = Field(default=None, description="If set, the app predicts through this server")
     
     # --- CSV Mapping ---
     # Allow mapping CSV columns via config
@@ -48,10 +129,6 @@ class Settings(BaseSettings):
     INSTRUCTIONS_COL: str = "instructions"
     TITLE_COL: str = "vietnamese_name" # Optional display title
     
-    class Config:
-        env_file = ".env"
-        extra = "ignore" # Ignore extra env vars
-
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         # Set defaults if not provided, allowing for flexible 'Data root'
@@ -64,17 +141,23 @@ class Settings(BaseSettings):
         # let's defaulting to looking in data/ first, then fall back to root if not found?
         # For 'Production-Lite' we strictly follow the config.
         
-        if self.IMAGES_DIR is None:
-            self.IMAGES_DIR = self.DATA_DIR / "Images"
-        if self.URLS_DIR is None:
-            self.URLS_DIR = self.DATA_DIR / "Urls"
-        if self.RECIPES_CSV is None:
-            self.RECIPES_CSV = self.DATA_DIR / "vnfood30_recipes.csv"
-            
-        if self.ARTIFACTS_DIR is None:
-            self.ARTIFACTS_DIR = self.BASE_DIR / "food2recipe" / "artifacts"
-        if self.REPORTS_DIR is None:
-            self.REPORTS_DIR = self.BASE_DIR / "food2recipe" / "reports"
+        # Derived defaults are filled in once here; the instance is frozen afterwards
+        defaults = {
+            "IMAGES_DIR": self.DATA_DIR / "Images",
+            "URLS_DIR": self.DATA_DIR / "Urls",
+            "RECIPES_CSV": self.DATA_DIR / "vnfood30_recipes.csv",
+            "ARTIFACTS_DIR": self.BASE_DIR / "food2recipe" / "artifacts",
+            "REPORTS_DIR": self.BASE_DIR / "food2recipe" / "reports",
+        }
+        for name, value in defaults.items():
+            if getattr(self, name) is None:
+                object.__setattr__(self, name, value)
+
+        if self.PROFILE not in ("full", "serving"):
+            raise ValueError(f"Unknown PROFILE: {self.PROFILE}. Expected full or serving")
+        if self.PROFILE == "serving":
+            # Artifacts only: the recipes CSV (without a bundle) is checked when it is read
+            return
 
         # --- Sanity check paths ---
         if not self.IMAGES_DIR.exists():
@@ -83,12 +166,19 @@ class Settings(BaseSettings):
         if not self.URLS_DIR.exists():
             raise FileNotFoundError(f"URLS_DIR not found: {self.URLS_DIR.resolve()}")
 
-        if not self.RECIPES_CSV.exists():
+        # A serving bundle carries the processed recipes
+        if not self.RECIPES_CSV.exists() and self.BUNDLE_PATH is None:
             raise FileNotFoundError(f"RECIPES_CSV not found: {self.RECIPES_CSV.resolve()}")
     
         # Ensure output dirs exist
         os.makedirs(self.ARTIFACTS_DIR, exist_ok=True)
         os.makedirs(self.REPORTS_DIR, exist_ok=True)
 
+
+@functools.lru_cache(maxsize=None)
 def load_settings() -> Settings:
+    """
+    Process-wide settings, read from the environment / .env and checked once.
+    Call load_settings.cache_clear() to re-read them (e.g. after changing the environment).
+    """
     return Settings()
@@ -1,14 +1,94 @@
 # File: food2recipe/evaluation/evaluate.py
+import time
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from food2recipe.core.settings import load_settings
 from food2recipe.core.logging_utils import setup_logger
 from food2recipe.retrieval.recommender import RecipeRecommender
+from food2recipe.preprocessing.pixel_shards import PixelShardStore
 from food2recipe.evaluation.metrics import compute_top_k_accuracy, compute_top_k_hit_rate, compute_mrr
 from food2recipe.evaluation.report import save_report
 
 logger = setup_logger("evaluate")
 
+
+def encode_test_set(recommender, paths, settings):
+    """Embeddings of the test images (pixel shards when available), in input order, plus the paths kept."""
+    embs, kept = [], []
+    store = PixelShardStore(settings)
+    if settings.PIXEL_SHARDS and store.exists():
+        store.load()
+        for images, batch_paths in store.iter_batches(paths, settings.BUILD_BATCH_SIZE):
+            embs.append(recommender.embed(images))
+            kept.extend(batch_paths)
+    done = set(kept)
+    rest = [p for p in paths if p not in done]
+    for start in range(0, len(rest), settings.BUILD_BATCH_SIZE):
+        chunk = rest[start:start + settings.BUILD_BATCH_SIZE]
+        batch_embs, ok = recommender.encode_images(chunk)
+        embs.append(batch_embs)
+        kept.extend(chunk[i] for i in ok)
+    order = {p: i for i, p in enumerate(kept)}
+    kept = [p for p in paths if p in order]
+    if not kept:
+        return np.zeros((0, 0), dtype=np.float32), []
+    return np.vstack(embs)[[order[p] for p in kept]], kept
+
+
+def compare_prediction_modes(recommender, test_df, settings):
+    """
+    Runs every available prediction mode over the same test embeddings, one
+    query at a time as the server sees them. Reports Top-1 accuracy (and its
+    delta vs knn), per-query classification latency, the size of what each
+    mode keeps in memory and, for the cascade, the share of queries answered
+    from the centroids alone.
+    """
+    modes = ["knn"]
+    index_mb = recommender.index.memory_bytes() / 2**20
+    memory_mb = {"knn": index_mb}
+    if recommender.centroids is not None:
+        modes.append("cascade")
+        memory_mb["cascade"] = index_mb + recommender.centroids.nbytes / 2**20
+    if recommender.linear_probe is not None:
+        modes.append("linear")
+        memory_mb["linear"] = recommender.linear_probe.nbytes / 2**20
+    truth = dict(zip(test_df['image_path'], test_df['food_name']))
+    embs, paths = encode_test_set(recommender, test_df['image_path'].tolist(), settings)
+    if not paths:
+        logger.warning("No test image could be encoded, skipping the mode comparison.")
+        return None
+
+    metrics, rows = {}, []
+    for mode in modes:
+        recommender.cascade_stats = {"fast": 0, "escalated": 0}
+        latencies, correct = [], []
+        for emb, path in zip(embs, paths):
+            t0 = time.perf_counter()
+            vote = recommender.classify(emb[None, :], mode=mode)[0]
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            correct.append(vote[0] == truth[path])
+
+        row = {
+            "mode": mode,
+            "top1_accuracy": float(np.mean(correct)),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "memory_mb": memory_mb[mode],
+        }
+        row["accuracy_delta_vs_knn"] = row["top1_accuracy"] - rows[0]["top1_accuracy"] if rows else 0.0
+        if mode == "cascade":
+            row["fast_path_rate"] = recommender.cascade_stats_summary()["fast_path_rate"]
+        rows.append(row)
+        for k, v in row.items():
+            if k != "mode":
+                metrics[f"{mode} {k}"] = v
+
+    recommender.cascade_stats = {"fast": 0, "escalated": 0}
+    logger.info(f"Prediction modes: {rows}")
+    return save_report(metrics, rows, report_name="eval_modes", settings=settings)
+
+
 def run_evaluation():
     settings = load_settings()
     
@@ -44,6 +124,16 @@ def run_evaluation():
     pred_labels_topk = []
     
     details = []
+
+    # Images with preprocessed crops are predicted in batches straight from the shards
+    precomputed = {}
+    store = PixelShardStore(settings)
+    if settings.PIXEL_SHARDS and store.exists():
+        store.load()
+        batches = store.iter_batches(test_df['image_path'].tolist(), settings.BUILD_BATCH_SIZE)
+        for images, paths in tqdm(batches, desc="Pixel shards"):
+            precomputed.update(zip(paths, recommender.predict_tensors(images)))
+        logger.info(f"{len(precomputed)} images predicted from pixel shards.")
     
     for idx, row in tqdm(test_df.iterrows(), total=len(test_df)):
         img_path = row['image_path']
@@ -52,7 +142,7 @@ def run_evaluation():
         try:
             # Predict
             # Note: predict() takes path or file
-            res = recommender.predict(img_path)
+            res = precomputed.get(img_path) or recommender.predict(img_path)
             
             p_top1 = res['predicted_food']
             p_topk = [item['food_name'] for item in res['top_k_items']]
@@ -87,8 +177,13 @@ def run_evaluation():
     logger.info(f"Results: {metrics}")
     
     # Save Report
-    s_path, c_path = save_report(metrics, details)
+    s_path, c_path = save_report(metrics, details, settings=settings)
     logger.info(f"Reports saved to {s_path} and {c_path}")
 
+    # knn vs cascade on the same embeddings
+    saved = compare_prediction_modes(recommender, test_df, settings)
+    if saved:
+        logger.info(f"Mode comparison saved to {saved[0]}")
+
 if __name__ == "__main__":
     run_evaluation()
@@ -3,8 +3,8 @@ import pandas as pd
 from typing import Dict, List
 from food2recipe.core.settings import load_settings
 
-def save_report(metrics: Dict, confusion_data: List[Dict], report_name="eval_report"):
-    settings = load_settings()
+def save_report(metrics: Dict, confusion_data: List[Dict], report_name="eval_report", settings=None):
+    settings = settings or load_settings()
     report_dir = settings.REPORTS_DIR
     
     # Save Summary
@@ -0,0 +1,114 @@
+# File: food2recipe/models/embedding_cache.py
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("embedding_cache")
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of image embeddings, so index rebuilds only encode new or changed files.
+
+    Entries are keyed by file identity:
+      - "stat":    path + size + mtime (cheap, default)
+      - "content": sha1 of the file bytes (survives moves/touches, costs one read per file)
+    The cache lives in a namespace derived from backend / model / pretrained tag / image size,
+    so switching models never reuses stale vectors.
+    Files that failed to decode are remembered in a negative cache under the same key.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.key_mode = settings.EMBED_CACHE_KEY.lower()
+        if self.key_mode not in ("stat", "content"):
+            raise ValueError(f"Unknown EMBED_CACHE_KEY: {settings.EMBED_CACHE_KEY}")
+
+        self.root = Path(settings.ARTIFACTS_DIR) / "embedding_cache" / self.namespace(settings)
+        self.vectors = {}  # key -> (D,) float32
+        self.failed = {}   # key -> error message
+
+    @staticmethod
+    def namespace(settings) -> str:
+        raw = f"{settings.MODEL_BACKEND}-{settings.MODEL_NAME}-{settings.PRETRAINED_DATASET}-{settings.IMAGE_SIZE}"
+        # Fast preprocessing gives slightly different vectors; standard keeps the original namespace
+        if settings.PREPROCESS_MODE != "standard":
+            raw += f"-{settings.PREPROCESS_MODE}"
+        return re.sub(r"[^A-Za-z0-9_.-]+", "_", raw)
+
+    def file_key(self, path) -> str:
+        if self.key_mode == "content":
+            h = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            return h.hexdigest()
+        st = os.stat(path)
+        return f"{Path(path).resolve()}|{st.st_size}|{st.st_mtime_ns}"
+
+    def load(self):
+        store_path = self.root / "cache.npz"
+        failed_path = self.root / "failed.json"
+
+        if store_path.exists():
+            try:
+                with np.load(store_path) as data:
+                    self.vectors = dict(zip(data["keys"].tolist(), data["vectors"]))
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable embedding cache at {self.root}: {e}")
+                self.vectors = {}
+
+        if failed_path.exists():
+            with open(failed_path, "r", encoding="utf-8") as f:
+                self.failed = json.load(f)
+
+        logger.info(f"Embedding cache: {len(self.vectors)} vectors, {len(self.failed)} known-bad files ({self.root.name})")
+        return self
+
+    def get(self, key):
+        return self.vectors.get(key)
+
+    def put(self, key, vector):
+        self.vectors[key] = np.asarray(vector, dtype=np.float32)
+        self.failed.pop(key, None)
+
+    def mark_failed(self, key, reason="decode error"):
+        self.failed[key] = reason
+
+    def is_failed(self, key) -> bool:
+        return key in self.failed
+
+    def prune(self, live_keys):
+        """Drops entries for files that are no longer in the dataset."""
+        live_keys = set(live_keys)
+        stale = [k for k in self.vectors if k not in live_keys]
+        for k in stale:
+            del self.vectors[k]
+        self.failed = {k: v for k, v in self.failed.items() if k in live_keys}
+        if stale:
+            logger.info(f"Dropped {len(stale)} cached vectors for deleted/changed files.")
+
+    def save(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        keys = list(self.vectors.keys())
+        if keys:
+            matrix = np.stack([self.vectors[k] for k in keys]).astype(np.float32)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+
+        # Keys and vectors go in one file, written to a temp name then renamed,
+        # so an interrupted save never leaves them out of sync
+        tmp_store = self.root / "cache.tmp.npz"
+        with open(tmp_store, "wb") as f:
+            np.savez(f, keys=np.array(keys, dtype=str), vectors=matrix)
+        os.replace(tmp_store, self.root / "cache.npz")
+
+        tmp_failed = self.root / "failed.tmp.json"
+        with open(tmp_failed, "w", encoding="utf-8") as f:
+            json.dump(self.failed, f)
+        os.replace(tmp_failed, self.root / "failed.json")
+        logger.info(f"Saved embedding cache ({len(keys)} vectors) to {self.root}")
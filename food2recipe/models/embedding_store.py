@@ -1,28 +1,354 @@
 # File: food2recipe/models/embedding_store.py
-import torch
+import os
+import json
+import time
+import shutil
+import uuid
 import pickle
+import hashlib
+import numpy as np
 from pathlib import Path
+from typing import Dict, List, Optional
 from food2recipe.core.logging_utils import setup_logger
 
 logger = setup_logger("embedding_store")
 
-def save_embeddings(embeddings, metadata, output_path: Path):
+FORMAT_VERSION = 1
+
+# On-disk layout (one folder):
+#   header.json       model, dim, count, dtype, checksum, build_id
+#   embeddings.npy    (N, D) float32/float16, opened with mmap_mode="r"
+#   label_ids.npy     (N,) int32 -> class_names
+#   split_ids.npy     (N,) int8  -> split_names
+#   path_offsets.npy  (N+1,) int64 byte offsets into path_blob.npy
+#   path_blob.npy     (total,) uint8, utf-8 paths concatenated
+#   class_names.json  class table (label id -> food_name)
+HEADER_FILE = "header.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+
+
+class ColumnarMetadata:
+    """
+    Per-image metadata stored as flat arrays instead of a list of dicts.
+
+    Arrays can be memory-mapped, so several processes share the same pages and
+    nothing has to be unpickled. Indexing still returns a dict
+    ({"image_path", "food_name", "split"}) for code that expects the old format.
+    """
+
+    def __init__(self, label_ids, class_names, split_ids, split_names, path_offsets, path_blob):
+        self.label_ids = label_ids
+        self.class_names = list(class_names)
+        self.split_ids = split_ids
+        self.split_names = list(split_names)
+        self.path_offsets = path_offsets
+        self.path_blob = path_blob
+
+    @classmethod
+    def from_records(cls, records: List[Dict]) -> "ColumnarMetadata":
+        """Builds columns from a list of {"image_path", "food_name", "split"} dicts."""
+        food_names = [r["food_name"] for r in records]
+        splits = [r.get("split", "") for r in records]
+
+        class_names = sorted(set(food_names))
+        class_to_id = {name: i for i, name in enumerate(class_names)}
+        split_names = sorted(set(splits))
+        split_to_id = {name: i for i, name in enumerate(split_names)}
+
+        encoded = [str(r.get("image_path") or "").encode("utf-8") for r in records]
+        lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+        path_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=path_offsets[1:])
+
+        return cls(
+            label_ids=np.array([class_to_id[n] for n in food_names], dtype=np.int32),
+            class_names=class_names,
+            split_ids=np.array([split_to_id[s] for s in splits], dtype=np.int8),
+            split_names=split_names,
+            path_offsets=path_offsets,
+            path_blob=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        )
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def image_path(self, i: int) -> str:
+        start, end = self.path_offsets[i], self.path_offsets[i + 1]
+        return self.path_blob[start:end].tobytes().decode("utf-8")
+
+    def food_name(self, i: int) -> str:
+        return self.class_names[self.label_ids[i]]
+
+    def split(self, i: int) -> str:
+        return self.split_names[self.split_ids[i]]
+
+    def __getitem__(self, i: int) -> Dict:
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        return {"image_path": self.image_path(i), "food_name": self.food_name(i), "split": self.split(i)}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_records(self) -> List[Dict]:
+        return list(self)
+
+    def save(self, folder: Path):
+        np.save(folder / "label_ids.npy", np.asarray(self.label_ids, dtype=np.int32))
+        np.save(folder / "split_ids.npy", np.asarray(self.split_ids, dtype=np.int8))
+        np.save(folder / "path_offsets.npy", np.asarray(self.path_offsets, dtype=np.int64))
+        np.save(folder / "path_blob.npy", np.asarray(self.path_blob, dtype=np.uint8))
+        with open(folder / "class_names.json", "w", encoding="utf-8") as f:
+            json.dump({"class_names": self.class_names, "split_names": self.split_names}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, folder: Path, mmap: bool = True) -> "ColumnarMetadata":
+        mode = "r" if mmap else None
+        with open(folder / "class_names.json", "r", encoding="utf-8") as f:
+            tables = json.load(f)
+        return cls(
+            label_ids=np.load(folder / "label_ids.npy", mmap_mode=mode),
+            class_names=tables["class_names"],
+            split_ids=np.load(folder / "split_ids.npy", mmap_mode=mode),
+            split_names=tables["split_names"],
+            path_offsets=np.load(folder / "path_offsets.npy", mmap_mode=mode),
+            path_blob=np.load(folder / "path_blob.npy", mmap_mode=mode),
+        )
+
+
+def compute_checksum(embeddings: np.ndarray) -> str:
+    """sha256 of the raw matrix bytes, hashed in row blocks to keep memory flat for mmapped input."""
+    h = hashlib.sha256()
+    block = max(1, (64 << 20) // max(1, embeddings.strides[0]))
+    for start in range(0, len(embeddings), block):
+        h.update(np.ascontiguousarray(embeddings[start:start + block]).tobytes())
+    return h.hexdigest()
+
+
+def save_store(folder: Path, embeddings: np.ndarray, metadata, model: str = "", dtype: str = "float32",
+               build_id: Optional[str] = None) -> Dict:
     """
-    Saves embeddings (Tensor) and metadata (List of dict/df) to disk.
+    Writes embeddings + columnar metadata + JSON header to folder.
+    metadata: ColumnarMetadata or list of dicts.
+    Returns the header.
     """
-    data = {
-        "embeddings": embeddings,
-        "metadata": metadata
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    if not isinstance(metadata, ColumnarMetadata):
+        metadata = ColumnarMetadata.from_records(metadata)
+    if len(metadata) != len(embeddings):
+        raise ValueError(f"{len(embeddings)} embeddings but {len(metadata)} metadata rows")
+
+    matrix = np.ascontiguousarray(embeddings, dtype=np.dtype(dtype))
+    np.save(folder / EMBEDDINGS_FILE, matrix)
+    metadata.save(folder)
+
+    header = {
+        "format_version": FORMAT_VERSION,
+        "build_id": build_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}",
+        "model": model,
+        "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+        "count": int(len(matrix)),
+        "dtype": matrix.dtype.name,
+        "checksum": compute_checksum(matrix),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
     }
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, "wb") as f:
-        pickle.dump(data, f)
-    logger.info(f"Saved {len(metadata)} embeddings to {output_path}")
+    with open(folder / HEADER_FILE, "w", encoding="utf-8") as f:
+        json.dump(header, f, indent=2)
+
+    logger.info(f"Saved {len(metadata)} embeddings ({header['dtype']}) to {folder}")
+    return header
+
+
+def load_store(folder: Path, mmap: bool = True, verify: bool = False):
+    """
+    Opens a store written by save_store.
+    With mmap=True nothing is copied: arrays are views of the page cache, shared across processes.
+    Returns (embeddings, ColumnarMetadata, header).
+    """
+    folder = Path(folder)
+    if not (folder / HEADER_FILE).exists():
+        raise FileNotFoundError(f"No embedding store at {folder}")
+
+    with open(folder / HEADER_FILE, "r", encoding="utf-8") as f:
+        header = json.load(f)
+
+    embeddings = np.load(folder / EMBEDDINGS_FILE, mmap_mode="r" if mmap else None)
+    metadata = ColumnarMetadata.load(folder, mmap=mmap)
+
+    if embeddings.shape[0] != header["count"] or len(metadata) != header["count"]:
+        raise ValueError(f"Corrupt embedding store at {folder}: counts do not match header")
+    if verify and compute_checksum(embeddings) != header["checksum"]:
+        raise ValueError(f"Checksum mismatch for embedding store at {folder}")
+
+    return embeddings, metadata, header
+
+
+def save_embeddings(embeddings, metadata, output_path: Path):
+    """
+    Saves embeddings (Tensor or array) and metadata (list of dicts) to the store folder output_path.
+    """
+    if hasattr(embeddings, "numpy"):
+        embeddings = embeddings.numpy()
+    save_store(output_path, embeddings, metadata)
+
+
+class StoreWriter:
+    """
+    Streams rows into pre-sized memory-mapped columns in a staging folder, so a
+    build never holds the whole matrix or a dict per image in memory.
+
+    checkpoint(rows_done) makes everything appended so far durable; open() on a
+    staging folder with the same signature resumes from the last checkpoint.
+    Staging layout: embeddings.npy, label_ids.npy, split_ids.npy, path_offsets.npy
+    (all sized for capacity rows), path_blob.bin and checkpoint.json.
+    """
+
+    CHECKPOINT_FILE = "checkpoint.json"
+
+    def __init__(self, folder: Path, capacity: int, signature: str):
+        self.folder = Path(folder)
+        self.capacity = capacity
+        self.signature = signature
+        self.written = 0
+        self.dim = 0
+        self.class_names: List[str] = []
+        self.split_names: List[str] = []
+        self._class_to_id = {}
+        self._split_to_id = {}
+        self._path_bytes = 0
+        self._emb = None
+        self._cols = {}
+        self._blob = None
+
+    def open(self) -> int:
+        """Returns the number of input rows already consumed (0 for a fresh build)."""
+        state = None
+        ckpt = self.folder / self.CHECKPOINT_FILE
+        if ckpt.exists():
+            with open(ckpt, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("signature") != self.signature or state.get("capacity") != self.capacity:
+                logger.info("Staging folder belongs to another build, starting over.")
+                state = None
+
+        if state is None:
+            if self.folder.exists():
+                for f in self.folder.iterdir():
+                    f.unlink()
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self._cols = {
+                "label_ids": np.lib.format.open_memmap(self.folder / "label_ids.npy", "w+", np.int32, (self.capacity,)),
+                "split_ids": np.lib.format.open_memmap(self.folder / "split_ids.npy", "w+", np.int8, (self.capacity,)),
+                "path_offsets": np.lib.format.open_memmap(
+                    self.folder / "path_offsets.npy", "w+", np.int64, (self.capacity + 1,)
+                ),
+            }
+            self._blob = open(self.folder / "path_blob.bin", "wb")
+            return 0
+
+        self.written = state["written"]
+        self.dim = state["dim"]
+        self.class_names = state["class_names"]
+        self.split_names = state["split_names"]
+        self._class_to_id = {n: i for i, n in enumerate(self.class_names)}
+        self._split_to_id = {n: i for i, n in enumerate(self.split_names)}
+        self._path_bytes = state["path_bytes"]
+        self._cols = {name: np.load(self.folder / f"{name}.npy", mmap_mode="r+")
+                      for name in ("label_ids", "split_ids", "path_offsets")}
+        if self.dim:
+            self._emb = np.load(self.folder / EMBEDDINGS_FILE, mmap_mode="r+")
+        # Drop path bytes appended after the last checkpoint
+        self._blob = open(self.folder / "path_blob.bin", "r+b")
+        self._blob.truncate(self._path_bytes)
+        self._blob.seek(self._path_bytes)
+        logger.info(f"Resuming build: {self.written} rows written, {state['rows_done']} input rows done.")
+        return state["rows_done"]
+
+    def append(self, embeddings: np.ndarray, records: List[Dict]):
+        """embeddings: (n, D); records: n {"image_path", "food_name", "split"} dicts."""
+        n = len(records)
+        if n == 0:
+            return
+        if self._emb is None:
+            self.dim = int(embeddings.shape[1])
+            self._emb = np.lib.format.open_memmap(
+                self.folder / EMBEDDINGS_FILE, "w+", np.float32, (self.capacity, self.dim)
+            )
+
+        start, end = self.written, self.written + n
+        self._emb[start:end] = embeddings
+        for i, r in enumerate(records, start):
+            self._cols["label_ids"][i] = self._class_to_id.setdefault(r["food_name"], len(self._class_to_id))
+            self._cols["split_ids"][i] = self._split_to_id.setdefault(r.get("split", ""), len(self._split_to_id))
+            encoded = str(r.get("image_path") or "").encode("utf-8")
+            self._blob.write(encoded)
+            self._path_bytes += len(encoded)
+            self._cols["path_offsets"][i + 1] = self._path_bytes
+        self.class_names = list(self._class_to_id)
+        self.split_names = list(self._split_to_id)
+        self.written = end
+
+    def checkpoint(self, rows_done: int):
+        if self._emb is not None:
+            self._emb.flush()
+        for col in self._cols.values():
+            col.flush()
+        self._blob.flush()
+        os.fsync(self._blob.fileno())
+
+        state = {
+            "signature": self.signature,
+            "capacity": self.capacity,
+            "rows_done": rows_done,
+            "written": self.written,
+            "dim": self.dim,
+            "class_names": self.class_names,
+            "split_names": self.split_names,
+            "path_bytes": self._path_bytes,
+        }
+        tmp = self.folder / (self.CHECKPOINT_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self.folder / self.CHECKPOINT_FILE)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """Memory-mapped (written, D) view."""
+        return self._emb[:self.written]
+
+    def metadata(self) -> ColumnarMetadata:
+        self._blob.flush()
+        if self._path_bytes:
+            blob = np.memmap(self.folder / "path_blob.bin", dtype=np.uint8, mode="r", shape=(self._path_bytes,))
+        else:
+            blob = np.zeros(0, dtype=np.uint8)
+        return ColumnarMetadata(
+            label_ids=self._cols["label_ids"][:self.written],
+            class_names=self.class_names,
+            split_ids=self._cols["split_ids"][:self.written],
+            split_names=self.split_names,
+            path_offsets=self._cols["path_offsets"][:self.written + 1],
+            path_blob=blob,
+        )
+
+    def cleanup(self):
+        """Removes the staging folder once the final store is written."""
+        self._blob.close()
+        self._emb = None
+        self._cols = {}
+        shutil.rmtree(self.folder, ignore_errors=True)
+
 
 def load_embeddings(input_path: Path):
-    if not input_path.exists():
-        raise FileNotFoundError(f"No embedding store at {input_path}")
-        
-    with open(input_path, "rb") as f:
-        data = pickle.load(f)
-    return data["embeddings"], data["metadata"]
+    input_path = Path(input_path)
+    if input_path.is_file():
+        # Legacy pickle format
+        with open(input_path, "rb") as f:
+            data = pickle.load(f)
+        return data["embeddings"], data["metadata"]
+
+    embeddings, metadata, _ = load_store(input_path)
+    return embeddings, metadata
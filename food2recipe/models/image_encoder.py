@@ -1,38 +1,143 @@
 # File: food2recipe/models/image_encoder.py
+import re
+import json
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from pathlib import Path
 from food2recipe.core.settings import load_settings
 from food2recipe.core.logging_utils import setup_logger
 
 logger = setup_logger("image_encoder")
 
+# torch thread pools are process-wide; only the first encoder in a process configures them
+_THREADS_CONFIGURED = False
+
+def configure_torch_threads(settings):
+    """
+    Applies TORCH_NUM_THREADS / TORCH_NUM_INTEROP_THREADS (0 = keep torch defaults).
+    Pinning these matters when several sessions share one process: the defaults
+    give every concurrent call all cores and oversubscribe the machine.
+    """
+    global _THREADS_CONFIGURED
+    if _THREADS_CONFIGURED or (settings.TORCH_NUM_THREADS <= 0 and settings.TORCH_NUM_INTEROP_THREADS <= 0):
+        return
+    _THREADS_CONFIGURED = True
+
+    if settings.TORCH_NUM_THREADS > 0:
+        torch.set_num_threads(settings.TORCH_NUM_THREADS)
+    if settings.TORCH_NUM_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(settings.TORCH_NUM_INTEROP_THREADS)
+        except RuntimeError as e:
+            # Can only be set before any inter-op parallel work has started
+            logger.warning(f"Could not set inter-op threads: {e}")
+    logger.info(f"torch threads: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+class _VisualTower(nn.Module):
+    """Wraps the visual part of a backend model so it exports as a plain image -> features graph."""
+    def __init__(self, model, backend):
+        super().__init__()
+        self.model = model
+        self.backend = backend
+
+    def forward(self, images):
+        if self.backend == "open_clip":
+            return self.model.encode_image(images)
+        return self.model(images)
+
 class ImageEncoder:
     def __init__(self, settings=None):
         self.settings = settings or load_settings()
         self.device = torch.device(self.settings.DEVICE if torch.cuda.is_available() else "cpu")
         self.model = None
         self.preprocess = None
+        self.session = None # onnxruntime session (onnx backend)
+        self._forward = None # images -> features, possibly compiled/traced
+        self.use_bf16 = False
+        configure_torch_threads(self.settings)
         self._load_model()
+        self.warmup()
 
     def _load_model(self):
         backend = self.settings.MODEL_BACKEND.lower()
+        if backend == "onnx":
+            self._load_onnx()
+            return
+
+        logger.info(f"Loading model: {backend} - {self.settings.MODEL_NAME} (on {self.device})")
+        self.model = self._load_torch_model(backend)
+        self._forward = self._optimize(_VisualTower(self.model, backend).eval())
+
+    def _optimize(self, tower):
+        """
+        CPU inference tuning from Settings: channels_last memory format,
+        bf16 autocast (only where the CPU supports it), and torch.compile or a
+        TorchScript trace.
+        """
+        if self.settings.CHANNELS_LAST:
+            tower = tower.to(memory_format=torch.channels_last)
+
+        if self.settings.USE_BF16:
+            if self.device.type == "cpu" and not cpu_supports_bf16():
+                logger.warning("USE_BF16 set but this CPU has no native bf16 support; staying in fp32.")
+            else:
+                self.use_bf16 = True
+
+        mode = self.settings.COMPILE_MODE.lower()
+        if mode == "compile":
+            tower = torch.compile(tower)
+        elif mode == "trace":
+            size = self.settings.IMAGE_SIZE
+            example = torch.zeros(1, 3, size, size, device=self.device)
+            if self.settings.CHANNELS_LAST:
+                example = example.contiguous(memory_format=torch.channels_last)
+            with torch.no_grad(), self._autocast():
+                tower = torch.jit.freeze(torch.jit.trace(tower, example, check_trace=False))
+        elif mode != "none":
+            raise ValueError(f"Unknown COMPILE_MODE: {mode}")
+        return tower
+
+    def _autocast(self):
+        if self.use_bf16:
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def _grad_context(self):
+        return torch.inference_mode() if self.settings.USE_INFERENCE_MODE else torch.no_grad()
+
+    def warmup(self):
+        """
+        Runs WARMUP_ITERS dummy batches so the first real request does not pay
+        for compilation, tracing or allocator growth.
+        """
+        size = self.settings.IMAGE_SIZE
+        for _ in range(self.settings.WARMUP_ITERS):
+            self.encode(torch.zeros(1, 3, size, size))
+
+    def _load_torch_model(self, backend):
         model_name = self.settings.MODEL_NAME
         pretrained = self.settings.PRETRAINED_DATASET
-        
-        logger.info(f"Loading model: {backend} - {model_name} (on {self.device})")
-        
+
         if backend == "open_clip":
             try:
                 import open_clip
                 model, _, preprocess = open_clip.create_model_and_transforms(
-                    model_name, 
+                    model_name,
                     pretrained=pretrained,
                     device=self.device
                 )
-                self.model = model
+                model.eval()
                 self.preprocess = preprocess # Note: We use our own deterministic transform usually, but keep this ref
                 logger.info("OpenCLIP model loaded.")
+                return model
             except ImportError:
                 logger.warning("open_clip not found. Install it or switch backend. Fallback to timm?")
                 raise
@@ -40,33 +145,135 @@ class ImageEncoder:
             try:
                 import timm
                 # Load a model that outputs embeddings (remove classifier)
-                self.model = timm.create_model(model_name, pretrained=True, num_classes=0).to(self.device)
-                self.model.eval()
+                model = timm.create_model(model_name, pretrained=True, num_classes=0).to(self.device)
+                model.eval()
                 logger.info("Timm model loaded.")
+                return model
             except ImportError:
                 logger.error("timm not installed.")
                 raise
         else:
             raise ValueError(f"Unknown backend: {backend}")
 
+    # --- ONNX Runtime backend ---
+
+    def onnx_paths(self):
+        """Cached export location, one file per source backend / model / pretrained tag / image size."""
+        s = self.settings
+        raw = f"{s.ONNX_SOURCE_BACKEND}-{s.MODEL_NAME}-{s.PRETRAINED_DATASET}-{s.IMAGE_SIZE}"
+        stem = re.sub(r"[^A-Za-z0-9_.-]+", "_", raw)
+        folder = Path(s.ARTIFACTS_DIR) / "onnx"
+        return folder / f"{stem}.onnx", folder / f"{stem}.int8.onnx"
+
+    def _load_onnx(self):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            logger.error("onnxruntime not installed. pip install -r requirements-onnx.txt")
+            raise
+
+        fp32_path, int8_path = self.onnx_paths()
+        parity_path = fp32_path.with_suffix(".parity.json")
+        parity = json.loads(parity_path.read_text()) if parity_path.exists() else {}
+        # A rejected int8 model is recorded in the parity report, so it is not re-exported on every start
+        if not fp32_path.exists() or (self.settings.ONNX_QUANTIZE and "int8_min_cosine" not in parity):
+            self.export_onnx()
+
+        path = fp32_path
+        if self.settings.ONNX_QUANTIZE:
+            if int8_path.exists():
+                path = int8_path
+            else:
+                logger.warning("int8 model failed the parity check at export, using fp32 ONNX model.")
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.settings.TORCH_NUM_THREADS > 0:
+            opts.intra_op_num_threads = self.settings.TORCH_NUM_THREADS
+        if self.settings.TORCH_NUM_INTEROP_THREADS > 0:
+            opts.inter_op_num_threads = self.settings.TORCH_NUM_INTEROP_THREADS
+        self.session = ort.InferenceSession(str(path), opts, providers=["CPUExecutionProvider"])
+        self._onnx_input = self.session.get_inputs()[0].name
+        logger.info(f"ONNX Runtime session loaded from {path.name}.")
+
+    def export_onnx(self):
+        """
+        Exports the visual tower of ONNX_SOURCE_BACKEND to ARTIFACTS_DIR/onnx, optionally
+        with a dynamically quantized int8 copy. Each file is kept only if its embeddings
+        match PyTorch (cosine >= ONNX_PARITY_MIN_COSINE).
+        """
+        import onnxruntime as ort
+
+        source = self.settings.ONNX_SOURCE_BACKEND.lower()
+        fp32_path, int8_path = self.onnx_paths()
+        fp32_path.parent.mkdir(parents=True, exist_ok=True)
+
+        logger.info(f"Exporting {source} - {self.settings.MODEL_NAME} to ONNX (one-time)...")
+        tower = _VisualTower(self._load_torch_model(source), source).cpu().eval()
+        size = self.settings.IMAGE_SIZE
+        dummy = torch.randn(1, 3, size, size)
+        torch.onnx.export(
+            tower, dummy, str(fp32_path),
+            input_names=["images"], output_names=["features"],
+            dynamic_axes={"images": {0: "batch"}, "features": {0: "batch"}},
+            opset_version=self.settings.ONNX_OPSET,
+            dynamo=False,
+        )
+
+        # Parity check on a fixed batch
+        generator = torch.Generator().manual_seed(0)
+        probe = torch.randn(4, 3, size, size, generator=generator)
+        with torch.no_grad():
+            reference = F.normalize(tower(probe), p=2, dim=1)
+
+        def _min_cosine(path):
+            sess = ort.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+            out = torch.from_numpy(sess.run(None, {"images": probe.numpy()})[0])
+            return float((F.normalize(out, p=2, dim=1) * reference).sum(dim=1).min())
+
+        report = {"fp32_min_cosine": _min_cosine(fp32_path)}
+        min_cos = self.settings.ONNX_PARITY_MIN_COSINE
+        if report["fp32_min_cosine"] < min_cos:
+            fp32_path.unlink()
+            raise RuntimeError(f"ONNX export parity check failed: cosine {report['fp32_min_cosine']:.5f} < {min_cos}")
+
+        if self.settings.ONNX_QUANTIZE:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(str(fp32_path), str(int8_path), weight_type=QuantType.QInt8)
+            report["int8_min_cosine"] = _min_cosine(int8_path)
+            if report["int8_min_cosine"] < min_cos:
+                logger.warning(f"int8 parity check failed (cosine {report['int8_min_cosine']:.5f} < {min_cos}); discarding it.")
+                int8_path.unlink()
+
+        with open(fp32_path.with_suffix(".parity.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"ONNX export done. Parity: {report}")
+
+        # The torch weights are not needed for ONNX serving
+        del tower
+
     def encode(self, images_tensor):
         """
         Encodes a batch of images.
         images_tensor: Tensor of shape (B, C, H, W)
         Returns: Normalized embeddings (B, D)
         """
+        if self.session is not None:
+            inputs = images_tensor.detach().cpu().float().contiguous().numpy()
+            features = torch.from_numpy(self.session.run(None, {self._onnx_input: inputs})[0])
+            return F.normalize(features, p=2, dim=1)
+
         # Ensure input is on device
         images_tensor = images_tensor.to(self.device)
-        
-        with torch.no_grad():
-            if self.settings.MODEL_BACKEND == "open_clip":
-                features = self.model.encode_image(images_tensor)
-            else:
-                features = self.model(images_tensor)
-                
-            # L2 Normalize
-            features = F.normalize(features, p=2, dim=1)
-            
+        if self.settings.CHANNELS_LAST:
+            images_tensor = images_tensor.contiguous(memory_format=torch.channels_last)
+
+        with self._grad_context(), self._autocast():
+            features = self._forward(images_tensor)
+
+        # L2 Normalize (in fp32, also when the forward ran in bf16)
+        features = F.normalize(features.float(), p=2, dim=1)
+
         return features.cpu()
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 # File: food2recipe/preprocessing/image_preprocess.py
-from PIL import Image
+import numpy as np
+import torch
+from PIL import Image, ImageOps
 from torchvision import transforms
 from food2recipe.core.settings import load_settings
 
@@ -7,11 +9,53 @@ from food2recipe.core.settings import load_settings
 MEAN = (0.48145466, 0.4578275, 0.40821073)
 STD = (0.26862954, 0.26130258, 0.27577711)
 
-def get_transforms(mode="inference", image_size=224):
+# uint8 -> normalized float in one fused multiply-add: x * SCALE + SHIFT
+_SCALE = torch.tensor([1.0 / (255.0 * s) for s in STD]).view(1, 3, 1, 1)
+_SHIFT = torch.tensor([-m / s for m, s in zip(MEAN, STD)]).view(1, 3, 1, 1)
+
+PREPROCESS_MODES = ("standard", "fast")
+
+
+class FastTransform:
+    """
+    Resize (short side, bicubic) + center crop on the uint8 image, returned as a
+    uint8 (3, S, S) tensor. Normalization is left to normalize_batch, which does
+    it once for the whole stacked batch.
+
+    load_and_transform_image recognises this transform and decodes JPEGs in
+    draft mode (DCT scaling to the smallest size >= image_size) and applies the
+    EXIF orientation first.
+    """
+
+    def __init__(self, image_size=224):
+        self.image_size = image_size
+
+    def __call__(self, image):
+        size = self.image_size
+        w, h = image.size
+        # Same output geometry as transforms.Resize(size) + CenterCrop(size)
+        if w <= h:
+            new_w, new_h = size, int(size * h / w)
+        else:
+            new_w, new_h = int(size * w / h), size
+        # reducing_gap: box-reduce by an integer factor first, then bicubic for the rest
+        image = image.resize((new_w, new_h), Image.BICUBIC, reducing_gap=3.0)
+        left, top = int(round((new_w - size) / 2.0)), int(round((new_h - size) / 2.0))
+        image = image.crop((left, top, left + size, top + size))
+        return torch.from_numpy(np.asarray(image, dtype=np.uint8).copy()).permute(2, 0, 1)
+
+
+def get_transforms(mode="inference", image_size=224, preprocess_mode="standard"):
     """
     Returns image transforms.
     Use OpenAI CLIP mean/std for best results if using CLIP.
+    preprocess_mode="fast" returns a FastTransform (uint8 output, see normalize_batch).
     """
+    if preprocess_mode == "fast":
+        return FastTransform(image_size)
+    if preprocess_mode != "standard":
+        raise ValueError(f"Unknown PREPROCESS_MODE: {preprocess_mode}")
+
     if mode == "train":
         # For building index/training, we might want simple resize or some augmentation
         # But for retrieval index, usually we use deterministic resize too unless doing data aug for robustness
@@ -31,12 +75,65 @@ def get_transforms(mode="inference", image_size=224):
             transforms.Normalize(MEAN, STD)
         ])
 
-def load_and_transform_image(image_path_or_file, transform):
+
+def get_uint8_transform(image_size=224, preprocess_mode="standard"):
+    """
+    Resize + center crop only, with uint8 (3, S, S) output. normalize_batch turns a
+    stacked batch of these into exactly what get_transforms(...) would have produced.
+    """
+    if preprocess_mode == "fast":
+        return FastTransform(image_size)
+    if preprocess_mode != "standard":
+        raise ValueError(f"Unknown PREPROCESS_MODE: {preprocess_mode}")
+    return transforms.Compose([
+        transforms.Resize(image_size, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(image_size),
+        transforms.PILToTensor(),
+    ])
+
+
+def normalize_batch(images):
+    """
+    Stacked transform output -> model input.
+    uint8 batches (FastTransform) are normalized here; float batches pass through.
+    """
+    if images.dtype != torch.uint8:
+        return images
+    return images.float().mul_(_SCALE).add_(_SHIFT)
+
+
+def open_image(image_path_or_file, max_pixels=0, draft_size=0, exif=False):
+    """
+    Opens an image as RGB.
+    max_pixels > 0 rejects larger images from the header, before any pixel is decoded.
+    draft_size > 0 lets the JPEG decoder downscale (1/2, 1/4, 1/8) while keeping the
+    short side >= draft_size.
+    exif=True applies the EXIF orientation tag.
+    """
+    image = Image.open(image_path_or_file)
+    w, h = image.size
+    if max_pixels > 0 and w * h > max_pixels:
+        raise ValueError(f"Image too large: {w}x{h} exceeds {max_pixels} pixels")
+
+    if draft_size > 0 and image.format == "JPEG":
+        scale = draft_size / min(w, h)
+        if scale < 1:
+            image.draft("RGB", (int(np.ceil(w * scale)), int(np.ceil(h * scale))))
+
+    if exif:
+        image = ImageOps.exif_transpose(image)
+    return image.convert("RGB")
+
+
+def load_and_transform_image(image_path_or_file, transform, max_pixels=0):
     """
     Loads an image (path or file-like) and applies transform.
     """
     try:
-        image = Image.open(image_path_or_file).convert("RGB")
+        if isinstance(transform, FastTransform):
+            image = open_image(image_path_or_file, max_pixels, draft_size=transform.image_size, exif=True)
+        else:
+            image = open_image(image_path_or_file, max_pixels)
         return transform(image)
     except Exception as e:
         # Handle partially corrupted images or read errors
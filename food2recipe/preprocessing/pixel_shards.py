@@ -0,0 +1,156 @@
+# File: food2recipe/preprocessing/pixel_shards.py
+import os
+import numpy as np
+import pandas as pd
+import torch
+from pathlib import Path
+from typing import Dict, List, Optional
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("pixel_shards")
+
+# On-disk layout (ARTIFACTS_DIR/pixel_shards/<IMAGE_SIZE>-<PREPROCESS_MODE>/):
+#   <split>-00000.npy   (n, 3, S, S) uint8 crops, opened with mmap_mode="r"
+#   rows.csv            image_path, split, shard, offset, size, mtime_ns
+# The crop only depends on image size and preprocessing mode, so the same shards
+# serve every MODEL_NAME / PRETRAINED_DATASET.
+ROWS_FILE = "rows.csv"
+
+
+class PixelShardStore:
+    """
+    Preprocessed uint8 center crops, so re-encoding with another model costs
+    only forward passes. Rows whose source file changed (size / mtime) are
+    treated as missing.
+    """
+
+    def __init__(self, settings):
+        self.image_size = settings.IMAGE_SIZE
+        self.shard_size = max(1, settings.PIXEL_SHARD_SIZE)
+        self.folder = Path(settings.ARTIFACTS_DIR) / "pixel_shards" / f"{settings.IMAGE_SIZE}-{settings.PREPROCESS_MODE}"
+        self.rows = {}  # image_path -> (shard, offset, size, mtime_ns)
+        self._shards = {}  # shard file name -> memmap, opened lazily
+
+    def __getstate__(self):
+        # Memmaps are reopened in each DataLoader worker
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def exists(self) -> bool:
+        return (self.folder / ROWS_FILE).exists()
+
+    def load(self) -> "PixelShardStore":
+        self.rows = {}
+        self._shards = {}
+        if self.exists():
+            df = pd.read_csv(self.folder / ROWS_FILE)
+            self.rows = {
+                r.image_path: (r.shard, int(r.offset), int(r.size), int(r.mtime_ns))
+                for r in df.itertuples(index=False)
+            }
+            logger.info(f"Pixel shards: {len(self.rows)} images in {self.folder}")
+        return self
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def lookup(self, path) -> Optional[tuple]:
+        """(shard, offset) of a fresh row, or None."""
+        row = self.rows.get(str(path))
+        if row is None:
+            return None
+        try:
+            if self._stat(path) != row[2:]:
+                return None
+        except OSError:
+            return None
+        return row[:2]
+
+    def _shard(self, name):
+        if name not in self._shards:
+            self._shards[name] = np.load(self.folder / name, mmap_mode="r")
+        return self._shards[name]
+
+    def get(self, path) -> Optional[torch.Tensor]:
+        """uint8 (3, S, S) crop of path, or None if it is not (or no longer) stored."""
+        loc = self.lookup(path)
+        if loc is None:
+            return None
+        return torch.from_numpy(np.array(self._shard(loc[0])[loc[1]]))
+
+    def iter_batches(self, paths: List[str], batch_size: int):
+        """
+        Yields (uint8 images (B, 3, S, S), paths) for the stored paths, in input order.
+        Missing or stale paths are skipped.
+        """
+        hits = [(p, self.lookup(p)) for p in paths]
+        hits = [(p, loc) for p, loc in hits if loc is not None]
+        for start in range(0, len(hits), batch_size):
+            chunk = hits[start:start + batch_size]
+            images = np.stack([self._shard(shard)[offset] for _, (shard, offset) in chunk])
+            yield torch.from_numpy(images), [p for p, _ in chunk]
+
+    def write(self, records: List[Dict], encode_fn):
+        """
+        Stores crops for records ({"image_path", "split"}) not already fresh in the store.
+        encode_fn(paths) yields (uint8 images, paths) batches and may drop unreadable files.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        todo = [r for r in records if self.lookup(r["image_path"]) is None]
+        logger.info(f"Pixel shards: {len(records) - len(todo)} up to date, {len(todo)} to write.")
+
+        by_split = {}
+        for r in todo:
+            by_split.setdefault(r["split"], []).append(str(r["image_path"]))
+
+        used = {row[0] for row in self.rows.values()}
+        for split, paths in sorted(by_split.items()):
+            shard_no = 0
+            for start in range(0, len(paths), self.shard_size):
+                chunk = paths[start:start + self.shard_size]
+                while f"{split}-{shard_no:05d}.npy" in used:
+                    shard_no += 1
+                name = f"{split}-{shard_no:05d}.npy"
+                used.add(name)
+                self._write_shard(name, chunk, encode_fn)
+
+        self._prune()
+        self._save_rows()
+
+    def _write_shard(self, name, paths, encode_fn):
+        size = self.image_size
+        position = {p: i for i, p in enumerate(paths)}
+        stats = {p: self._stat(p) for p in paths}
+        shard = np.lib.format.open_memmap(
+            self.folder / name, mode="w+", dtype=np.uint8, shape=(len(paths), 3, size, size)
+        )
+        written = 0
+        for images, batch_paths in encode_fn(paths):
+            for img, p in zip(images.numpy(), batch_paths):
+                shard[position[p]] = img
+                self.rows[p] = (name, position[p], *stats[p])
+                written += 1
+        shard.flush()
+        del shard
+        self._shards.pop(name, None)
+        logger.info(f"Wrote {written}/{len(paths)} crops to {name}")
+
+    def _prune(self):
+        """Deletes shard files no row points to any more (all their images were rewritten)."""
+        used = {row[0] for row in self.rows.values()}
+        for f in self.folder.glob("*.npy"):
+            if f.name not in used:
+                f.unlink()
+
+    def _save_rows(self):
+        df = pd.DataFrame(
+            [(p, *row) for p, row in self.rows.items()],
+            columns=["image_path", "shard", "offset", "size", "mtime_ns"],
+        )
+        df.insert(1, "split", df["shard"].str.rsplit("-", n=1).str[0])
+        tmp = self.folder / (ROWS_FILE + ".tmp")
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, self.folder / ROWS_FILE)
@@ -1,7 +1,6 @@
 # File: food2recipe/preprocessing/text_preprocess.py
 import re
 import unicodedata
-import pandas as pd
 from typing import Dict, Optional, Any
 
 from food2recipe.core.settings import load_settings
@@ -68,6 +67,8 @@ class RecipeProcessor:
         """
         Loads CSV, validates columns, cleans text, and builds lookup map.
         """
+        import pandas as pd
+
         csv_path = self.settings.RECIPES_CSV
 
         if not csv_path.exists():
@@ -153,6 +154,11 @@ class RecipeProcessor:
         sample_keys = list(self.recipes_data.keys())[:5]
         logger.info(f"Sample recipe keys: {sample_keys}")
 
+    def load_records(self, recipes_data: Dict[str, Any]):
+        """Uses recipe records already processed by load_and_process (e.g. from a serving bundle)."""
+        self.recipes_data = dict(recipes_data)
+        logger.info(f"Loaded {len(self.recipes_data)} processed recipes.")
+
     def _clean_text(self, text: str) -> str:
         """
         Basic text cleaning.
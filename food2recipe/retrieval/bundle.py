@@ -0,0 +1,254 @@
+# File: food2recipe/retrieval/bundle.py
+import os
+import json
+import time
+import struct
+import numpy as np
+from pathlib import Path
+from typing import Any, Dict, Optional
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.models.embedding_store import ColumnarMetadata
+from food2recipe.retrieval.centroids import ClassCentroids
+from food2recipe.retrieval.related_graph import RelatedGraph
+from food2recipe.retrieval.linear_probe import LinearProbe
+from food2recipe.retrieval.reduction import PCAReducer
+
+logger = setup_logger("bundle")
+
+# Single-file serving bundle:
+#   [0:8)    magic b"F2RBNDL1"
+#   [8:16)   TOC offset, little-endian uint64
+#   [16:24)  TOC length
+#   sections, each starting on a 64-byte boundary: raw C-order array bytes or utf-8 JSON
+#   TOC      utf-8 JSON {"format_version", "header", "sections": {name: {offset, nbytes, dtype, shape}}}
+# The whole file is opened with one read-only memmap; array sections are
+# zero-copy views of it, so replicas share the page cache and nothing is parsed
+# besides the TOC and the JSON sections.
+MAGIC = b"F2RBNDL1"
+BUNDLE_FILE = "bundle.f2r"
+FORMAT_VERSION = 1
+ALIGN = 64
+_PREAMBLE = struct.Struct("<8sQQ")
+
+
+class BundleWriter:
+    """Writes sections one after another, then the TOC; the file appears atomically on close()."""
+
+    def __init__(self, path: Path, block_rows: int = 65536):
+        self.path = Path(path)
+        self.block_rows = block_rows
+        self.sections = {}
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        self._f = open(self._tmp, "wb")
+        self._f.write(_PREAMBLE.pack(MAGIC, 0, 0))
+
+    def _align(self):
+        pad = -self._f.tell() % ALIGN
+        if pad:
+            self._f.write(b"\0" * pad)
+        return self._f.tell()
+
+    def add_array(self, name: str, array):
+        """array may be memory-mapped; it is copied in row blocks."""
+        array = np.asarray(array)
+        offset = self._align()
+        if array.ndim == 0:
+            self._f.write(array.tobytes())
+        for start in range(0, len(array) if array.ndim else 0, self.block_rows):
+            self._f.write(np.ascontiguousarray(array[start:start + self.block_rows]).tobytes())
+        self.sections[name] = {"offset": offset, "nbytes": self._f.tell() - offset,
+                               "dtype": array.dtype.str, "shape": list(array.shape)}
+
+    def add_json(self, name: str, obj: Any):
+        offset = self._align()
+        self._f.write(json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+        self.sections[name] = {"offset": offset, "nbytes": self._f.tell() - offset, "dtype": "json", "shape": []}
+
+    def close(self, header: Dict):
+        toc = json.dumps({"format_version": FORMAT_VERSION, "header": header, "sections": self.sections},
+                         ensure_ascii=False).encode("utf-8")
+        toc_offset = self._align()
+        self._f.write(toc)
+        self._f.seek(0)
+        self._f.write(_PREAMBLE.pack(MAGIC, toc_offset, len(toc)))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._f.close()
+        self._tmp.unlink(missing_ok=True)
+
+
+def read_toc(path: Path) -> Dict:
+    """TOC only (a couple of small reads), e.g. to check the build id without mapping the file."""
+    with open(path, "rb") as f:
+        magic, offset, length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a serving bundle")
+        f.seek(offset)
+        return json.loads(f.read(length).decode("utf-8"))
+
+
+class Bundle:
+    """Read side of a serving bundle."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        toc = read_toc(self.path)
+        if toc["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported bundle format {toc['format_version']}")
+        self.header = toc["header"]
+        self.sections = toc["sections"]
+        self._buf = np.memmap(self.path, dtype=np.uint8, mode="r")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sections
+
+    def array(self, name: str) -> np.ndarray:
+        s = self.sections[name]
+        raw = self._buf[s["offset"]:s["offset"] + s["nbytes"]]
+        return raw.view(np.dtype(s["dtype"])).reshape(s["shape"])
+
+    def json(self, name: str) -> Any:
+        s = self.sections[name]
+        return json.loads(self._buf[s["offset"]:s["offset"] + s["nbytes"]].tobytes().decode("utf-8"))
+
+    def get_array(self, name: str) -> Optional[np.ndarray]:
+        return self.array(name) if name in self else None
+
+    # -------------------- Artifacts --------------------
+    @property
+    def build_id(self) -> str:
+        return self.header.get("build_id", "")
+
+    def metadata(self) -> ColumnarMetadata:
+        tables = self.json("metadata_tables")
+        return ColumnarMetadata(
+            label_ids=self.array("label_ids"),
+            class_names=tables["class_names"],
+            split_ids=self.array("split_ids"),
+            split_names=tables["split_names"],
+            path_offsets=self.array("path_offsets"),
+            path_blob=self.array("path_blob"),
+        )
+
+    def centroids(self) -> Optional[ClassCentroids]:
+        meta = self.header.get("centroids")
+        if meta is None:
+            return None
+        return ClassCentroids(self.array("centroids"), meta["class_names"], self.build_id,
+                              counts=self.array("centroid_counts"), prototypes=self.get_array("prototypes"),
+                              prototype_labels=self.get_array("prototype_labels"))
+
+    def related_graph(self) -> Optional[RelatedGraph]:
+        if "related_tables" not in self:
+            return None
+        tables = self.json("related_tables")
+        return RelatedGraph(tables["names"], self.array("related_neighbors"), self.array("related_scores"),
+                            self.array("related_group_ids"), tables["group_names"],
+                            self.array("related_group_offsets"), self.array("related_group_members"),
+                            build_id=self.build_id)
+
+    def linear_probe(self) -> Optional[LinearProbe]:
+        meta = self.header.get("linear_probe")
+        if meta is None:
+            return None
+        return LinearProbe(self.array("probe_weights"), self.array("probe_bias"), meta["class_names"],
+                           self.build_id, meta["temperature"])
+
+    def reducer(self) -> Optional[PCAReducer]:
+        meta = self.header.get("pca")
+        if meta is None:
+            return None
+        return PCAReducer(self.array("pca_mean"), self.array("pca_components"), self.array("pca_scale"),
+                          self.array("pca_variance_ratio"), meta["whiten"], self.build_id)
+
+    def recipes(self) -> Optional[Dict[str, Dict]]:
+        """Processed recipe records keyed by food_key, as RecipeProcessor builds them from the CSV."""
+        return self.json("recipes") if "recipes" in self else None
+
+
+def _is_flat_faiss(index) -> bool:
+    import faiss
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+
+def write_bundle(path: Path, index, centroids=None, graph=None, linear_probe=None, reducer=None,
+                 recipes: Optional[Dict] = None) -> Dict:
+    """
+    Packs one index build and everything served with it into a single file.
+    index: a loaded RetrievalIndex with its stored vectors. Flat FAISS indexes
+    are not copied (exact inner product is served by NumPy straight off the
+    bundle's vectors); other FAISS indexes are stored serialized.
+    Returns the bundle header.
+    """
+    if index.embeddings is None:
+        raise ValueError("The index has no stored vectors to bundle")
+    build_id = index.build_id
+    for name, artifact in (("centroids", centroids), ("related graph", graph),
+                           ("linear probe", linear_probe), ("PCA reducer", reducer)):
+        if artifact is not None and artifact.build_id != build_id:
+            raise ValueError(f"The {name} is from build {artifact.build_id}, index is {build_id}")
+
+    header = {
+        "build_id": build_id,
+        "model": index.header.get("model", ""),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "index": index.header,
+    }
+    writer = BundleWriter(path)
+    try:
+        writer.add_array("embeddings", index.embeddings)
+        meta = index.metadata
+        for column in ("label_ids", "split_ids", "path_offsets", "path_blob"):
+            writer.add_array(column, np.asarray(getattr(meta, column)))
+        writer.add_json("metadata_tables", {"class_names": meta.class_names, "split_names": meta.split_names})
+
+        if index.is_faiss and not _is_flat_faiss(index.index):
+            import faiss
+            writer.add_array("faiss_index", faiss.serialize_index(index.index))
+        elif not index.is_faiss and index.index.dtype != "float32":
+            writer.add_array(f"numpy_index_{index.index.dtype}", index.index.matrix)
+            if index.index.scales is not None:
+                writer.add_array("numpy_index_scales", index.index.scales)
+
+        if centroids is not None:
+            header["centroids"] = {"class_names": centroids.class_names}
+            writer.add_array("centroids", np.asarray(centroids.matrix, dtype=np.float32))
+            writer.add_array("centroid_counts", np.asarray(centroids.counts, dtype=np.int64))
+            if centroids.prototypes is not None:
+                writer.add_array("prototypes", centroids.prototypes)
+                writer.add_array("prototype_labels", centroids.prototype_labels)
+
+        if graph is not None:
+            writer.add_json("related_tables", {"names": graph.names, "group_names": graph.group_names})
+            writer.add_array("related_neighbors", graph.neighbors)
+            writer.add_array("related_scores", graph.neighbor_scores)
+            writer.add_array("related_group_ids", graph.group_ids)
+            writer.add_array("related_group_offsets", graph.group_offsets)
+            writer.add_array("related_group_members", graph.group_members)
+
+        if linear_probe is not None:
+            header["linear_probe"] = {"class_names": linear_probe.class_names,
+                                      "temperature": float(linear_probe.temperature)}
+            writer.add_array("probe_weights", linear_probe.weights)
+            writer.add_array("probe_bias", linear_probe.bias)
+
+        if reducer is not None:
+            header["pca"] = {"whiten": bool(reducer.whiten)}
+            writer.add_array("pca_mean", reducer.mean)
+            writer.add_array("pca_components", reducer.components)
+            writer.add_array("pca_scale", reducer.scale)
+            writer.add_array("pca_variance_ratio", reducer.variance_ratio)
+
+        if recipes is not None:
+            writer.add_json("recipes", recipes)
+        writer.close(header)
+    except BaseException:
+        writer.abort()
+        raise
+    logger.info(f"Wrote serving bundle {path} ({Path(path).stat().st_size / 1e6:.1f} MB, "
+                f"{len(writer.sections)} sections, build {build_id})")
+    return header
@@ -0,0 +1,157 @@
+# File: food2recipe/retrieval/centroids.py
+import json
+import numpy as np
+from pathlib import Path
+from typing import Optional
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("centroids")
+
+# Stored next to the index it was computed from:
+#   centroids.npy             (C, D) float32, L2-normalized class means, row = label id
+#   centroids.json            build_id, class_names, dim, counts, num_prototypes
+#   prototypes.npy            (P, D) float32, optional k-means prototypes
+#   prototype_labels.npy      (P,) int32 label id of each prototype
+CENTROIDS_FILE = "centroids.npy"
+CENTROIDS_META = "centroids.json"
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.where(norms > 1e-6, matrix / np.maximum(norms, 1e-12), matrix).astype(np.float32)
+
+
+def class_sums(embeddings: np.ndarray, label_ids: np.ndarray, num_classes: int, block_size: int = 65536):
+    """
+    Per-class vector sums and counts as segment sums, block by block so a
+    memory-mapped matrix is never loaded whole.
+    Returns (sums (C, D) float64, counts (C,) int64).
+    """
+    sums = np.zeros((num_classes, embeddings.shape[1]), dtype=np.float64)
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        np.add.at(sums, np.asarray(label_ids[start:start + block_size]), block)
+    counts = np.bincount(np.asarray(label_ids), minlength=num_classes).astype(np.int64)
+    return sums, counts
+
+
+def compute_centroids(embeddings: np.ndarray, label_ids: np.ndarray, num_classes: int, block_size: int = 65536):
+    """L2-normalized class means (C, D) and per-class counts. Empty classes get a zero row."""
+    sums, counts = class_sums(embeddings, label_ids, num_classes, block_size)
+    means = sums / np.maximum(counts, 1)[:, None]
+    return _normalize_rows(means), counts
+
+
+def compute_prototypes(embeddings: np.ndarray, label_ids: np.ndarray, num_classes: int, k: int,
+                       iters: int = 10, seed: int = 0):
+    """
+    Up to k prototypes per class from spherical k-means within the class
+    (classes with fewer than k images get one prototype per image).
+    Returns (prototypes (P, D) float32, prototype_labels (P,) int32).
+    """
+    label_ids = np.asarray(label_ids)
+    order = np.argsort(label_ids, kind="stable")
+    bounds = np.searchsorted(label_ids[order], np.arange(num_classes + 1))
+    rng = np.random.default_rng(seed)
+
+    prototypes, proto_labels = [], []
+    for c in range(num_classes):
+        rows = order[bounds[c]:bounds[c + 1]]
+        if len(rows) == 0:
+            continue
+        vecs = np.asarray(embeddings[np.sort(rows)], dtype=np.float32)
+        kc = min(k, len(vecs))
+        centers = vecs[rng.choice(len(vecs), kc, replace=False)]
+        for _ in range(iters):
+            assign = np.argmax(vecs @ centers.T, axis=1)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, assign, vecs)
+            # Empty clusters keep their previous center
+            filled = np.bincount(assign, minlength=kc) > 0
+            centers[filled] = _normalize_rows(sums[filled])
+        prototypes.append(centers)
+        proto_labels.append(np.full(kc, c, dtype=np.int32))
+
+    if not prototypes:
+        return np.zeros((0, embeddings.shape[1]), dtype=np.float32), np.zeros(0, dtype=np.int32)
+    return np.vstack(prototypes).astype(np.float32), np.concatenate(proto_labels)
+
+
+class ClassCentroids:
+    """Centroid artifact of one index build."""
+
+    def __init__(self, matrix, class_names, build_id="", counts=None, prototypes=None, prototype_labels=None):
+        self.matrix = matrix
+        self.class_names = list(class_names)
+        self.build_id = build_id
+        self.counts = counts if counts is not None else np.zeros(len(self.class_names), dtype=np.int64)
+        self.prototypes = prototypes
+        self.prototype_labels = prototype_labels
+
+    @property
+    def nbytes(self) -> int:
+        size = np.asarray(self.matrix).nbytes
+        if self.prototypes is not None:
+            size += np.asarray(self.prototypes).nbytes
+        return int(size)
+
+    @classmethod
+    def from_embeddings(cls, embeddings, label_ids, class_names, build_id="", num_prototypes=0,
+                        block_size=65536) -> "ClassCentroids":
+        matrix, counts = compute_centroids(embeddings, label_ids, len(class_names), block_size)
+        prototypes = prototype_labels = None
+        if num_prototypes > 1:
+            prototypes, prototype_labels = compute_prototypes(embeddings, label_ids, len(class_names), num_prototypes)
+        return cls(matrix, class_names, build_id, counts, prototypes, prototype_labels)
+
+    def as_dict(self):
+        """{food_name: centroid}, the format of the old class_centroids.npy."""
+        return {name: self.matrix[i] for i, name in enumerate(self.class_names) if self.counts[i] > 0}
+
+    def save(self, folder: Path):
+        folder = Path(folder)
+        np.save(folder / CENTROIDS_FILE, np.asarray(self.matrix, dtype=np.float32))
+        if self.prototypes is not None:
+            np.save(folder / "prototypes.npy", self.prototypes)
+            np.save(folder / "prototype_labels.npy", self.prototype_labels)
+        else:
+            for name in ("prototypes.npy", "prototype_labels.npy"):
+                (folder / name).unlink(missing_ok=True)
+
+        meta = {
+            "build_id": self.build_id,
+            "class_names": self.class_names,
+            "dim": int(self.matrix.shape[1]),
+            "counts": [int(c) for c in self.counts],
+            "num_prototypes": 0 if self.prototypes is None else int(len(self.prototypes)),
+        }
+        with open(folder / CENTROIDS_META, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        logger.info(f"Saved centroids for {len(self.class_names)} classes ({meta['num_prototypes']} prototypes) to {folder}")
+
+    @classmethod
+    def load(cls, folder: Path, build_id: Optional[str] = None) -> "ClassCentroids":
+        """
+        Raises FileNotFoundError if absent, ValueError if build_id is given and
+        the centroids were computed from another index build (stale).
+        """
+        folder = Path(folder)
+        if not (folder / CENTROIDS_META).exists():
+            raise FileNotFoundError(f"No centroids at {folder}")
+        with open(folder / CENTROIDS_META, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if build_id and meta["build_id"] != build_id:
+            raise ValueError(f"Centroids are from build {meta['build_id']}, index is {build_id}")
+
+        prototypes = prototype_labels = None
+        if meta.get("num_prototypes"):
+            prototypes = np.load(folder / "prototypes.npy", mmap_mode="r")
+            prototype_labels = np.load(folder / "prototype_labels.npy")
+        return cls(
+            matrix=np.load(folder / CENTROIDS_FILE, mmap_mode="r"),
+            class_names=meta["class_names"],
+            build_id=meta["build_id"],
+            counts=np.asarray(meta["counts"], dtype=np.int64),
+            prototypes=prototypes,
+            prototype_labels=prototype_labels,
+        )
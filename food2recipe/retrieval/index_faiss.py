@@ -4,90 +4,381 @@ import pickle
 from pathlib import Path
 from food2recipe.core.settings import load_settings
 from food2recipe.core.logging_utils import setup_logger
+from food2recipe.models.embedding_store import ColumnarMetadata, save_store, load_store, HEADER_FILE
 
 logger = setup_logger("index_faiss")
 
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "opq_pq")
+
+
+def faiss_factory_string(index_type: str, n: int, d: int, settings) -> str:
+    """
+    Maps INDEX_TYPE to a faiss.index_factory description.
+    nlist defaults to ~4*sqrt(N), capped so every list gets enough training points.
+    """
+    index_type = index_type.lower()
+    nlist = settings.IVF_NLIST or max(1, min(int(4 * np.sqrt(n)), n // 39))
+    m, nbits = settings.PQ_M, settings.PQ_NBITS
+
+    if index_type in ("ivf_pq", "opq_pq") and d % m != 0:
+        raise ValueError(f"PQ_M={m} must divide the embedding dim {d}")
+
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{nlist},PQ{m}x{nbits}"
+    if index_type == "hnsw":
+        return f"HNSW{settings.HNSW_M},Flat"
+    if index_type == "opq_pq":
+        return f"OPQ{m},PQ{m}x{nbits}"
+    raise ValueError(f"Unknown INDEX_TYPE: {index_type}. Expected one of {INDEX_TYPES}")
+
+class NumpyIndex:
+    """
+    Brute-force inner-product search without FAISS.
+
+    - Top-k via argpartition (O(N) per query) instead of a full argsort.
+    - Many queries at once, scored in row blocks so the (B, block) score
+      matrix stays small however large N gets.
+    - Optional float16 / int8 storage (int8 with one scale per vector) to cut
+      the resident matrix 2x / 4x. Each block is upcast to float32 for the
+      matmul, so this trades some compute for memory.
+    """
+
+    DTYPES = ("float32", "float16", "int8")
+
+    def __init__(self, matrix: np.ndarray, scales: np.ndarray = None, block_size: int = 65536):
+        self.matrix = matrix
+        self.scales = scales
+        self.block_size = max(1, block_size)
+
+    @classmethod
+    def from_embeddings(cls, embeddings: np.ndarray, dtype: str = "float32", block_size: int = 65536):
+        dtype = dtype.lower()
+        if dtype not in cls.DTYPES:
+            raise ValueError(f"Unknown NUMPY_INDEX_DTYPE: {dtype}. Expected one of {cls.DTYPES}")
+        if dtype == "int8":
+            matrix, scales = cls._quantize_int8(embeddings, block_size)
+            return cls(matrix, scales, block_size)
+        if embeddings.dtype != np.dtype(dtype):
+            embeddings = np.asarray(embeddings, dtype=dtype)
+        return cls(embeddings, None, block_size)
+
+    @staticmethod
+    def _quantize_int8(embeddings: np.ndarray, block_size: int):
+        """Symmetric per-vector quantization: x ~= codes * scale, codes in [-127, 127]."""
+        n = len(embeddings)
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        scales = np.empty(n, dtype=np.float32)
+        for start in range(0, n, block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+            block_scales = np.abs(block).max(axis=1) / 127.0
+            block_scales[block_scales == 0] = 1.0
+            codes[start:start + block_size] = np.rint(block / block_scales[:, None])
+            scales[start:start + block_size] = block_scales
+        return codes, scales
+
+    @property
+    def dtype(self) -> str:
+        return self.matrix.dtype.name
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.matrix)
+
+    def search(self, queries: np.ndarray, k: int):
+        """
+        queries: (B, D) float32
+        Returns: distances (B, k), indices (B, k), best first
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        B = len(queries)
+        k = min(k, self.ntotal)
+        best_scores = np.full((B, 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((B, 0), dtype=np.int64)
+
+        for start in range(0, self.ntotal, self.block_size):
+            block = np.asarray(self.matrix[start:start + self.block_size], dtype=np.float32)
+            scores = queries @ block.T  # (B, block)
+            if self.scales is not None:
+                scores *= self.scales[start:start + len(block)]
+
+            # Top-k of this block, then merge with the running top-k
+            kb = min(k, scores.shape[1])
+            part = np.argpartition(-scores, kb - 1, axis=1)[:, :kb]
+            cand_scores = np.concatenate([best_scores, np.take_along_axis(scores, part, axis=1)], axis=1)
+            cand_ids = np.concatenate([best_ids, part + start], axis=1)
+
+            if cand_scores.shape[1] > k:
+                keep = np.argpartition(-cand_scores, k - 1, axis=1)[:, :k]
+                cand_scores = np.take_along_axis(cand_scores, keep, axis=1)
+                cand_ids = np.take_along_axis(cand_ids, keep, axis=1)
+            best_scores, best_ids = cand_scores, cand_ids
+
+        # Only the k survivors get sorted
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+    def save(self, folder: Path):
+        """Returns the file names written."""
+        written = [f"numpy_index_{self.dtype}.npy"]
+        np.save(folder / written[0], self.matrix)
+        if self.scales is not None:
+            written.append("numpy_index_scales.npy")
+            np.save(folder / written[1], self.scales)
+        return written
+
+    @classmethod
+    def load(cls, folder: Path, dtype: str, block_size: int = 65536):
+        """Memory-maps a quantized matrix saved by save(); None if there is none for dtype."""
+        path = folder / f"numpy_index_{dtype}.npy"
+        if not path.exists():
+            return None
+        scales = None
+        if dtype == "int8":
+            scales = np.load(folder / "numpy_index_scales.npy", mmap_mode="r")
+        return cls(np.load(path, mmap_mode="r"), scales, block_size)
+
+
 class RetrievalIndex:
     def __init__(self, settings=None):
         self.settings = settings or load_settings()
         self.index = None
-        self.metadata = []
+        self.metadata = ColumnarMetadata.from_records([])
+        self.embeddings = None # Source matrix (N, D), memory-mapped after load
+        self.header = {}
         self.is_faiss = False
+        self.label_ids = np.zeros(0, dtype=np.int32)
+        self.class_names = []
+        # Query-time knobs for approximate backends
+        self.nprobe = self.settings.NPROBE
+        self.ef_search = self.settings.EF_SEARCH
         
-    def build(self, embeddings: np.ndarray, metadata: list):
+    def build(self, embeddings: np.ndarray, metadata):
         """
         Builds the index.
         embeddings: (N, D) numpy array, normalized.
+        metadata: ColumnarMetadata or list of {"image_path", "food_name", "split"} dicts.
         """
         d = embeddings.shape[1]
-        self.metadata = metadata
+        self._set_metadata(metadata)
+        self.embeddings = embeddings
+        self.header = {}
         
         if self.settings.USE_FAISS:
             try:
                 import faiss
-                # Inner Product (Cosine sim if normalized)
-                self.index = faiss.IndexFlatIP(d)
-                self.index.add(embeddings)
+                # Vectors are added block by block, so memory-mapped input is never copied whole
+                self.index = self._build_faiss(faiss, embeddings)
                 self.is_faiss = True
-                logger.info(f"Built FAISS index with {len(embeddings)} vectors.")
+                self._apply_search_params()
+                logger.info(f"Built FAISS index ({self.settings.INDEX_TYPE}) with {len(embeddings)} vectors.")
             except ImportError:
                 logger.warning("FAISS not found. Fallback to Numpy.")
-                self.index = embeddings
+                self.index = self._build_numpy(embeddings)
                 self.is_faiss = False
         else:
-            self.index = embeddings
+            self.index = self._build_numpy(embeddings)
             self.is_faiss = False
-            logger.info(f"Built Numpy 'index' (brute force) with {len(embeddings)} vectors.")
+            logger.info(f"Built Numpy 'index' (brute force, {self.index.dtype}) with {len(embeddings)} vectors.")
+
+    def _build_numpy(self, embeddings: np.ndarray) -> NumpyIndex:
+        return NumpyIndex.from_embeddings(
+            embeddings, self.settings.NUMPY_INDEX_DTYPE, self.settings.NUMPY_SEARCH_BLOCK
+        )
+
+    def _build_faiss(self, faiss, embeddings: np.ndarray):
+        n, d = embeddings.shape
+        index_type = self.settings.INDEX_TYPE.lower()
+        if index_type == "flat":
+            # Inner Product (Cosine sim if normalized)
+            index = faiss.IndexFlatIP(d)
+            self._add_blocks(index, embeddings)
+            return index
+
+        description = faiss_factory_string(index_type, n, d, self.settings)
+        index = faiss.index_factory(d, description, faiss.METRIC_INNER_PRODUCT)
+        if index_type == "hnsw":
+            index.hnsw.efConstruction = self.settings.HNSW_EF_CONSTRUCTION
+
+        if not index.is_trained:
+            # Train on a fixed random sample so rebuilds are reproducible
+            sample_size = min(n, self.settings.INDEX_TRAIN_SAMPLE)
+            rng = np.random.default_rng(0)
+            sample = np.ascontiguousarray(embeddings[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+            logger.info(f"Training {description} on {sample_size} vectors...")
+            index.train(sample)
+        self._add_blocks(index, embeddings)
+        return index
+
+    def _add_blocks(self, index, embeddings: np.ndarray):
+        block = self.settings.NUMPY_SEARCH_BLOCK
+        for start in range(0, len(embeddings), block):
+            index.add(np.ascontiguousarray(embeddings[start:start + block], dtype=np.float32))
+
+    def set_search_params(self, nprobe: int = None, ef_search: int = None):
+        """Query-time knobs: nprobe (IVF*), efSearch (HNSW). Ignored by backends without them."""
+        if nprobe is not None:
+            self.nprobe = nprobe
+        if ef_search is not None:
+            self.ef_search = ef_search
+        self._apply_search_params()
+
+    def _apply_search_params(self):
+        if not self.is_faiss:
+            return
+        import faiss
+        params = faiss.ParameterSpace()
+        # ParameterSpace also reaches through OPQ / pre-transform wrappers
+        if faiss.try_extract_index_ivf(self.index) is not None:
+            params.set_index_parameter(self.index, "nprobe", self.nprobe)
+        if hasattr(faiss.downcast_index(self._base_index(faiss)), "hnsw"):
+            params.set_index_parameter(self.index, "efSearch", self.ef_search)
+
+    def _base_index(self, faiss):
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, faiss.IndexPreTransform):
+            index = faiss.downcast_index(index.index)
+        return index
 
     def search(self, query_emb: np.ndarray, k: int = 5):
         """
         query_emb: (1, D)
         Returns: distances, indices
         """
+        D, I = self.search_batch(query_emb, k)
+        return D[0], I[0] # Return 1D lists
+
+    def search_batch(self, query_embs: np.ndarray, k: int = 5):
+        """
+        Multi-query search.
+        query_embs: (B, D)
+        Returns: distances (B, k), indices (B, k)
+        """
+        if query_embs.ndim == 1:
+            query_embs = query_embs[None, :]
+
         if self.is_faiss:
-            # FAISS expects float32
-            if query_emb.dtype != np.float32:
-                query_emb = query_emb.astype(np.float32)
-            D, I = self.index.search(query_emb, k)
-            return D[0], I[0] # Return 1D lists
+            # FAISS expects float32 and C-contiguous input
+            query_embs = np.ascontiguousarray(query_embs, dtype=np.float32)
+            return self.index.search(query_embs, k)
         else:
             # Numpy Brute Force
             # Cosine similarity = dot product if normalized
-            scores = np.dot(self.index, query_emb.T).flatten() # (N,)
-            # Top-k
-            # argsort returns lowest to highest, so we take last k and reverse
-            indices = np.argsort(scores)[-k:][::-1]
-            distances = scores[indices]
-            return distances, indices
+            return self.index.search(query_embs, k)
+
+    def _set_metadata(self, metadata):
+        """
+        Stores metadata in columnar form. label_ids / class_names let vote
+        aggregation use array ops instead of per-neighbour dict lookups.
+        """
+        if not isinstance(metadata, ColumnarMetadata):
+            metadata = ColumnarMetadata.from_records(metadata)
+        self.metadata = metadata
+        self.label_ids = metadata.label_ids
+        self.class_names = metadata.class_names
+
+    @property
+    def build_id(self) -> str:
+        return self.header.get("build_id", "")
+
+    def memory_bytes(self) -> int:
+        """Size of the searchable structure (FAISS index or NumPy matrix), i.e. what kNN keeps in RAM."""
+        if self.index is None:
+            return 0
+        if self.is_faiss:
+            import faiss
+            return int(faiss.serialize_index(self.index).nbytes)
+        scales = self.index.scales.nbytes if self.index.scales is not None else 0
+        return int(self.index.matrix.nbytes + scales)
 
     def save(self, folder: Path):
         folder.mkdir(parents=True, exist_ok=True)
-        # Save metadata
-        with open(folder / "metadata.pkl", "wb") as f:
-            pickle.dump(self.metadata, f)
+        # Vectors + columnar metadata + header (memory-mappable, no pickle)
+        model = f"{self.settings.MODEL_BACKEND}/{self.settings.MODEL_NAME}/{self.settings.PRETRAINED_DATASET}"
+        self.header = save_store(folder, self.embeddings, self.metadata, model=model)
             
         # Save index
+        written = set()
         if self.is_faiss:
             import faiss
             faiss.write_index(self.index, str(folder / "faiss_index.bin"))
-        else:
-            np.save(folder / "numpy_index.npy", self.index)
+            written.add("faiss_index.bin")
+        elif self.index.dtype != "float32":
+            # float32 searches the store's embeddings.npy directly, no extra copy
+            written.update(self.index.save(folder))
+
+        # Binaries from a previous build with another backend/dtype would shadow this one on load
+        for stale in ["faiss_index.bin", *(p.name for p in folder.glob("numpy_index_*.npy"))]:
+            if stale not in written and (folder / stale).exists():
+                (folder / stale).unlink()
             
     def load(self, folder: Path):
-        if not (folder / "metadata.pkl").exists():
+        if (folder / HEADER_FILE).exists():
+            self.embeddings, metadata, self.header = load_store(folder, mmap=True)
+            self._set_metadata(metadata)
+        elif (folder / "metadata.pkl").exists():
+            # Legacy format: pickled list of dicts + numpy_index.npy
+            with open(folder / "metadata.pkl", "rb") as f:
+                self._set_metadata(pickle.load(f))
+            self.header = {}
+            legacy_npy = folder / "numpy_index.npy"
+            self.embeddings = np.load(legacy_npy, mmap_mode="r") if legacy_npy.exists() else None
+        else:
             raise FileNotFoundError(f"Index not found at {folder}")
             
-        with open(folder / "metadata.pkl", "rb") as f:
-            self.metadata = pickle.load(f)
-            
         if self.settings.USE_FAISS and (folder / "faiss_index.bin").exists():
             import faiss
-            self.index = faiss.read_index(str(folder / "faiss_index.bin"))
+            self.index = self._read_faiss(faiss, folder / "faiss_index.bin")
             self.is_faiss = True
-        elif (folder / "numpy_index.npy").exists():
-            self.index = np.load(folder / "numpy_index.npy")
+            self._apply_search_params()
+        elif self.embeddings is not None:
+            # Brute force straight off the memory-mapped matrix (or its saved quantized copy)
+            dtype = self.settings.NUMPY_INDEX_DTYPE.lower()
+            self.index = None
+            if dtype != "float32":
+                self.index = NumpyIndex.load(folder, dtype, self.settings.NUMPY_SEARCH_BLOCK)
+            if self.index is None:
+                self.index = self._build_numpy(self.embeddings)
             self.is_faiss = False
         else:
             raise FileNotFoundError("Index binary not found.")
         
         logger.info(f"Index loaded. Size: {len(self.metadata)}")
+
+    def load_bundle(self, bundle):
+        """
+        Opens the index packed in a serving bundle (retrieval.bundle.Bundle).
+        Vectors and metadata are views of the bundle's memory map; only a
+        non-flat FAISS index has to be deserialized.
+        """
+        self.embeddings = bundle.array("embeddings")
+        self._set_metadata(bundle.metadata())
+        self.header = bundle.header["index"]
+
+        dtype = self.settings.NUMPY_INDEX_DTYPE.lower()
+        if self.settings.USE_FAISS and "faiss_index" in bundle:
+            import faiss
+            self.index = faiss.deserialize_index(np.asarray(bundle.array("faiss_index")))
+            self.is_faiss = True
+            self._apply_search_params()
+        elif f"numpy_index_{dtype}" in bundle:
+            self.index = NumpyIndex(bundle.array(f"numpy_index_{dtype}"), bundle.get_array("numpy_index_scales"),
+                                    self.settings.NUMPY_SEARCH_BLOCK)
+            self.is_faiss = False
+        else:
+            self.index = self._build_numpy(self.embeddings)
+            self.is_faiss = False
+        logger.info(f"Index loaded from bundle. Size: {len(self.metadata)}")
+        return self
+
+    @staticmethod
+    def _read_faiss(faiss, path: Path):
+        """Memory-maps the FAISS index when supported, so processes share its pages."""
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        try:
+            return faiss.read_index(str(path), flags)
+        except Exception:
+            return faiss.read_index(str(path))
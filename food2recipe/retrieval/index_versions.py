@@ -0,0 +1,210 @@
+# File: food2recipe/retrieval/index_versions.py
+import os
+import json
+import uuid
+import shutil
+import hashlib
+from pathlib import Path
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("index_versions")
+
+# Layout (ARTIFACTS_DIR/indexes/):
+#   <build_id>/            one complete index build (vectors, metadata, centroids, graph, ...)
+#   <build_id>-<stamp>/    the same build plus artifacts a tool added later (probe, centroids, bundle)
+#   <version>/manifest.json  build_id, model, created_at, {file: {size, sha256}}
+#   current                text file naming the version to serve, replaced atomically
+#   .staging-<id>/         a build in progress, renamed to <build_id> when complete
+# Without a current pointer, the legacy single ARTIFACTS_DIR/index folder is used.
+VERSIONS_DIR = "indexes"
+CURRENT_FILE = "current"
+MANIFEST_FILE = "manifest.json"
+
+
+def versions_root(settings) -> Path:
+    return Path(settings.ARTIFACTS_DIR) / VERSIONS_DIR
+
+
+def current_version(settings) -> Optional[str]:
+    """Name of the version the current pointer names, or None."""
+    try:
+        name = (versions_root(settings) / CURRENT_FILE).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    return name or None
+
+
+def resolve_index_dir(settings) -> Path:
+    """Folder of the index to serve: the current version, else the legacy ARTIFACTS_DIR/index."""
+    version = current_version(settings)
+    if version:
+        return versions_root(settings) / version
+    return Path(settings.ARTIFACTS_DIR) / "index"
+
+
+def _read_manifest(folder: Path) -> Dict:
+    with open(Path(folder) / MANIFEST_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def list_versions(settings) -> List[str]:
+    """
+    Published versions, oldest first by the manifest's created_at (not file
+    mtime: refresh_manifest rewrites the manifest of an older version).
+    """
+    root = versions_root(settings)
+    if not root.exists():
+        return []
+    folders = [p for p in root.iterdir() if p.is_dir() and (p / MANIFEST_FILE).exists()]
+    return [p.name for p in sorted(folders, key=lambda p: (_read_manifest(p).get("created_at", ""), p.name))]
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_json_atomic(path: Path, payload: Dict):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def write_manifest(folder: Path, build_id: str, model: str = "", created_at: Optional[str] = None) -> Dict:
+    """Records every file of the version with its size and sha256."""
+    folder = Path(folder)
+    files = {
+        p.name: {"size": p.stat().st_size, "sha256": file_digest(p)}
+        for p in sorted(folder.iterdir()) if p.is_file() and p.name != MANIFEST_FILE
+    }
+    manifest = {
+        "build_id": build_id,
+        "model": model,
+        # ISO with microseconds: sorts as text, and builds in the same second stay ordered
+        "created_at": created_at or datetime.now().isoformat(timespec="microseconds"),
+        "files": files,
+    }
+    _write_json_atomic(folder / MANIFEST_FILE, manifest)
+    return manifest
+
+
+def refresh_manifest(folder: Path):
+    """
+    Re-records file sizes/checksums after a tool added artifacts to a
+    published version. created_at is kept, so the version keeps its age.
+    """
+    if (Path(folder) / MANIFEST_FILE).exists():
+        manifest = _read_manifest(folder)
+        write_manifest(folder, manifest["build_id"], manifest.get("model", ""), manifest.get("created_at"))
+
+
+def verify_manifest(folder: Path, checksums: bool = False) -> Dict:
+    """
+    Raises ValueError if a listed file is missing or differs in size (or in
+    sha256 with checksums=True). Returns the manifest.
+    """
+    folder = Path(folder)
+    manifest = _read_manifest(folder)
+    for name, meta in manifest["files"].items():
+        path = folder / name
+        if not path.exists():
+            raise ValueError(f"{folder.name}: missing {name}")
+        if path.stat().st_size != meta["size"]:
+            raise ValueError(f"{folder.name}: {name} is {path.stat().st_size} bytes, manifest says {meta['size']}")
+        if checksums and file_digest(path) != meta["sha256"]:
+            raise ValueError(f"{folder.name}: checksum mismatch for {name}")
+    return manifest
+
+
+def new_staging_dir(settings) -> Path:
+    """Empty folder a build writes into before publish()."""
+    folder = versions_root(settings) / f".staging-{uuid.uuid4().hex[:8]}"
+    folder.mkdir(parents=True)
+    return folder
+
+
+def set_current(settings, version: str):
+    """Atomically points serving processes at version."""
+    root = versions_root(settings)
+    if not (root / version / MANIFEST_FILE).exists():
+        raise FileNotFoundError(f"No published index version {version}")
+    tmp = root / f"{CURRENT_FILE}.tmp"
+    tmp.write_text(version, encoding="utf-8")
+    os.replace(tmp, root / CURRENT_FILE)
+
+
+def publish(settings, staging: Path, build_id: str, model: str = "", version: Optional[str] = None) -> Path:
+    """
+    Writes the manifest, renames the staging folder to the version (default:
+    the build id), moves the current pointer to it and prunes old versions.
+    """
+    version = version or build_id
+    write_manifest(staging, build_id, model)
+    target = versions_root(settings) / version
+    os.replace(staging, target)
+    set_current(settings, version)
+    logger.info(f"Published index version {version}")
+    prune_versions(settings, settings.INDEX_KEEP_VERSIONS)
+    return target
+
+
+def add_artifacts(settings, index_dir: Path, write: Callable[[Path], None],
+                  finalize: Optional[Callable[[Path], None]] = None) -> Path:
+    """
+    Adds the files write(folder) saves to the index in index_dir and returns
+    the folder now holding them.
+
+    A published version is never modified, since replicas may be reading it:
+    the result is published as a new version <build_id>-<stamp> (which the
+    index watchers pick up), with the other files hard-linked from index_dir
+    (copied across filesystems). write runs on the empty staging folder
+    first, so nothing is written through a link. finalize(folder) runs on the
+    complete folder before publishing (e.g. to repack its bundle).
+    The legacy ARTIFACTS_DIR/index folder is updated in place.
+    """
+    index_dir = Path(index_dir)
+    if index_dir.parent.resolve() != versions_root(settings).resolve() or not (index_dir / MANIFEST_FILE).exists():
+        write(index_dir)
+        if finalize is not None:
+            finalize(index_dir)
+        refresh_manifest(index_dir)
+        return index_dir
+
+    manifest = _read_manifest(index_dir)
+    staging = new_staging_dir(settings)
+    try:
+        write(staging)
+        for path in sorted(index_dir.iterdir()):
+            target = staging / path.name
+            if path.is_file() and path.name != MANIFEST_FILE and not target.exists():
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copy2(path, target)
+        if finalize is not None:
+            finalize(staging)
+        version = f"{manifest['build_id']}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        return publish(settings, staging, manifest["build_id"], manifest.get("model", ""), version=version)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def prune_versions(settings, keep: int):
+    """Deletes all but the newest keep versions; the current one is always kept."""
+    if keep <= 0:
+        return
+    current = current_version(settings)
+    versions = list_versions(settings)
+    for name in versions[:-keep]:
+        if name != current:
+            shutil.rmtree(versions_root(settings) / name, ignore_errors=True)
+            logger.info(f"Pruned index version {name}")
@@ -0,0 +1,174 @@
+# File: food2recipe/retrieval/inference_executor.py
+import math
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("inference_executor")
+
+
+class QueueFullError(Exception):
+    """Raised when the request queue is at capacity (load shedding)."""
+
+
+def check_request_params(confidence_threshold=None, top_k=None, max_top_k=None):
+    """
+    Raises ValueError unless top_k (if given) is an integer in [1, max_top_k]
+    and every threshold (one value or one per image, None = default) is a
+    finite number in [0, 1].
+    """
+    if top_k is not None:
+        if isinstance(top_k, bool) or int(top_k) != top_k or top_k < 1:
+            raise ValueError(f"top_k must be a positive integer, got {top_k!r}")
+        if max_top_k is not None and top_k > max_top_k:
+            raise ValueError(f"top_k must be at most {max_top_k}, got {top_k}")
+    thresholds = confidence_threshold if hasattr(confidence_threshold, "__iter__") else [confidence_threshold]
+    for t in thresholds:
+        if t is not None and not (math.isfinite(t) and 0.0 <= t <= 1.0):
+            raise ValueError(f"confidence threshold must be in [0, 1], got {t!r}")
+
+
+class _Request:
+    __slots__ = ("payload", "threshold", "top_k", "future", "enqueued")
+
+    def __init__(self, payload, threshold, top_k):
+        self.payload = payload
+        self.threshold = threshold
+        self.top_k = top_k
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class InferenceExecutor:
+    """
+    One bounded queue and one worker thread in front of predict_batch, for
+    callers on many threads (e.g. Streamlit sessions sharing a recommender)
+    and for the inference server, whose MicroBatcher awaits it.
+
+    Model work is serialized, so concurrent calls never oversubscribe the
+    torch / FAISS thread pools; requests that arrive within max_wait_ms of
+    each other run as one micro-batch (up to max_batch_size). Per-request
+    parameters (confidence threshold, top-k) travel with the request instead
+    of living in shared settings.
+    """
+
+    def __init__(self, predict_batch_fn, max_batch_size=8, max_wait_ms=5, max_queue_size=32, stats_window=1024):
+        self.predict_batch_fn = predict_batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        # Stats
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.num_batches = 0
+        self.total_batch_items = 0
+        self._waits_ms = deque(maxlen=stats_window)  # Queue wait of recent requests
+
+    def _ensure_worker(self):
+        if self._worker is None:
+            with self._start_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="inference-executor", daemon=True)
+                    self._worker.start()
+
+    def submit(self, image_file, confidence_threshold=None, top_k=None) -> Future:
+        """
+        Queues one image (path, bytes or file-like). Returns a Future of its
+        predict() result. Raises QueueFullError if the queue is saturated.
+        """
+        self._ensure_worker()
+        # File-likes are read on the caller's thread: they are not safe to share
+        if hasattr(image_file, "getvalue"):
+            image_file = image_file.getvalue()
+        elif hasattr(image_file, "read"):
+            image_file = image_file.read()
+        request = _Request(image_file, confidence_threshold, top_k)
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            with self._stats_lock:
+                self.num_rejected += 1
+            raise QueueFullError("Inference queue is full")
+        with self._stats_lock:
+            self.num_requests += 1
+        return request.future
+
+    def predict(self, image_file, confidence_threshold=None, top_k=None, timeout=None):
+        """Blocking submit(). On timeout the request is cancelled if it has not started."""
+        future = self.submit(image_file, confidence_threshold, top_k)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def _collect_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Skip requests whose caller gave up
+            batch = [r for r in self._collect_batch() if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            now = time.perf_counter()
+            with self._stats_lock:
+                self._waits_ms.extend((now - r.enqueued) * 1000.0 for r in batch)
+                self.num_batches += 1
+                self.total_batch_items += len(batch)
+
+            # top_k changes the search itself, so each value gets its own predict_batch call
+            groups = {}
+            for r in batch:
+                groups.setdefault(r.top_k, []).append(r)
+            for top_k, requests in groups.items():
+                try:
+                    results = self.predict_batch_fn(
+                        [r.payload for r in requests], return_exceptions=True, top_k=top_k,
+                        confidence_threshold=[r.threshold for r in requests],
+                    )
+                except Exception as e:
+                    logger.exception(f"Batch of {len(requests)} failed: {e}")
+                    results = [e] * len(requests)
+                for r, res in zip(requests, results):
+                    if isinstance(res, Exception):
+                        r.future.set_exception(res)
+                    else:
+                        r.future.set_result(res)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            waits = sorted(self._waits_ms)
+            batches = self.num_batches
+
+            def pct(p):
+                return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+            return {
+                "queue_depth": self.queue.qsize(),
+                "queue_capacity": self.queue.maxsize,
+                "requests": self.num_requests,
+                "rejected": self.num_rejected,
+                "batches": batches,
+                "avg_batch_size": self.total_batch_items / batches if batches else 0.0,
+                "wait_ms_p50": pct(0.50),
+                "wait_ms_p95": pct(0.95),
+                "wait_ms_max": waits[-1] if waits else 0.0,
+            }
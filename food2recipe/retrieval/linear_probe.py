@@ -0,0 +1,121 @@
+# File: food2recipe/retrieval/linear_probe.py
+import numpy as np
+from pathlib import Path
+from typing import Optional
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("linear_probe")
+
+# Stored next to the index it was trained on:
+#   linear_probe.npz    weights (D, C), bias (C,), temperature, class_names, build_id
+LINEAR_PROBE_FILE = "linear_probe.npz"
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - np.max(logits, axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / np.sum(exp, axis=1, keepdims=True)
+
+
+def fit_temperature(logits: np.ndarray, labels: np.ndarray) -> float:
+    """Temperature minimizing the negative log-likelihood of held-out labels (log-spaced grid search)."""
+    best_t, best_nll = 1.0, np.inf
+    for t in np.logspace(-1.5, 1.5, 121):
+        probs = softmax(logits / t)
+        nll = -np.mean(np.log(np.maximum(probs[np.arange(len(labels)), labels], 1e-12)))
+        if nll < best_nll:
+            best_t, best_nll = float(t), nll
+    return best_t
+
+
+class LinearProbe:
+    """
+    Linear classifier head over the index embeddings: class probabilities are
+    softmax((q @ W + b) / T), one (D, C) matmul per batch whatever the index size.
+    T is fitted on held-out rows so the probabilities are calibrated.
+    """
+
+    def __init__(self, weights, bias, class_names, build_id="", temperature=1.0):
+        self.weights = weights
+        self.bias = bias
+        self.class_names = list(class_names)
+        self.build_id = build_id
+        self.temperature = temperature
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.weights.nbytes + self.bias.nbytes)
+
+    @classmethod
+    def fit(cls, embeddings, label_ids, class_names, build_id="", calibration_mask=None,
+            C=1.0, max_iter=1000) -> "LinearProbe":
+        """
+        Multinomial logistic regression on the rows outside calibration_mask;
+        the temperature is fitted on the rows inside it (T = 1 without any).
+        Classes without training rows can never be predicted.
+        """
+        from sklearn.linear_model import LogisticRegression
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        label_ids = np.asarray(label_ids)
+        if calibration_mask is None or calibration_mask.all() or not calibration_mask.any():
+            calibration_mask = np.zeros(len(label_ids), dtype=bool)
+        train = ~calibration_mask
+        present = np.unique(label_ids[train])
+        if len(present) < 2:
+            raise ValueError("A linear probe needs training images from at least 2 classes")
+
+        clf = LogisticRegression(C=C, max_iter=max_iter)
+        clf.fit(embeddings[train], label_ids[train])
+
+        weights = np.zeros((embeddings.shape[1], len(class_names)), dtype=np.float32)
+        bias = np.full(len(class_names), -np.inf, dtype=np.float32)
+        if len(clf.classes_) == 2:
+            # Binary fits keep a single coefficient row, for the second class
+            weights[:, clf.classes_[1]] = clf.coef_[0]
+            bias[clf.classes_[0]] = 0.0
+            bias[clf.classes_[1]] = clf.intercept_[0]
+        else:
+            weights[:, clf.classes_] = clf.coef_.T
+            bias[clf.classes_] = clf.intercept_
+        probe = cls(weights, bias, class_names, build_id)
+
+        if calibration_mask.any():
+            probe.temperature = fit_temperature(probe.logits(embeddings[calibration_mask]), label_ids[calibration_mask])
+        return probe
+
+    def logits(self, queries) -> np.ndarray:
+        return np.asarray(queries, dtype=np.float32) @ self.weights + self.bias
+
+    def predict_proba(self, queries) -> np.ndarray:
+        """(B, C) class probabilities."""
+        return softmax(self.logits(queries) / self.temperature)
+
+    def save(self, folder: Path):
+        np.savez(
+            Path(folder) / LINEAR_PROBE_FILE,
+            weights=self.weights,
+            bias=self.bias,
+            temperature=np.float32(self.temperature),
+            class_names=np.array(self.class_names, dtype=str),
+            build_id=np.array(self.build_id),
+        )
+        logger.info(f"Saved linear probe ({self.weights.shape[0]}x{self.weights.shape[1]}, T={self.temperature:.3f}) to {folder}")
+
+    @classmethod
+    def load(cls, folder: Path, build_id: Optional[str] = None) -> "LinearProbe":
+        """Raises FileNotFoundError if absent, ValueError if it was trained on another index build."""
+        path = Path(folder) / LINEAR_PROBE_FILE
+        if not path.exists():
+            raise FileNotFoundError(f"No linear probe at {folder}")
+        with np.load(path, allow_pickle=False) as data:
+            probe = cls(
+                weights=data["weights"],
+                bias=data["bias"],
+                class_names=data["class_names"].tolist(),
+                build_id=str(data["build_id"]),
+                temperature=float(data["temperature"]),
+            )
+        if build_id and probe.build_id != build_id:
+            raise ValueError(f"Linear probe is from build {probe.build_id}, index is {build_id}")
+        return probe
@@ -0,0 +1,185 @@
+# File: food2recipe/retrieval/prediction_cache.py
+import time
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+def content_key(data: bytes) -> str:
+    """Fast 128-bit hash of the raw upload bytes."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe bounded LRU cache with optional TTL and hit/miss counters.
+    max_size <= 0 disables the cache (every get is a miss, put is a no-op).
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()  # key -> (inserted_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl_seconds > 0 and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class _Slots:
+    """Fixed (max_size, D) matrix of cached embeddings plus their values and LRU ticks."""
+
+    def __init__(self, max_size: int):
+        self.vectors = None  # (max_size, D) float32, allocated on first put
+        self.values = [None] * max_size
+        self.last_used = np.zeros(max_size, dtype=np.int64)
+        self.size = 0
+
+
+class SemanticCache:
+    """
+    Near-duplicate cache keyed on query embeddings.
+
+    Re-compressed or resized copies of a photo hash differently but embed
+    almost identically. Entries live in a fixed (max_size, D) matrix; a lookup
+    is one matmul against it, and a query whose best cosine similarity is
+    >= threshold returns the stored value. Least recently used slots are
+    evicted first. Embeddings must be L2-normalized.
+
+    Entries are kept per version (index build / top_k / mode), so traffic
+    mixing several top_k values does not evict itself. At most max_versions
+    versions are kept; the least recently used one is dropped first.
+    max_size <= 0 disables the cache.
+    """
+
+    def __init__(self, max_size: int = 256, threshold: float = 0.995, max_versions: int = 8):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.max_versions = max(1, max_versions)
+        self._versions = OrderedDict()  # version -> _Slots
+        self._tick = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.version_evictions = 0
+
+    def _slots(self, version, create):
+        slots = self._versions.get(version)
+        if slots is None and create:
+            slots = self._versions[version] = _Slots(self.max_size)
+            while len(self._versions) > self.max_versions:
+                self._versions.popitem(last=False)
+                self.version_evictions += 1
+        if slots is not None:
+            self._versions.move_to_end(version)
+        return slots
+
+    def lookup(self, queries, version=None):
+        """
+        queries: (B, D) normalized embeddings.
+        Returns a list of B cached values (None on miss).
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        with self._lock:
+            slots = self._slots(version, create=False)
+            if slots is None or slots.size == 0 or slots.vectors.shape[1] != queries.shape[1]:
+                self.misses += len(queries)
+                return [None] * len(queries)
+
+            sims = queries @ slots.vectors[:slots.size].T  # (B, size)
+            best = np.argmax(sims, axis=1)
+            found = []
+            for b, slot in enumerate(best):
+                if sims[b, slot] >= self.threshold:
+                    self._tick += 1
+                    slots.last_used[slot] = self._tick
+                    self.hits += 1
+                    found.append(slots.values[slot])
+                else:
+                    self.misses += 1
+                    found.append(None)
+            return found
+
+    def put(self, embedding, value, version=None):
+        if self.max_size <= 0:
+            return
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        with self._lock:
+            slots = self._slots(version, create=True)
+            if slots.vectors is None or slots.vectors.shape[1] != embedding.shape[0]:
+                slots.vectors = np.zeros((self.max_size, embedding.shape[0]), dtype=np.float32)
+                slots.size = 0
+
+            if slots.size < self.max_size:
+                slot = slots.size
+                slots.size += 1
+            else:
+                slot = int(np.argmin(slots.last_used[:slots.size]))
+                self.evictions += 1
+
+            self._tick += 1
+            slots.vectors[slot] = embedding
+            slots.values[slot] = value
+            slots.last_used[slot] = self._tick
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+
+    def __len__(self):
+        return sum(slots.size for slots in list(self._versions.values()))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "versions": len(self._versions),
+            "max_versions": self.max_versions,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "version_evictions": self.version_evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -1,157 +1,781 @@
 # File: food2recipe/retrieval/recommender.py
-import torch
+import io
+import time
+import functools
+import threading
 import numpy as np
+from pathlib import Path
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from food2recipe.core.settings import load_settings
 from food2recipe.core.logging_utils import setup_logger
-from food2recipe.models.image_encoder import ImageEncoder
 from food2recipe.retrieval.index_faiss import RetrievalIndex
+from food2recipe.retrieval.centroids import ClassCentroids
+from food2recipe.retrieval.linear_probe import LinearProbe
+from food2recipe.retrieval.reduction import PCAReducer
+from food2recipe.retrieval.index_versions import MANIFEST_FILE, resolve_index_dir, verify_manifest
+from food2recipe.retrieval.bundle import BUNDLE_FILE, Bundle, read_toc
+from food2recipe.retrieval.prediction_cache import LRUCache, SemanticCache, content_key
+from food2recipe.retrieval.inference_executor import InferenceExecutor, check_request_params
 from food2recipe.preprocessing.text_preprocess import RecipeProcessor
-from food2recipe.preprocessing.image_preprocess import get_transforms, load_and_transform_image
 
 logger = setup_logger("recommender")
 
+# torch / torchvision / open_clip (and faiss, pandas further down) are imported
+# on first use, so importing this module stays cheap for processes that never
+# encode (e.g. app front-ends predicting through the inference server)
+
+PREDICTION_MODES = ("knn", "cascade", "linear")
+
+# Escalated queries restricted to CASCADE_TOP_M classes fetch this many times
+# TOP_K neighbours, so enough of them fall in the candidate classes
+_CASCADE_OVERFETCH = 4
+
+class ResourceGeneration:
+    """
+    Everything loaded from one index version (vectors, projection, centroids,
+    probe, related dishes; recipes too when served from a bundle). Swapped in
+    as a unit; requests pin the generation they started on.
+    """
+
+    def __init__(self, version="", index=None, reducer=None, centroids=None, linear_probe=None, related_engine=None,
+                 recipes=None, bundle=None):
+        self.version = version
+        self.index = index
+        self.reducer = reducer
+        self.centroids = centroids
+        self.linear_probe = linear_probe
+        self.related_engine = related_engine
+        self.recipes = recipes  # Processed recipe records from the bundle (None: read the CSV)
+        self.bundle = bundle  # Path of the serving bundle, if loaded from one
+        self.loaded_at = time.time()
+        self.active = 0  # Requests currently running on this generation
+
+
+def _stack(images):
+    import torch
+    return torch.stack(images)
+
+
+def _generation_attr(name):
+    """Attribute of the generation pinned by the running request (else the current one)."""
+    return property(lambda self: getattr(self._current(), name),
+                    lambda self, value: setattr(self._gen, name, value))
+
+
+def _pinned(method):
+    """Runs method on one generation throughout, even if a new version is swapped in meanwhile."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self._local, "gen", None) is not None:
+            return method(self, *args, **kwargs)
+        with self._swap_lock:
+            gen = self._gen
+            gen.active += 1
+        self._local.gen = gen
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._local.gen = None
+            with self._swap_lock:
+                gen.active -= 1
+    return wrapper
+
+
 class RecipeRecommender:
+    index = _generation_attr("index")
+    reducer = _generation_attr("reducer")
+    centroids = _generation_attr("centroids")
+    linear_probe = _generation_attr("linear_probe")
+    related_engine = _generation_attr("related_engine")
+
     def __init__(self, settings=None):
         self.settings = settings or load_settings()
         self.encoder = None
-        self.index = None
         self.recipe_processor = None
-        self.related_engine = None
-        self.transform = get_transforms(mode="inference", image_size=self.settings.IMAGE_SIZE)
+        self._gen = ResourceGeneration()
+        self._retired = None  # Previous generation, until its in-flight requests finish
+        self._swap_lock = threading.Lock()
+        self._local = threading.local()
+        self._watcher = None
+        self._stop_watch = threading.Event()
+        self.swaps = 0
+        # Settings validates the field, but variants made with model_copy are not re-validated
+        if self.settings.PREDICTION_MODE not in PREDICTION_MODES:
+            raise ValueError(f"Unknown PREDICTION_MODE: {self.settings.PREDICTION_MODE}. "
+                             f"Expected one of {', '.join(PREDICTION_MODES)}")
+        self.mode = self.settings.PREDICTION_MODE
+        self.cascade_stats = {"fast": 0, "escalated": 0}
+        # Created up front so concurrent predict() callers share one pool; its threads start on first use
+        self._decode_pool = ThreadPoolExecutor(max_workers=max(1, self.settings.DECODE_WORKERS),
+                                               thread_name_prefix="decode")
+        self._executor = None  # Shared InferenceExecutor, created by the first submit()
+        # Caches keyed by content hash of the upload (+ model / index version)
+        self.embedding_cache = LRUCache(self.settings.PREDICTION_CACHE_SIZE, self.settings.PREDICTION_CACHE_TTL_S)
+        self.search_cache = LRUCache(self.settings.PREDICTION_CACHE_SIZE, self.settings.PREDICTION_CACHE_TTL_S)
+        # Near-duplicate uploads (re-compressed / resized copies) keyed on the embedding itself
+        self.semantic_cache = SemanticCache(self.settings.SEMANTIC_CACHE_SIZE, self.settings.SEMANTIC_CACHE_THRESHOLD,
+                                    self.settings.SEMANTIC_CACHE_VERSIONS)
+        self._encoder_tag = f"{self.settings.MODEL_BACKEND}/{self.settings.MODEL_NAME}/{self.settings.PRETRAINED_DATASET}"
+        self._transform = None
+
+    @property
+    def transform(self):
+        if self._transform is None:
+            from food2recipe.preprocessing.image_preprocess import get_transforms
+            self._transform = get_transforms(mode="inference", image_size=self.settings.IMAGE_SIZE,
+                                             preprocess_mode=self.settings.PREPROCESS_MODE)
+        return self._transform
+
+    def _current(self):
+        return getattr(self._local, "gen", None) or self._gen
+
+    @property
+    def _model_tag(self):
+        """Embedding cache namespace: encoder, preprocessing and the index's query projection."""
+        tag = f"{self._encoder_tag}/{self.settings.PREPROCESS_MODE}"
+        reducer = self.reducer
+        return f"{tag}/{reducer.tag}" if reducer is not None else tag
         
-    def load_resources(self):
-        """Loads model, index, and recipes CSV."""
+    def load_resources(self, include_model=True):
+        """
+        Loads model, index, and recipes CSV.
+        include_model=False skips encoder and index, for clients that predict
+        through the inference server and only need recipes / related dishes.
+        With BUNDLE_PATH set (or a bundle.f2r in the index version) everything
+        but the model weights comes from that one memory-mapped file.
+        With INDEX_WATCH_INTERVAL_S > 0, new index versions are then swapped
+        in by a background thread.
+        """
         logger.info("Loading resources...")
         
-        # 1. Encoder
-        self.encoder = ImageEncoder(self.settings)
-        
-        # 2. Index
-        index_path = self.settings.ARTIFACTS_DIR / "index"
-        self.index = RetrievalIndex(self.settings)
-        try:
-            self.index.load(index_path)
-        except Exception as e:
-            logger.error(f"Failed to load index: {e}. Did you run build_index.py?")
-            raise
-            
-        # 3. Recipes
+        if include_model:
+            # 1. Encoder
+            from food2recipe.models.image_encoder import ImageEncoder
+            self.encoder = ImageEncoder(self.settings)
+
+        # 2. Index version: vectors, centroids, related dishes
+        self._gen = self._load_generation(self._index_source(), include_model)
+
+        # 3. Recipes: precomputed in the bundle, else parsed from the CSV
         self.recipe_processor = RecipeProcessor(self.settings)
-        self.recipe_processor.load_and_process()
+        if self._gen.recipes is not None:
+            self.recipe_processor.load_records(self._gen.recipes)
+        else:
+            self.recipe_processor.load_and_process()
+
+        if self.settings.INDEX_WATCH_INTERVAL_S > 0:
+            self.start_watcher()
+
+    def _index_source(self) -> Path:
+        """Bundle file (BUNDLE_PATH) or index folder to serve."""
+        if self.settings.BUNDLE_PATH:
+            return Path(self.settings.BUNDLE_PATH)
+        return resolve_index_dir(self.settings)
+
+    @staticmethod
+    def _source_version(source: Path) -> str:
+        """Version name of a source: the build id of a bundle file, else the folder name."""
+        return read_toc(source)["header"]["build_id"] if source.is_file() else source.name
 
-        # 4. Related Engine
+    def _load_generation(self, index_dir, include_model=True):
+        if index_dir.is_file():
+            return self._load_bundle_generation(index_dir, include_model)
+        if (index_dir / MANIFEST_FILE).exists():
+            verify_manifest(index_dir)
+        if (index_dir / BUNDLE_FILE).exists():
+            return self._load_bundle_generation(index_dir / BUNDLE_FILE, include_model, version=index_dir.name)
+
+        gen = ResourceGeneration(version=index_dir.name)
+
+        if include_model:
+            gen.index = RetrievalIndex(self.settings)
+            try:
+                gen.index.load(index_dir)
+            except Exception as e:
+                logger.error(f"Failed to load index: {e}. Did you run build_index.py?")
+                raise
+            # Queries must be projected like the stored vectors
+            gen.reducer = PCAReducer.load(index_dir, build_id=gen.index.build_id)
+            gen.centroids = self._load_centroids(index_dir, gen.index)
+            gen.linear_probe = self._load_linear_probe(index_dir, gen.index)
+
+        # Related Engine
         from food2recipe.retrieval.related_engine import RelatedEngine
-        self.related_engine = RelatedEngine(self.settings)
+        gen.related_engine = RelatedEngine(self.settings)
         try:
-            self.related_engine.load_resources()
+            gen.related_engine.load_resources(index_dir)
         except Exception as e:
             logger.warning(f"Could not load related engine resources: {e}")
-            self.related_engine = None
-        
-    def predict(self, image_file):
+            gen.related_engine = None
+        return gen
+
+    def _load_bundle_generation(self, path, include_model=True, version=None):
+        """Generation whose arrays are all views of one memory-mapped bundle file."""
+        bundle = Bundle(path)
+        gen = ResourceGeneration(version=version or bundle.build_id, recipes=bundle.recipes(), bundle=path)
+        centroids = bundle.centroids()
+        if include_model:
+            gen.index = RetrievalIndex(self.settings).load_bundle(bundle)
+            gen.reducer = bundle.reducer()
+            if centroids is None and self.mode == "cascade":
+                logger.warning("Cascade mode needs the index centroids (none in the bundle); using knn.")
+            gen.centroids = self._matching_classes(centroids, gen.index, "cascade", "Centroid")
+            probe = bundle.linear_probe()
+            if probe is None and self.mode == "linear":
+                logger.warning("Linear mode needs a trained probe (none in the bundle); using knn.")
+            gen.linear_probe = self._matching_classes(probe, gen.index, "linear", "Linear probe")
+
+        from food2recipe.retrieval.related_engine import RelatedEngine
+        gen.related_engine = RelatedEngine(self.settings)
+        gen.related_engine.set_resources(centroids, bundle.related_graph())
+        logger.info(f"Loaded bundle {path} (build {bundle.build_id})")
+        return gen
+
+    def _matching_classes(self, artifact, index, mode, what):
+        """artifact if it covers exactly the index classes, else None (mode then falls back to knn)."""
+        if artifact is not None and artifact.class_names != list(index.class_names):
+            if self.mode == mode:
+                logger.warning(f"{what} classes do not match the index; using knn.")
+            return None
+        return artifact
+
+    def _load_centroids(self, index_path, index):
+        """Centroids of this index build, or None (cascade mode then falls back to knn)."""
+        try:
+            centroids = ClassCentroids.load(index_path, build_id=index.build_id)
+        except (FileNotFoundError, ValueError) as e:
+            if self.mode == "cascade":
+                logger.warning(f"Cascade mode needs the index centroids ({e}); using knn.")
+            return None
+        return self._matching_classes(centroids, index, "cascade", "Centroid")
+
+    def _load_linear_probe(self, index_path, index):
+        """Linear head trained on this index build, or None (linear mode then falls back to knn)."""
+        try:
+            probe = LinearProbe.load(index_path, build_id=index.build_id)
+        except (FileNotFoundError, ValueError) as e:
+            if self.mode == "linear":
+                logger.warning(f"Linear mode needs a trained probe ({e}); using knn. "
+                               "Run python -m food2recipe.scripts.train_linear_probe")
+            return None
+        return self._matching_classes(probe, index, "linear", "Linear probe")
+
+    # -------------------- Hot swap --------------------
+    def start_watcher(self, interval_s=None):
+        """Polls the artifacts 'current' pointer (or BUNDLE_PATH) in a daemon thread and swaps new versions in."""
+        interval = interval_s or self.settings.INDEX_WATCH_INTERVAL_S
+        if self._watcher is not None or interval <= 0:
+            return
+        self._stop_watch.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="index-watcher", daemon=True)
+        self._watcher.start()
+        logger.info(f"Watching for new index versions every {interval}s")
+
+    def stop_watcher(self):
+        if self._watcher is not None:
+            self._stop_watch.set()
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval):
+        while not self._stop_watch.wait(interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logger.error(f"Index reload failed, still serving {self._gen.version}: {e}")
+
+    def reload_if_changed(self) -> bool:
+        """
+        Loads the version the 'current' pointer names if it is not the one
+        being served, then swaps it in. In-flight requests finish on the old
+        generation; at most two generations are alive at any time, so a new
+        load waits until the previously retired one has drained.
+        Returns True if a new version was swapped in.
+        """
+        source = self._index_source()
+        version = self._source_version(source)
+        if version == self._gen.version:
+            return False
+        with self._swap_lock:
+            if self._retired is not None:
+                if self._retired.active > 0:
+                    logger.info(f"Version {self._retired.version} still has requests in flight, deferring reload")
+                    return False
+                self._retired = None
+
+        new = self._load_generation(source, include_model=self.encoder is not None)
+        if new.index is not None and not self._same_model(new.index):
+            raise ValueError(f"Version {new.version} was built with {new.index.header.get('model')}, "
+                             f"serving {self._encoder_tag}; restart with the matching model instead")
+        if new.index is not None and new.index.embeddings is not None:
+            # Touch the index once so the first request does not pay for page faults
+            new.index.search_batch(np.asarray(new.index.embeddings[:1], dtype=np.float32), k=1)
+
+        with self._swap_lock:
+            old, self._gen = self._gen, new
+            self._retired = old if old.active > 0 else None
+            self.swaps += 1
+            if new.recipes is not None and self.recipe_processor is not None:
+                self.recipe_processor.load_records(new.recipes)
+        logger.info(f"Swapped index version {old.version or '-'} -> {new.version}")
+        return True
+
+    def _same_model(self, index) -> bool:
+        """Same embedding space (model + pretrained weights; the backend does not matter)."""
+        model = index.header.get("model")
+        return not model or model.split("/")[1:] == self._encoder_tag.split("/")[1:]
+
+    def generation_info(self) -> dict:
+        gen = self._gen
+        return {
+            "version": gen.version,
+            "build_id": gen.index.build_id if gen.index is not None else "",
+            "loaded_at": gen.loaded_at,
+            "bundle": str(gen.bundle) if gen.bundle is not None else None,
+            "swaps": self.swaps,
+            "retired_in_flight": self._retired.active if self._retired is not None else 0,
+        }
+
+    def predict(self, image_file, confidence_threshold=None, top_k=None):
         """
         Returns:
             - best_food_name (str)
             - confidence (float)
             - recipe (dict) or None
             - top_k_items (list of dicts with name, score, image_path from train)
+        confidence_threshold / top_k override the default threshold / TOP_K for this call. The
+        default depends on what the confidence is: CONFIDENCE_THRESHOLD for the top-1 neighbour
+        cosine (knn), CENTROID_CONFIDENCE_THRESHOLD for the centroid cosine (cascade fast path),
+        PROBE_CONFIDENCE_THRESHOLD for the probe probability (linear).
+        Runs on the calling thread; concurrent callers should go through submit().
         """
-        # 1. Encode
-        img_tensor = load_and_transform_image(image_file, self.transform)
-        # Add batch dim
-        img_tensor = img_tensor.unsqueeze(0) 
-        
-        emb = self.encoder.encode(img_tensor).numpy() # (1, D)
-        
-        # 2. Search
-        top_k = self.settings.TOP_K
-        scores, indices = self.index.search(emb, k=top_k)
-        
-        # 3. Aggregate results
-        # We retrieved K nearest training images. They have labels (food_name).
-        retrieved_items = []
+        # Single image is just a batch of one, so both paths share the exact same code
+        return self.predict_batch([image_file], confidence_threshold=confidence_threshold, top_k=top_k)[0]
+
+    @property
+    def executor(self) -> InferenceExecutor:
+        return self.start_executor()
+
+    def start_executor(self, max_batch_size=None, max_wait_ms=None, max_queue_size=None) -> InferenceExecutor:
+        """
+        The shared executor, created on first use with these limits (default
+        EXECUTOR_*; the inference server passes its SERVER_* ones). Later calls
+        return the existing one, with a warning if they ask for other limits
+        (e.g. a warmup submit() ran before the server started).
+        """
+        created = False
+        if self._executor is None:
+            with self._swap_lock:
+                if self._executor is None:
+                    self._executor = InferenceExecutor(
+                        self.predict_batch,
+                        max_batch_size=max_batch_size or self.settings.EXECUTOR_MAX_BATCH_SIZE,
+                        max_wait_ms=max_wait_ms or self.settings.EXECUTOR_MAX_WAIT_MS,
+                        max_queue_size=max_queue_size or self.settings.EXECUTOR_MAX_QUEUE_SIZE,
+                    )
+                    created = True
+        if not created:
+            ex = self._executor
+            current = {"max_batch_size": ex.max_batch_size, "max_wait_ms": ex.max_wait * 1000.0,
+                       "max_queue_size": ex.queue.maxsize}
+            requested = {"max_batch_size": max_batch_size, "max_wait_ms": max_wait_ms, "max_queue_size": max_queue_size}
+            ignored = {k: v for k, v in requested.items() if v is not None and not np.isclose(v, current[k])}
+            if ignored:
+                logger.warning(f"Executor already running with {current}; ignoring requested {ignored}")
+        return self._executor
+
+    def submit(self, image_file, confidence_threshold=None, top_k=None, timeout=None):
+        """
+        Thread-safe predict() for callers sharing this recommender (e.g. Streamlit
+        sessions): queued on the shared executor, micro-batched with concurrent
+        requests, model work serialized. Parameters apply to this request only.
+        Raises QueueFullError when the queue is full, TimeoutError after
+        timeout (default EXECUTOR_TIMEOUT_S), ValueError for out of range parameters.
+        """
+        # Checked here too, so a bad request fails alone instead of its whole micro-batch
+        check_request_params(confidence_threshold, top_k, self.settings.MAX_TOP_K)
+        timeout = self.settings.EXECUTOR_TIMEOUT_S if timeout is None else timeout
+        return self.executor.predict(image_file, confidence_threshold, top_k, timeout=timeout or None)
+
+    @_pinned
+    def predict_batch(self, image_files, return_exceptions=False, confidence_threshold=None, top_k=None):
+        """
+        Batched version of predict().
+        Decodes images in parallel, encodes them in a single forward pass and runs
+        one multi-query search.
+
+        Embeddings and votes are cached by a hash of the raw image bytes,
+        so re-uploads of the same photo skip decode/encode/search. Near-duplicates
+        (same photo, different bytes) still get encoded but reuse the votes of a
+        cached query with cosine >= SEMANTIC_CACHE_THRESHOLD. The threshold is
+        applied after the caches, so changing it never invalidates entries.
+
+        confidence_threshold: one value for the batch or one per image.
+        Returns a list of result dicts (same format as predict), in input order.
+        If return_exceptions is True, images that fail to decode get their
+        exception in place of a result instead of failing the whole batch.
+        Raises ValueError if top_k is not in [1, MAX_TOP_K] or a threshold is
+        not in [0, 1].
+        """
+        check_request_params(confidence_threshold, top_k, self.settings.MAX_TOP_K)
+        image_files = list(image_files)
+        if not image_files:
+            return []
+
+        # 1. Raw bytes + content keys
+        payloads = [self._read_bytes(f) for f in image_files]
+        errors = {pos: p for pos, p in enumerate(payloads) if isinstance(p, Exception)}
+        keys = {pos: content_key(p) for pos, p in enumerate(payloads) if pos not in errors}
+
+        # 2. Cache lookups: votes first, then embedding
+        top_k = top_k or self.settings.TOP_K
+        version = self._vote_version(top_k)
+        votes = {}  # pos -> (food_name, confidence, dedup_topk, source)
+        embs = {}  # pos -> embedding (D,)
+        for pos, key in keys.items():
+            hit = self.search_cache.get((key, version))
+            if hit is not None:
+                votes[pos] = hit
+                continue
+            emb = self.embedding_cache.get((key, self._model_tag))
+            if emb is not None:
+                embs[pos] = emb
+
+        # 3. Decode (parallel, PIL releases the GIL while decoding/resizing) + encode misses
+        to_encode = [pos for pos in keys if pos not in votes and pos not in embs]
+        decoded = {}
+        if to_encode:
+            for pos, img in zip(to_encode, self._decode_images([io.BytesIO(payloads[pos]) for pos in to_encode])):
+                if isinstance(img, Exception):
+                    errors[pos] = img
+                else:
+                    decoded[pos] = img
+
+        if errors and not return_exceptions:
+            raise errors[min(errors)]
+
+        if decoded:
+            # One forward pass for the whole batch
+            new_embs = self.embed(_stack(list(decoded.values()))) # (B, D)
+            for pos, emb in zip(decoded, new_embs):
+                emb.setflags(write=False)
+                embs[pos] = emb
+                self.embedding_cache.put((keys[pos], self._model_tag), emb)
+
+        # 4. Near-duplicate lookup: votes of a recent query with (almost) the same embedding
+        candidates = sorted(embs)
+        if candidates:
+            found = self.semantic_cache.lookup(np.stack([embs[pos] for pos in candidates]), version=version)
+            for pos, vote in zip(candidates, found):
+                if vote is not None:
+                    votes[pos] = vote
+
+        # 5. Classify the rest in one go (centroids and / or one multi-query search)
+        todo = [pos for pos in candidates if pos not in votes]
+        if todo:
+            for pos, vote in zip(todo, self.classify(np.stack([embs[pos] for pos in todo]), top_k=top_k)):
+                votes[pos] = vote
+                self.search_cache.put((keys[pos], version), vote)
+                self.semantic_cache.put(embs[pos], vote, version=version)
+
+        thresholds = self._thresholds(confidence_threshold, len(image_files))
+        results = [errors.get(pos) for pos in range(len(image_files))]
+        for pos, vote in votes.items():
+            results[pos] = self._finalize(vote, thresholds[pos])
+        return results
+
+    def _thresholds(self, confidence_threshold, n):
+        """
+        Per-image thresholds from None, one value, or one (possibly None) value
+        per image. None is resolved per vote by _finalize.
+        """
+        if confidence_threshold is None or np.isscalar(confidence_threshold):
+            confidence_threshold = [confidence_threshold] * n
+        return list(confidence_threshold)
+
+    def _default_threshold(self, source):
+        """
+        Threshold for a vote's confidence when the request sets none: kNN and
+        centroid votes carry cosine similarities, probe votes softmax
+        probabilities, so each has its own.
+        """
+        if source == "probe":
+            return self.settings.PROBE_CONFIDENCE_THRESHOLD
+        if source == "centroid":
+            return self.settings.CENTROID_CONFIDENCE_THRESHOLD
+        return self.settings.CONFIDENCE_THRESHOLD
+
+    @_pinned
+    def predict_tensors(self, images, confidence_threshold=None):
+        """
+        Predicts from already preprocessed images (B, 3, S, S), e.g. uint8 crops
+        from a PixelShardStore. Bypasses the caches.
+        """
+        embs = self.embed(images)
+        return [self._finalize(vote, confidence_threshold) for vote in self.classify(embs)]
+
+    @_pinned
+    def encode_images(self, image_files):
+        """
+        Embeddings of a list of images, no caches.
+        Returns ((n, D) float32 embeddings, positions of the images that decoded).
+        """
+        decoded = [(pos, img) for pos, img in enumerate(self._decode_images(list(image_files)))
+                   if not isinstance(img, Exception)]
+        if not decoded:
+            return np.zeros((0, 0), dtype=np.float32), []
+        return self.embed(_stack([img for _, img in decoded])), [pos for pos, _ in decoded]
+
+    @_pinned
+    def embed(self, images):
+        """Query embeddings (B, D) of preprocessed images, in the index's vector space."""
+        from food2recipe.preprocessing.image_preprocess import normalize_batch
+        embs = self.encoder.encode(normalize_batch(images)).numpy()
+        if self.reducer is not None:
+            embs = self.reducer.transform(embs)
+        return embs
+
+    @_pinned
+    def classify(self, embeddings, mode=None, top_k=None):
+        """
+        Threshold-independent votes for a batch of query embeddings (B, D).
+        knn: sum-score vote over the TOP_K nearest reference images.
+        cascade: class centroid scores first; queries whose top-2 margin is
+        below CASCADE_MARGIN escalate to the kNN vote (over the CASCADE_TOP_M
+        best centroid classes when set).
+        linear: calibrated class probabilities from the linear probe.
+        top_k defaults to settings.TOP_K.
+        Each vote is (food_name, confidence, dedup_topk, source); source (knn,
+        centroid or probe) says what confidence measures, which picks its
+        default threshold.
+        """
+        mode = mode or self.mode
+        top_k = top_k or self.settings.TOP_K
+        if mode == "linear" and self.linear_probe is not None:
+            probs = self.linear_probe.predict_proba(embeddings)
+            order = np.argsort(-probs, axis=1, kind="stable")[:, :top_k]
+            return [self._class_vote(p, o, top_k, source="probe") for p, o in zip(probs, order)]
+
+        if mode == "cascade" and self.centroids is not None:
+            class_scores = self._centroid_scores(embeddings)
+            order = np.argsort(-class_scores, axis=1, kind="stable")
+            best = np.take_along_axis(class_scores, order[:, :2], axis=1)
+            margin = best[:, 0] - (best[:, 1] if best.shape[1] > 1 else -np.inf)
+            fast = margin >= self.settings.CASCADE_MARGIN
+
+            votes = [None] * len(embeddings)
+            for b in np.flatnonzero(fast):
+                votes[b] = self._class_vote(class_scores[b], order[b], top_k, source="centroid")
+            escalate = np.flatnonzero(~fast)
+            if len(escalate):
+                top_m = self.settings.CASCADE_TOP_M
+                k = top_k * _CASCADE_OVERFETCH if top_m > 0 else top_k
+                scores, indices = self.index.search_batch(embeddings[escalate], k=k)
+                if top_m > 0:
+                    scores, indices = self._restrict(scores, indices, order[escalate, :top_m], top_k)
+                for b, vote in zip(escalate, self._vote_batch(scores, indices, top_k)):
+                    votes[b] = vote
+            self.cascade_stats["fast"] += int(fast.sum())
+            self.cascade_stats["escalated"] += len(escalate)
+            return votes
+
+        scores, indices = self.index.search_batch(embeddings, k=top_k)
+        return self._vote_batch(scores, indices, top_k)
+
+    def _centroid_scores(self, embeddings):
+        """(B, C) cosine of each query to each class: its centroid, or its best prototype."""
+        c = self.centroids
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if c.prototypes is not None:
+            sims = embeddings @ np.asarray(c.prototypes, dtype=np.float32).T
+            class_scores = np.full((len(embeddings), len(c.class_names)), -np.inf, dtype=np.float32)
+            np.maximum.at(class_scores.T, c.prototype_labels, sims.T)
+            return class_scores
+        class_scores = embeddings @ np.asarray(c.matrix, dtype=np.float32).T
+        class_scores[:, c.counts == 0] = -np.inf
+        return class_scores
+
+    def _class_vote(self, class_scores, order, top_k=None, source="centroid"):
+        """
+        Vote from per-class scores (centroid cosine or probe probability);
+        confidence is the best class score.
+        """
+        top = [c for c in order[:top_k or self.settings.TOP_K] if np.isfinite(class_scores[c])]
+        names = self.index.class_names
+        dedup_topk = tuple(
+            {"food_name": names[c], "score": float(class_scores[c]), "image_path": None}
+            for c in top
+        )
+        return names[top[0]], float(class_scores[top[0]]), dedup_topk, source
+
+    def _restrict(self, scores, indices, candidates, top_k):
+        """
+        Keeps the first top_k neighbours whose class is among the candidates,
+        padding with -1. Rows left empty keep their unrestricted neighbours.
+        """
+        out_scores = np.zeros((len(indices), top_k), dtype=np.float32)
+        out_indices = np.full((len(indices), top_k), -1, dtype=np.int64)
+        valid = indices >= 0
+        labels = np.where(valid, self.index.label_ids[np.where(valid, indices, 0)], -1)
+        for b in range(len(indices)):
+            keep = np.flatnonzero(valid[b] & np.isin(labels[b], candidates[b]))[:top_k]
+            if len(keep) == 0:
+                keep = np.arange(min(top_k, indices.shape[1]))
+            out_scores[b, :len(keep)] = scores[b, keep]
+            out_indices[b, :len(keep)] = indices[b, keep]
+        return out_scores, out_indices
+
+    @staticmethod
+    def _read_bytes(image_file):
+        """Raw bytes of a path, bytes object or file-like (e.g. Streamlit UploadedFile). Errors are returned."""
+        try:
+            if isinstance(image_file, (bytes, bytearray)):
+                return bytes(image_file)
+            if hasattr(image_file, "getvalue"):
+                return image_file.getvalue()
+            if hasattr(image_file, "read"):
+                data = image_file.read()
+                if hasattr(image_file, "seek"):
+                    image_file.seek(0)
+                return data
+            with open(image_file, "rb") as f:
+                return f.read()
+        except Exception as e:
+            return ValueError(f"Error reading image: {e}")
+
+    def _index_version(self):
+        # Versions derived from one build (added probe / centroids) share its build id
+        return (self.index.build_id or f"mem-{id(self.index)}", self._current().version)
+
+    def _vote_version(self, top_k=None):
+        """Everything a cached vote depends on besides the query."""
+        version = (self._index_version(), top_k or self.settings.TOP_K, self.mode)
+        if self.mode == "cascade":
+            version += (self.settings.CASCADE_MARGIN, self.settings.CASCADE_TOP_M)
+        return version
+
+    def cache_stats(self) -> dict:
+        return {
+            "embedding": self.embedding_cache.stats(),
+            "search": self.search_cache.stats(),
+            "semantic": self.semantic_cache.stats(),
+            "cascade": self.cascade_stats_summary(),
+            "executor": self._executor.stats() if self._executor is not None else None,
+        }
+
+    def cascade_stats_summary(self) -> dict:
+        total = self.cascade_stats["fast"] + self.cascade_stats["escalated"]
+        return {**self.cascade_stats, "fast_path_rate": self.cascade_stats["fast"] / total if total else 0.0}
+
+    def _decode_images(self, image_files):
+        """
+        Loads and transforms images. Errors are returned in place, not raised.
+        """
+        from food2recipe.preprocessing.image_preprocess import load_and_transform_image
+        transform = self.transform
+        def _load(image_file):
+            try:
+                return load_and_transform_image(image_file, transform, self.settings.MAX_IMAGE_PIXELS)
+            except Exception as e:
+                return e
+
+        if len(image_files) == 1:
+            return [_load(image_files[0])]
+        return list(self._decode_pool.map(_load, image_files))
+
+    def _aggregate_batch(self, scores, indices, confidence_threshold=None):
+        """
+        Sum-score voting for a whole batch of neighbour lists at once.
+        scores, indices: (B, K) from RetrievalIndex.search_batch
+        """
+        return [self._finalize(vote, confidence_threshold) for vote in self._vote_batch(scores, indices)]
+
+    def _vote_batch(self, scores, indices, top_k=None):
+        """
+        Threshold-independent part of the aggregation, so its output can be cached.
+        Returns one (best_food_name, top_1_score, dedup_topk, "knn") tuple per query.
+        """
+        top_k = top_k or self.settings.TOP_K
+        scores = np.asarray(scores, dtype=np.float64)
+        indices = np.asarray(indices)
+        B, K = indices.shape
+        num_classes = len(self.index.class_names)
+
+        # FAISS pads with -1 when the index holds fewer than k vectors
+        valid = indices >= 0
+        labels = np.where(valid, self.index.label_ids[np.where(valid, indices, 0)], 0)
+        rows = np.broadcast_to(np.arange(B)[:, None], (B, K))
+        positions = np.broadcast_to(np.arange(K)[None, :], (B, K))
+
+        # Sum scores per (query, class), in neighbour order
+        class_sums = np.zeros((B, num_classes), dtype=np.float64)
+        np.add.at(class_sums, (rows[valid], labels[valid]), scores[valid])
+
+        # First neighbour position of each class, used to break ties the same
+        # way a stable sort over first-seen order would
+        first_pos = np.full((B, num_classes), K, dtype=np.int64)
+        np.minimum.at(first_pos, (rows[valid], labels[valid]), positions[valid])
+
         votes = []
-        
-        for score, idx in zip(scores, indices):
-            meta = self.index.metadata[idx]
-            food_class = meta['food_name']
-            
-            # Populate info
-            item = {
-                "food_name": food_class,
-                "score": float(score),
-                "image_path": meta.get("image_path")
-            }
-            retrieved_items.append(item)
-            votes.append(food_class)
-            
-        # Majority vote
-        # Or Sum-score voting (better for embeddings)
-        score_map = {}
-        for item in retrieved_items:
-            fname = item["food_name"]
-            score_map[fname] = score_map.get(fname, 0.0) + item["score"]
-            
-        # Sort by total score
-        sorted_preds = sorted(score_map.items(), key=lambda x: x[1], reverse=True)
-        best_food_name, total_score = sorted_preds[0]
-        
-        # Start Confidence calculation
-        # Simple heuristic: max(score) of top-1 match
-        # Or avg score of retrieval
-        top_1_score = retrieved_items[0]["score"] # The single nearest neighbor similarity
-        
-        # Create Deduplicated Top-K List
-        dedup_topk = []
-        for name, score in sorted_preds:
-             dedup_topk.append({
-                 "food_name": name,
-                 "score": float(score / top_k), # Average score? Or just Sum? Sum is fine for ranking. 
-                 # Let's keep it normalized roughly to 0-1 range for UI display if possible, 
-                 # but similarity sums can be > 1. 
-                 # Let's use avg matching score as a proxy:
-                 "score": float(score) / top_k if top_k > 0 else 0.0,
-                 # We lose specific image path here, but that's okay for class-level prediction
-                 "image_path": None 
-             })
-             
-        # Improve Confidence: use the aggregated score of the winner vs runner up?
-        # stick to top-1 NN for "Confidence" as it represents "is there an identical image?"
-        
-        
+        for b in range(B):
+            present = np.flatnonzero(first_pos[b] < K)
+            order = present[np.lexsort((first_pos[b, present], -class_sums[b, present]))]
+
+            # Sort by total score
+            sorted_preds = [(self.index.class_names[c], class_sums[b, c]) for c in order]
+            best_food_name, total_score = sorted_preds[0]
+
+            # Confidence: top-1 NN similarity, i.e. "is there an identical image?"
+            top_1_score = float(scores[b, 0])
+
+            # Deduplicated Top-K List
+            # Avg matching score keeps it roughly in 0-1 range for UI display
+            dedup_topk = tuple(
+                {
+                    "food_name": name,
+                    "score": float(score) / top_k if top_k > 0 else 0.0,
+                    # We lose specific image path here, but that's okay for class-level prediction
+                    "image_path": None,
+                }
+                for name, score in sorted_preds
+            )
+            votes.append((best_food_name, top_1_score, dedup_topk, "knn"))
+        return votes
+
+    def _finalize(self, vote, threshold=None):
+        best_food_name, top_1_score, dedup_topk, source = vote
         # Output Decision
-        threshold = self.settings.CONFIDENCE_THRESHOLD
-        
+        if threshold is None:
+            threshold = self._default_threshold(source)
         is_uncertain = top_1_score < threshold
-        
+        # Copies, so callers can edit their result without touching cached votes
+        return self._build_result(best_food_name, top_1_score, is_uncertain, [dict(item) for item in dedup_topk])
 
+    def _build_result(self, best_food_name, confidence, is_uncertain, dedup_topk):
         # Get Recipe
         recipe = self.recipe_processor.get_recipe(best_food_name)
-        
-        # --- NEW: Get Related & Group Items ---
+
+        # Related & Group Items
         related_similar = []
         related_group = []
         group_name = ""
-        
+
         if self.related_engine:
             related_similar = self.related_engine.get_similar_dishes(best_food_name)
             related_group = self.related_engine.get_group_dishes(best_food_name)
             group_name = self.related_engine.get_group_name(best_food_name)
 
-        result = {
+        return {
             "predicted_food": best_food_name,
-            "confidence": top_1_score,
+            "confidence": confidence,
             "is_uncertain": is_uncertain,
             "recipe": recipe,
             "top_k_items": dedup_topk,
-            # New fields
             "related_similar": related_similar,
             "related_group": related_group,
             "group_name": group_name
         }
-        
-        return result
 
 if __name__ == "__main__":
     # Smoke test
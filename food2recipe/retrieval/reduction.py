@@ -0,0 +1,132 @@
+# File: food2recipe/retrieval/reduction.py
+import numpy as np
+from pathlib import Path
+from typing import Optional
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("reduction")
+
+# Stored next to the index whose vectors it produced:
+#   pca.npz    mean (D,), components (D, d), scale (d,), variance_ratio (d,), whiten, build_id
+PCA_FILE = "pca.npz"
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class PCAReducer:
+    """
+    PCA projection of encoder embeddings to a smaller dimension, with optional
+    whitening, re-normalized so inner product stays cosine similarity.
+    Index vectors and queries must go through the same reducer.
+    """
+
+    def __init__(self, mean, components, scale, variance_ratio, whiten=False, build_id=""):
+        self.mean = mean
+        self.components = components
+        self.scale = scale
+        self.variance_ratio = variance_ratio  # Share of the total variance along each component
+        self.whiten = whiten
+        self.build_id = build_id
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def source_dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def explained_variance(self) -> float:
+        return float(np.sum(self.variance_ratio))
+
+    @property
+    def tag(self) -> str:
+        """Identifies the projection, for cache keys."""
+        return f"pca{self.dim}{'w' if self.whiten else ''}-{self.build_id}"
+
+    @classmethod
+    def fit(cls, embeddings, dim: int, whiten: bool = False, sample_size: int = 100_000,
+            block_size: int = 65536) -> "PCAReducer":
+        """
+        Fits on a fixed random sample (reproducible rebuilds), accumulating the
+        covariance block by block so a memory-mapped matrix is never loaded whole.
+        """
+        n, d = embeddings.shape
+        dim = min(dim, d)
+        rows = np.arange(n)
+        if n > sample_size:
+            rows = np.sort(np.random.default_rng(0).choice(n, sample_size, replace=False))
+
+        total = np.zeros(d, dtype=np.float64)
+        gram = np.zeros((d, d), dtype=np.float64)
+        for start in range(0, len(rows), block_size):
+            block = np.asarray(embeddings[rows[start:start + block_size]], dtype=np.float64)
+            total += block.sum(axis=0)
+            gram += block.T @ block
+        mean = total / len(rows)
+        cov = gram / len(rows) - np.outer(mean, mean)
+
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        order = np.argsort(eigvals)[::-1]
+        eigvals = np.maximum(eigvals[order], 0.0)
+        eigvecs = eigvecs[:, order]
+
+        scale = 1.0 / np.sqrt(eigvals[:dim] + 1e-6) if whiten else np.ones(dim)
+        ratio = eigvals[:dim] / eigvals.sum() if eigvals.sum() > 0 else np.full(dim, 1.0 / dim)
+        return cls(mean.astype(np.float32), eigvecs[:, :dim].astype(np.float32), scale.astype(np.float32),
+                   ratio.astype(np.float32), whiten=whiten)
+
+    def truncate(self, dim: int) -> "PCAReducer":
+        """The same projection keeping only the first dim components (PCA components are nested)."""
+        return PCAReducer(self.mean, self.components[:, :dim], self.scale[:dim], self.variance_ratio[:dim],
+                          whiten=self.whiten, build_id=self.build_id)
+
+    def transform(self, embeddings) -> np.ndarray:
+        """(B, D) -> (B, d) float32, L2-normalized."""
+        reduced = (np.asarray(embeddings, dtype=np.float32) - self.mean) @ self.components
+        return _normalize_rows(reduced * self.scale)
+
+    def transform_blocks(self, embeddings, out, block_size: int = 65536):
+        """Transforms a (possibly memory-mapped) matrix into out (N, d), block by block."""
+        for start in range(0, len(embeddings), block_size):
+            out[start:start + block_size] = self.transform(embeddings[start:start + block_size])
+        return out
+
+    def save(self, folder: Path):
+        np.savez(
+            Path(folder) / PCA_FILE,
+            mean=self.mean,
+            components=self.components,
+            scale=self.scale,
+            variance_ratio=self.variance_ratio,
+            whiten=np.array(self.whiten),
+            build_id=np.array(self.build_id),
+        )
+        logger.info(f"Saved PCA {self.source_dim}->{self.dim} (whiten={self.whiten}, "
+                    f"{self.explained_variance:.1%} variance) to {folder}")
+
+    @classmethod
+    def load(cls, folder: Path, build_id: Optional[str] = None) -> Optional["PCAReducer"]:
+        """
+        None if the index has no reducer. Raises ValueError if it belongs to
+        another index build: queries would not match the stored vectors.
+        """
+        path = Path(folder) / PCA_FILE
+        if not path.exists():
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            reducer = cls(
+                mean=data["mean"],
+                components=data["components"],
+                scale=data["scale"],
+                variance_ratio=data["variance_ratio"],
+                whiten=bool(data["whiten"]),
+                build_id=str(data["build_id"]),
+            )
+        if build_id and reducer.build_id != build_id:
+            raise ValueError(f"PCA reducer is from build {reducer.build_id}, index is {build_id}")
+        return reducer
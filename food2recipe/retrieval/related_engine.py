@@ -1,8 +1,14 @@
 
+import json
 import numpy as np
 from typing import List, Dict, Tuple
 from food2recipe.core.settings import load_settings
 from food2recipe.core.logging_utils import setup_logger
+from food2recipe.models.embedding_store import HEADER_FILE
+from food2recipe.retrieval.centroids import ClassCentroids
+from food2recipe.retrieval.related_graph import RelatedGraph, top_k_similar
+from food2recipe.retrieval.index_versions import resolve_index_dir
+from food2recipe.preprocessing.text_preprocess import normalize_food_name
 
 logger = setup_logger("related_engine")
 
@@ -45,45 +51,89 @@ DISH_GROUPS = {
 class RelatedEngine:
     def __init__(self, settings=None):
         self.settings = settings or load_settings()
-        self.centroids = {}
-        self.groups = DISH_GROUPS
+        self.centroids = None # ClassCentroids: stacked (C, D) matrix, row = label id
+        self.graph = None # RelatedGraph built with the index: O(1) lookups
+        # Keys normalized the same way as the index class names ("Banh beo" -> "banh_beo")
+        self.groups = {normalize_food_name(dish): group for dish, group in DISH_GROUPS.items()}
+        self._class_to_id = {}
         
-    def load_resources(self):
-        """Loads class centroids."""
+    def load_resources(self, index_dir=None):
+        """Loads the class centroids and related-dish graph stored with the index build (default: current)."""
+        index_dir = index_dir or resolve_index_dir(self.settings)
+        build_id = None
+        if (index_dir / HEADER_FILE).exists():
+            with open(index_dir / HEADER_FILE, "r", encoding="utf-8") as f:
+                build_id = json.load(f).get("build_id")
+
+        try:
+            self.graph = RelatedGraph.load(index_dir, build_id)
+            logger.info(f"Loaded related-dish graph for {len(self.graph.names)} dishes.")
+        except (FileNotFoundError, ValueError) as e:
+            logger.info(f"No usable related-dish graph ({e}), computing similar dishes from centroids.")
+
+        try:
+            self._set_centroids(ClassCentroids.load(index_dir, build_id))
+            logger.info(f"Loaded centroids for {len(self._class_to_id)} classes.")
+            return
+        except ValueError as e:
+            logger.warning(f"Stale centroids ({e}). 'Similar' feature will be unavailable until build_index is rerun.")
+            return
+        except FileNotFoundError:
+            pass
+
+        # Legacy artifact from tools/build_centroids.py (pickled dict)
         centroids_path = self.settings.ARTIFACTS_DIR / "class_centroids.npy"
-        if list(centroids_path.parent.glob("class_centroids.npy")):
+        if centroids_path.exists():
             try:
-                self.centroids = np.load(centroids_path, allow_pickle=True).item()
-                logger.info(f"Loaded centroids for {len(self.centroids)} classes.")
+                legacy = np.load(centroids_path, allow_pickle=True).item()
+                names = list(legacy)
+                self._set_centroids(ClassCentroids(
+                    np.stack([legacy[n] for n in names]).astype(np.float32), names,
+                    counts=np.ones(len(names), dtype=np.int64),
+                ))
+                logger.info(f"Loaded legacy centroids for {len(names)} classes.")
             except Exception as e:
                 logger.warning(f"Failed to load centroids: {e}. 'Similar' feature will be unavailable.")
         else:
             logger.warning("Centroids file not found. 'Similar' feature will be unavailable.")
 
+    def set_resources(self, centroids=None, graph=None):
+        """Uses centroids / graph loaded elsewhere (e.g. from a serving bundle)."""
+        self.graph = graph
+        if centroids is not None:
+            self._set_centroids(centroids)
+
+    def _set_centroids(self, centroids):
+        self.centroids = centroids
+        self._class_to_id = {name: i for i, name in enumerate(centroids.class_names) if centroids.counts[i] > 0}
+
     def get_similar_dishes(self, current_dish: str, k=3) -> List[str]:
         """
         Returns k similar dishes based on embedding distance.
+        Served from the precomputed graph; without one (or for k above its
+        stored top-k) it is one matrix-vector product over the centroid matrix.
         """
-        if not self.centroids or current_dish not in self.centroids:
+        if self.graph is not None:
+            similar = self.graph.similar(current_dish, k)
+            if similar is not None:
+                return similar
+
+        i = self._class_to_id.get(current_dish)
+        if i is None:
             return []
-            
-        query_vec = self.centroids[current_dish]
-        scores = []
-        
-        for other, vec in self.centroids.items():
-            if other == current_dish:
-                continue
-            # Cosine sim (vectors are normalized)
-            sim = np.dot(query_vec, vec)
-            scores.append((other, sim))
-            
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return [x[0] for x in scores[:k]]
+        ids, _ = top_k_similar(
+            self.centroids.matrix, self.centroids.matrix[i:i + 1], k,
+            exclude=np.array([i]), valid=np.asarray(self.centroids.counts) > 0,
+        )
+        return [self.centroids.class_names[j] for j in ids[0] if j >= 0]
 
     def get_group_dishes(self, current_dish: str, k=5) -> List[str]:
         """
         Returns dishes in the same group.
         """
+        if self.graph is not None:
+            return self.graph.group_dishes(current_dish, k)
+
         group = self.groups.get(current_dish)
         if not group:
             return []
@@ -94,6 +144,8 @@ class RelatedEngine:
         return same_group[:k]
         
     def get_group_name(self, dish_name: str) -> str:
+        if self.graph is not None:
+            return self.graph.group_name(dish_name) or "Khác"
         return self.groups.get(dish_name, "Khác")
 
 class SessionManager:
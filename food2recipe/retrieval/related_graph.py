@@ -0,0 +1,171 @@
+# File: food2recipe/retrieval/related_graph.py
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.preprocessing.text_preprocess import normalize_food_name
+
+logger = setup_logger("related_graph")
+
+RELATED_FILE = "related_graph.npz"
+
+
+def top_k_similar(matrix: np.ndarray, queries: np.ndarray, k: int, exclude=None, valid=None):
+    """
+    Cosine top-k of each query row against matrix rows (both normalized), one matmul.
+    exclude: (B,) row of matrix to skip per query (the class itself), or None.
+    valid: (C,) bool mask of usable rows (classes without images have no centroid).
+    Returns (ids (B, k) int32 padded with -1, scores (B, k) float32).
+    """
+    sims = np.asarray(queries, dtype=np.float32) @ np.asarray(matrix, dtype=np.float32).T
+    if valid is not None:
+        sims[:, ~valid] = -np.inf
+    if exclude is not None:
+        sims[np.arange(len(sims)), exclude] = -np.inf
+
+    k_eff = min(k, sims.shape[1])
+    ids = np.full((len(sims), k), -1, dtype=np.int32)
+    scores = np.full((len(sims), k), -np.inf, dtype=np.float32)
+    if k_eff == 0:
+        return ids, scores
+    part = np.argpartition(-sims, k_eff - 1, axis=1)[:, :k_eff]
+    part_scores = np.take_along_axis(sims, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    top = np.take_along_axis(part, order, axis=1)
+    top_scores = np.take_along_axis(part_scores, order, axis=1)
+    found = np.isfinite(top_scores)
+    ids[:, :k_eff] = np.where(found, top, -1)
+    scores[:, :k_eff] = top_scores
+    return ids, scores
+
+
+class RelatedGraph:
+    """
+    Precomputed related-dish lookups, built alongside the index:
+    top-k similar classes per class, and group membership in CSR form.
+    All lookups are a dict hit plus an array slice, whatever the class count.
+    """
+
+    def __init__(self, names, neighbors, neighbor_scores, group_ids, group_names,
+                 group_offsets, group_members, build_id=""):
+        self.names = list(names)
+        self.neighbors = neighbors
+        self.neighbor_scores = neighbor_scores
+        self.group_ids = group_ids
+        self.group_names = list(group_names)
+        self.group_offsets = group_offsets
+        self.group_members = group_members
+        self.build_id = build_id
+        self.name_to_id = {name: i for i, name in enumerate(self.names)}
+
+    @property
+    def k(self) -> int:
+        return self.neighbors.shape[1]
+
+    @classmethod
+    def build(cls, centroids, groups: Dict[str, str], k: int = 10, block_size: int = 4096) -> "RelatedGraph":
+        """
+        centroids: ClassCentroids of the index build.
+        groups: {dish name: group name}; names are normalized like the index class keys.
+        """
+        names = list(centroids.class_names)
+        num_classes = len(names)
+        matrix = np.asarray(centroids.matrix, dtype=np.float32)
+        valid = np.asarray(centroids.counts) > 0
+
+        neighbors = np.full((num_classes, k), -1, dtype=np.int32)
+        scores = np.full((num_classes, k), -np.inf, dtype=np.float32)
+        for start in range(0, num_classes, block_size):
+            rows = np.arange(start, min(start + block_size, num_classes))
+            neighbors[rows], scores[rows] = top_k_similar(matrix, matrix[rows], k, exclude=rows, valid=valid)
+        neighbors[~valid] = -1
+
+        # Group tables. Dishes that only exist in the group map get a name entry
+        # (no centroid, so never a neighbour) so their group still resolves.
+        name_to_id = {name: i for i, name in enumerate(names)}
+        group_names, members = [], {}
+        for dish, group in groups.items():
+            key = normalize_food_name(dish)
+            if not key:
+                continue
+            if key not in name_to_id:
+                name_to_id[key] = len(names)
+                names.append(key)
+            if group not in members:
+                group_names.append(group)
+                members[group] = []
+            if name_to_id[key] not in members[group]:
+                members[group].append(name_to_id[key])
+
+        group_ids = np.full(len(names), -1, dtype=np.int32)
+        group_offsets = np.zeros(len(group_names) + 1, dtype=np.int64)
+        flat = []
+        for g, group in enumerate(group_names):
+            group_ids[members[group]] = g
+            flat.extend(members[group])
+            group_offsets[g + 1] = len(flat)
+
+        # Extra names have no neighbours
+        pad = len(names) - num_classes
+        if pad:
+            neighbors = np.vstack([neighbors, np.full((pad, k), -1, dtype=np.int32)])
+            scores = np.vstack([scores, np.full((pad, k), -np.inf, dtype=np.float32)])
+
+        return cls(names, neighbors, scores, group_ids, group_names, group_offsets,
+                   np.asarray(flat, dtype=np.int32), build_id=centroids.build_id)
+
+    def similar(self, name: str, k: int) -> Optional[List[str]]:
+        """k most similar dishes, or None when the graph cannot answer (unknown name, k > stored)."""
+        i = self.name_to_id.get(name)
+        if i is None or k > self.k:
+            return None
+        return [self.names[j] for j in self.neighbors[i, :k] if j >= 0]
+
+    def group_dishes(self, name: str, k: int) -> List[str]:
+        i = self.name_to_id.get(name)
+        if i is None or self.group_ids[i] < 0:
+            return []
+        g = self.group_ids[i]
+        ids = self.group_members[self.group_offsets[g]:self.group_offsets[g + 1]]
+        return [self.names[j] for j in ids if j != i][:k]
+
+    def group_name(self, name: str) -> Optional[str]:
+        i = self.name_to_id.get(name)
+        if i is None or self.group_ids[i] < 0:
+            return None
+        return self.group_names[self.group_ids[i]]
+
+    def save(self, folder: Path):
+        np.savez(
+            Path(folder) / RELATED_FILE,
+            names=np.array(self.names, dtype=str),
+            neighbors=self.neighbors,
+            neighbor_scores=self.neighbor_scores,
+            group_ids=self.group_ids,
+            group_names=np.array(self.group_names, dtype=str),
+            group_offsets=self.group_offsets,
+            group_members=self.group_members,
+            build_id=np.array(self.build_id),
+        )
+        logger.info(f"Saved related-dish graph ({len(self.names)} dishes, k={self.k}, {len(self.group_names)} groups)")
+
+    @classmethod
+    def load(cls, folder: Path, build_id: Optional[str] = None) -> "RelatedGraph":
+        """Raises FileNotFoundError if absent, ValueError if it belongs to another index build."""
+        path = Path(folder) / RELATED_FILE
+        if not path.exists():
+            raise FileNotFoundError(f"No related-dish graph at {folder}")
+        with np.load(path, allow_pickle=False) as data:
+            graph = cls(
+                names=data["names"].tolist(),
+                neighbors=data["neighbors"],
+                neighbor_scores=data["neighbor_scores"],
+                group_ids=data["group_ids"],
+                group_names=data["group_names"].tolist(),
+                group_offsets=data["group_offsets"],
+                group_members=data["group_members"],
+                build_id=str(data["build_id"]),
+            )
+        if build_id and graph.build_id != build_id:
+            raise ValueError(f"Related-dish graph is from build {graph.build_id}, index is {build_id}")
+        return graph
@@ -0,0 +1,111 @@
+# File: food2recipe/scripts/bench_imports.py
+import os
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("bench_imports")
+
+# Serving entry points that should import without the heavy stack
+DEFAULT_MODULES = ("food2recipe.retrieval.recommender", "food2recipe.serving.inference_server")
+# Deferred until first use (encode, CSV parse, FAISS search); importing them up front is a regression
+HEAVY_MODULES = ("torch", "torchvision", "open_clip", "timm", "onnxruntime", "faiss", "pandas", "sklearn")
+
+
+def parse_importtime(stderr: str):
+    """
+    Parses `python -X importtime` output.
+    Returns [(module, depth, self_us, cumulative_us)] in report order (children before parents).
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def measure_import(module: str):
+    """Imports module in a fresh interpreter. Returns (total ms, importtime rows)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=os.environ.copy(),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    rows = parse_importtime(result.stderr)
+    # Interpreter startup ends with site; the top-level entries after it are what the import pulled in
+    names = [name for name, _, _, _ in rows]
+    rows = rows[names.index("site") + 1:] if "site" in names else rows
+    total_us = sum(cumulative for _, depth, _, cumulative in rows if depth == 0)
+    return total_us / 1000.0, rows
+
+
+def heavy_imports(rows):
+    """Heavy top-level packages that were imported."""
+    loaded = {name.split(".")[0] for name, _, _, _ in rows}
+    return [m for m in HEAVY_MODULES if m in loaded]
+
+
+def slowest_packages(rows, n=10):
+    """Top-level packages by cumulative import time (ms)."""
+    totals = {}
+    for name, _, _, cumulative in rows:
+        top = name.split(".")[0]
+        if name == top:
+            totals[top] = max(totals.get(top, 0), cumulative)
+    return sorted(((name, us / 1000.0) for name, us in totals.items()), key=lambda x: -x[1])[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time benchmark of the serving entry points (python -X importtime).")
+    parser.add_argument("--modules", nargs="+", default=list(DEFAULT_MODULES))
+    parser.add_argument("--repeats", type=int, default=5, help="Fresh interpreters per module (median is reported)")
+    parser.add_argument("--budget-ms", type=float, default=0.0, help="Fail if a median import exceeds this (0 = off)")
+    args = parser.parse_args()
+
+    settings = load_settings()
+    failed = False
+    records = []
+    for module in args.modules:
+        runs = [measure_import(module) for _ in range(max(1, args.repeats))]
+        median_ms = statistics.median(ms for ms, _ in runs)
+        rows = runs[-1][1]
+        heavy = heavy_imports(rows)
+        logger.info(f"{module}: {median_ms:.0f} ms (median of {len(runs)})")
+        for name, ms in slowest_packages(rows, 5):
+            logger.info(f"    {name:<28} {ms:8.1f} ms")
+        if heavy:
+            logger.error(f"{module} imports {', '.join(heavy)} eagerly")
+            failed = True
+        if args.budget_ms > 0 and median_ms > args.budget_ms:
+            logger.error(f"{module} takes {median_ms:.0f} ms, budget is {args.budget_ms:.0f} ms")
+            failed = True
+        records.append((module, median_ms, heavy))
+
+    # Appended, so regressions show up as a step in the history
+    out_path = settings.REPORTS_DIR / "import_time.csv"
+    # PROFILE=serving does not create REPORTS_DIR
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    new_file = not out_path.exists()
+    with open(out_path, "a", encoding="utf-8") as f:
+        if new_file:
+            f.write("timestamp,python,module,median_ms,heavy_imports\n")
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+        python = ".".join(map(str, sys.version_info[:3]))
+        for module, median_ms, heavy in records:
+            f.write(f"{stamp},{python},{module},{median_ms:.1f},{' '.join(heavy)}\n")
+    logger.info(f"Appended to {out_path}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# File: food2recipe/scripts/bench_index.py
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.models.embedding_store import load_store
+from food2recipe.retrieval.index_faiss import RetrievalIndex, INDEX_TYPES
+from food2recipe.retrieval.index_versions import resolve_index_dir
+
+logger = setup_logger("bench_index")
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """Fraction of the exact top-k neighbours that the approximate search returned."""
+    hits = sum(len(np.intersect1d(f, t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def bench_backend(settings, index_type, base, queries, truth, k):
+    settings = settings.model_copy(update={"INDEX_TYPE": index_type, "USE_FAISS": True})
+    index = RetrievalIndex(settings)
+
+    t0 = time.perf_counter()
+    index.build(base, [{"image_path": "", "food_name": "", "split": ""}] * len(base))
+    build_s = time.perf_counter() - t0
+
+    # Single-query latency (what one upload pays)
+    latencies = []
+    for q in queries:
+        t0 = time.perf_counter()
+        index.search_batch(q[None, :], k)
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+
+    # Batched throughput
+    t0 = time.perf_counter()
+    _, found = index.search_batch(queries, k)
+    batch_s = time.perf_counter() - t0
+
+    import faiss
+    return {
+        "backend": index_type,
+        f"recall@{k}": recall_at_k(found, truth),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "batch_qps": len(queries) / batch_s if batch_s > 0 else float("inf"),
+        "build_s": build_s,
+        "index_mb": len(faiss.serialize_index(index.index)) / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FAISS index backends against the flat index.")
+    parser.add_argument("--backends", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--k", type=int, default=None, help="Defaults to TOP_K")
+    parser.add_argument("--queries", type=int, default=500, help="Held-out vectors used as queries")
+    args = parser.parse_args()
+
+    settings = load_settings()
+    k = args.k or settings.TOP_K
+
+    embeddings, _, header = load_store(resolve_index_dir(settings))
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    logger.info(f"Loaded {len(embeddings)} vectors (dim={header['dim']}) from build {header['build_id']}")
+
+    # Hold out queries so they are not trivially their own nearest neighbour
+    rng = np.random.default_rng(0)
+    perm = rng.permutation(len(embeddings))
+    num_queries = min(args.queries, len(embeddings) // 5)
+    queries, base = embeddings[perm[:num_queries]], embeddings[perm[num_queries:]]
+
+    # Ground truth from exact search
+    flat = RetrievalIndex(settings.model_copy(update={"INDEX_TYPE": "flat", "USE_FAISS": True}))
+    flat.build(base, [{"image_path": "", "food_name": "", "split": ""}] * len(base))
+    _, truth = flat.search_batch(queries, k)
+
+    rows = []
+    for index_type in args.backends:
+        try:
+            rows.append(bench_backend(settings, index_type, base, queries, truth, k))
+        except Exception as e:
+            logger.warning(f"Skipping {index_type}: {e}")
+
+    df = pd.DataFrame(rows)
+    logger.info(f"Index backends vs flat ({len(base)} vectors, {num_queries} queries, "
+                f"nprobe={settings.NPROBE}, efSearch={settings.EF_SEARCH}):\n{df.to_string(index=False)}")
+
+    out_path = settings.REPORTS_DIR / "index_benchmark.csv"
+    df.to_csv(out_path, index=False)
+    logger.info(f"Saved benchmark to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
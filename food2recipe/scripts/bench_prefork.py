@@ -0,0 +1,144 @@
+# File: food2recipe/scripts/bench_prefork.py
+import io
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.serving.client import InferenceClient
+from food2recipe.serving.prefork import process_memory
+
+logger = setup_logger("bench_prefork")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _children(pid: int):
+    """PIDs whose parent is pid."""
+    found = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Field 4 is the ppid; the command name (field 2) may contain spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            found.append(int(entry))
+    return sorted(found)
+
+
+def _sample_images(n, size=256, seed=0):
+    """Random JPEGs: the benchmark needs traffic, not a dataset."""
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(n):
+        buf = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(buf, format="JPEG")
+        images.append(buf.getvalue())
+    return images
+
+
+def run_server(workers, images, startup_timeout):
+    """
+    Starts the inference server with SERVER_WORKERS=workers, sends it traffic
+    so every process has run the model, and returns [(role, pid, memory)].
+    """
+    port = _free_port()
+    env = {**os.environ, "SERVER_WORKERS": str(workers), "SERVER_HOST": "127.0.0.1", "SERVER_PORT": str(port)}
+    proc = subprocess.Popen([sys.executable, "-m", "food2recipe.serving.inference_server"], env=env)
+    client = InferenceClient(f"http://127.0.0.1:{port}", timeout=startup_timeout)
+    try:
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"Server exited with status {proc.returncode}")
+            try:
+                client.health()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Server not up after {startup_timeout:.0f}s")
+                time.sleep(0.5)
+
+        # Concurrent traffic so the requests spread over the workers
+        with ThreadPoolExecutor(max(1, workers) * 2) as pool:
+            list(pool.map(client.predict, images))
+        time.sleep(0.5)
+
+        rows = [("parent" if workers > 1 else "single", proc.pid, process_memory(proc.pid))]
+        rows += [("worker", pid, process_memory(pid)) for pid in _children(proc.pid)] if workers > 1 else []
+        return rows
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per worker of the pre-fork server vs independent processes.")
+    parser.add_argument("--workers", type=int, default=None, help="Defaults to SERVER_WORKERS (at least 2)")
+    parser.add_argument("--requests", type=int, default=64, help="Warm-up requests sent to each server")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        logger.error("Needs Linux /proc/<pid>/smaps_rollup.")
+        sys.exit(1)
+
+    settings = load_settings()
+    workers = args.workers or max(2, settings.SERVER_WORKERS)
+    images = _sample_images(args.requests)
+
+    single = run_server(1, images, args.startup_timeout)
+    prefork = run_server(workers, images, args.startup_timeout)
+    rows = single + prefork
+
+    logger.info(f"{'role':<8} {'pid':>8} {'RSS MB':>9} {'PSS MB':>9} {'shared MB':>10} {'private MB':>11}")
+    for role, pid, mem in rows:
+        shared = mem["Shared_Clean"] + mem["Shared_Dirty"]
+        private = mem["Private_Clean"] + mem["Private_Dirty"]
+        logger.info(f"{role:<8} {pid:>8} {mem['Rss']:9.1f} {mem['Pss']:9.1f} {shared:10.1f} {private:11.1f}")
+
+    # N independent servers share library text (the single process' shared pages) but nothing they loaded
+    single_mem = single[0][2]
+    independent = (single_mem["Shared_Clean"] + single_mem["Shared_Dirty"]
+                   + workers * (single_mem["Private_Clean"] + single_mem["Private_Dirty"]))
+    worker_mems = [mem for role, _, mem in prefork if role == "worker"]
+    if len(worker_mems) != workers:
+        logger.warning(f"Found {len(worker_mems)} workers, expected {workers}")
+    total_pss = sum(mem["Pss"] for _, _, mem in prefork)
+    per_worker_private = sum(m["Private_Clean"] + m["Private_Dirty"] for m in worker_mems) / max(1, len(worker_mems))
+    logger.info(f"{workers} independent processes: ~{independent:.0f} MB (shared pages + {workers} x private of one)")
+    logger.info(f"Pre-fork parent + {len(worker_mems)} workers: {total_pss:.0f} MB (sum of PSS); "
+                f"each worker adds {per_worker_private:.0f} MB private")
+
+    # Appended, so the effect of model / index changes shows up in the history
+    out_path = settings.REPORTS_DIR / "prefork_memory.csv"
+    # PROFILE=serving does not create REPORTS_DIR
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    new_file = not out_path.exists()
+    with open(out_path, "a", encoding="utf-8") as f:
+        if new_file:
+            f.write("timestamp,workers,role,pid,rss_mb,pss_mb,shared_mb,private_mb\n")
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+        for role, pid, mem in rows:
+            shared = mem["Shared_Clean"] + mem["Shared_Dirty"]
+            private = mem["Private_Clean"] + mem["Private_Dirty"]
+            f.write(f"{stamp},{workers},{role},{pid},{mem['Rss']:.1f},{mem['Pss']:.1f},{shared:.1f},{private:.1f}\n")
+    logger.info(f"Appended to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
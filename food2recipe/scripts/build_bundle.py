@@ -0,0 +1,99 @@
+# File: food2recipe/scripts/build_bundle.py
+import sys
+import time
+import argparse
+from pathlib import Path
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.retrieval.index_faiss import RetrievalIndex
+from food2recipe.retrieval.centroids import ClassCentroids
+from food2recipe.retrieval.related_graph import RelatedGraph
+from food2recipe.retrieval.linear_probe import LinearProbe
+from food2recipe.retrieval.reduction import PCAReducer
+from food2recipe.retrieval.bundle import BUNDLE_FILE, Bundle, read_toc, write_bundle
+from food2recipe.retrieval.index_versions import add_artifacts, resolve_index_dir
+from food2recipe.preprocessing.text_preprocess import RecipeProcessor
+
+logger = setup_logger("build_bundle")
+
+
+def _optional(load, folder, build_id):
+    """Artifact of this build, or None if absent / stale."""
+    try:
+        return load(folder, build_id=build_id)
+    except (FileNotFoundError, ValueError) as e:
+        logger.info(f"Not bundled: {e}")
+        return None
+
+
+def bundle_index_dir(settings, index_dir: Path, output: Path = None, include_recipes: bool = True) -> Path:
+    """Packs the index build in index_dir (and the processed recipes) into one bundle file."""
+    index = RetrievalIndex(settings)
+    index.load(index_dir)
+    recipes = None
+    if include_recipes:
+        try:
+            processor = RecipeProcessor(settings)
+            processor.load_and_process()
+            recipes = processor.recipes_data
+        except FileNotFoundError as e:
+            logger.warning(f"Bundling without recipes ({e}); serving will read the CSV.")
+
+    output = Path(output) if output else index_dir / BUNDLE_FILE
+    write_bundle(
+        output, index,
+        centroids=_optional(ClassCentroids.load, index_dir, index.build_id),
+        graph=_optional(RelatedGraph.load, index_dir, index.build_id),
+        linear_probe=_optional(LinearProbe.load, index_dir, index.build_id),
+        reducer=PCAReducer.load(index_dir, build_id=index.build_id),
+        recipes=recipes,
+    )
+    return output
+
+
+def refresh_bundle(settings, index_dir: Path) -> bool:
+    """
+    Repacks the bundle.f2r of index_dir, if there is one, after a tool added
+    artifacts (probe, centroids, graph) to the folder: serving reads only the
+    bundle, so it would otherwise keep the old ones. Recipes stay in or out
+    as they were. Returns whether a bundle was rewritten.
+    """
+    path = Path(index_dir) / BUNDLE_FILE
+    if not path.exists():
+        return False
+    bundle_index_dir(settings, Path(index_dir), include_recipes="recipes" in read_toc(path)["sections"])
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the current index version into one memory-mappable bundle.")
+    parser.add_argument("--output", type=Path, default=None,
+                        help=f"Bundle path (default: {BUNDLE_FILE} inside the index version)")
+    parser.add_argument("--no-recipes", action="store_true", help="Leave the recipes out (served from the CSV)")
+    args = parser.parse_args()
+
+    settings = load_settings()
+    index_dir = resolve_index_dir(settings)
+    try:
+        if args.output:
+            output = bundle_index_dir(settings, index_dir, args.output, include_recipes=not args.no_recipes)
+        else:
+            # Inside the index: published as a new version next to the served one
+            folder = add_artifacts(settings, index_dir, lambda d: None,
+                                   finalize=lambda d: bundle_index_dir(settings, d, include_recipes=not args.no_recipes))
+            output = folder / BUNDLE_FILE
+    except FileNotFoundError:
+        logger.error("Index not found. Please run 'python -m food2recipe.scripts.build_index' first.")
+        sys.exit(1)
+
+    # Cold-start check: what a fresh replica pays before it can search (model weights excluded)
+    start = time.perf_counter()
+    bundle = Bundle(output)
+    index = RetrievalIndex(settings).load_bundle(bundle)
+    bundle.centroids(), bundle.related_graph(), bundle.linear_probe(), bundle.reducer(), bundle.recipes()
+    index.search_batch(index.embeddings[:1], k=settings.TOP_K)
+    logger.info(f"Bundle opened and searched in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
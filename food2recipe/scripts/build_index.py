@@ -1,42 +1,353 @@
 # File: food2recipe/scripts/build_index.py
+import os
 import sys
+import json
+import time
+import shutil
+import hashlib
+import multiprocessing
 import torch
 import pandas as pd
 import numpy as np
+from pathlib import Path
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 from torch.utils.data import DataLoader, Dataset
 from food2recipe.core.settings import load_settings
 from food2recipe.core.logging_utils import setup_logger
 from food2recipe.preprocessing.build_manifest import build_manifest
 from food2recipe.models.image_encoder import ImageEncoder
-from food2recipe.retrieval.index_faiss import RetrievalIndex
-from food2recipe.preprocessing.image_preprocess import get_transforms, load_and_transform_image
-from PIL import Image
+from food2recipe.models.embedding_cache import EmbeddingCache
+from food2recipe.models.embedding_store import StoreWriter
+from food2recipe.retrieval.index_faiss import RetrievalIndex, NumpyIndex
+from food2recipe.retrieval.reduction import PCAReducer
+from food2recipe.retrieval.index_versions import new_staging_dir, publish
+from food2recipe.retrieval.centroids import ClassCentroids
+from food2recipe.retrieval.related_graph import RelatedGraph
+from food2recipe.retrieval.related_engine import DISH_GROUPS
+from food2recipe.scripts.build_bundle import bundle_index_dir
+from food2recipe.preprocessing.image_preprocess import (
+    get_transforms, get_uint8_transform, load_and_transform_image, normalize_batch
+)
+from food2recipe.preprocessing.pixel_shards import PixelShardStore
+from food2recipe.scripts.bench_index import recall_at_k
 
 logger = setup_logger("build_index")
 
 class ImageDataset(Dataset):
-    def __init__(self, image_paths, transform):
+    def __init__(self, image_paths, transform, max_pixels=0, pixel_store=None):
         self.image_paths = image_paths
         self.transform = transform
+        self.max_pixels = max_pixels
+        # Optional PixelShardStore: stored crops skip the JPEG decode entirely
+        self.pixel_store = pixel_store
     
     def __len__(self):
         return len(self.image_paths)
     
     def __getitem__(self, idx):
         path = self.image_paths[idx]
+        t0 = time.perf_counter()
+        if self.pixel_store is not None:
+            tensor = self.pixel_store.get(path)
+            if tensor is not None:
+                return tensor, str(path), time.perf_counter() - t0
         try:
-            # We use a helper from image_preprocess to ensure consistency
-            # But standard Dataset needs to return tensors directly
-            # Re-implementing simplified load here for speed
-            image = Image.open(path).convert("RGB")
-            return self.transform(image), str(path)
+            tensor = load_and_transform_image(path, self.transform, self.max_pixels)
         except Exception as e:
-            # Return dummy or handle error? For index build, skipping is safer but complicated In batch
-            # We'll just return zeros and filter later? 
-            # Better: The manifest building step should have vetted files, but let's be safe.
-            print(f"Error loading {path}: {e}")
-            return torch.zeros((3, 224, 224)), ""
+            # The manifest step does not vet files, so skip unreadable ones.
+            # Returning None lets collate_skip_failed drop them, which also works with workers > 0.
+            logger.warning(f"Error loading {path}: {e}")
+            return None
+        return tensor, str(path), time.perf_counter() - t0
+
+
+def collate_skip_failed(batch):
+    """
+    Collate that drops failed samples (None).
+    Returns (images, paths, decode_seconds) or None if the whole batch failed.
+    """
+    batch = [b for b in batch if b is not None]
+    if not batch:
+        return None
+    imgs, paths, decode_times = zip(*batch)
+    return torch.stack(imgs), list(paths), float(sum(decode_times))
+
+
+def make_dataloader(image_paths, transform, settings, pixel_store=None):
+    """
+    Multi-worker decode pipeline: workers decode/resize ahead of the encoder
+    (prefetch_factor batches each) into pinned buffers when encoding on GPU.
+    """
+    num_workers = max(0, settings.BUILD_NUM_WORKERS)
+    kwargs = {}
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = settings.BUILD_PREFETCH_FACTOR
+    return DataLoader(
+        ImageDataset(image_paths, transform, settings.MAX_IMAGE_PIXELS, pixel_store),
+        batch_size=settings.BUILD_BATCH_SIZE,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=collate_skip_failed,
+        pin_memory=torch.cuda.is_available() and settings.DEVICE != "cpu",
+        **kwargs,
+    )
+
+
+def log_throughput_report(num_images, decode_seconds, num_workers, stall_seconds, encode_seconds):
+    """
+    Per-stage throughput, to see whether decode or encode is the bottleneck.
+    decode_seconds is summed over samples, so the pipeline's decode capacity
+    is spread over the worker processes.
+    """
+    parallelism = max(1, num_workers)
+    decode_rate = num_images / (decode_seconds / parallelism) if decode_seconds > 0 else float("inf")
+    encode_rate = num_images / encode_seconds if encode_seconds > 0 else float("inf")
+    bottleneck = "decode" if decode_rate < encode_rate else "encode"
+
+    logger.info("Throughput report:")
+    logger.info(f"  decode : {decode_rate:8.1f} img/s ({num_workers} workers, {decode_seconds:.1f}s total CPU)")
+    logger.info(f"  encode : {encode_rate:8.1f} img/s ({encode_seconds:.1f}s)")
+    logger.info(f"  encoder waited on decode for {stall_seconds:.1f}s -> bottleneck: {bottleneck}")
+
+
+def encode_paths(image_paths, encoder, transform, settings, pixel_store=None):
+    """
+    Encodes images through the decode pipeline.
+    Returns (embeddings (N, D) or None, encoded_paths); unreadable files are skipped.
+    With a pixel_store, transform must produce uint8 crops (get_uint8_transform).
+    """
+    dataloader = make_dataloader(image_paths, transform, settings, pixel_store)
+    
+    all_embeddings = []
+    valid_paths = []
+    decode_seconds = stall_seconds = encode_seconds = 0.0
+    
+    logger.info(f"Encoding {len(image_paths)} images (batch_size={settings.BUILD_BATCH_SIZE}, workers={settings.BUILD_NUM_WORKERS})...")
+    t_wait = time.perf_counter()
+    for batch in tqdm(dataloader):
+        # Time spent blocked on the loader = encoder starved by decode
+        stall_seconds += time.perf_counter() - t_wait
+
+        # Whole batch failed to load
+        if batch is not None:
+            imgs, paths, batch_decode_seconds = batch
+            decode_seconds += batch_decode_seconds
+
+            t0 = time.perf_counter()
+            # fast preprocessing ships uint8 batches from the workers, normalized here
+            embeddings = encoder.encode(normalize_batch(imgs))
+            encode_seconds += time.perf_counter() - t0
+
+            all_embeddings.append(embeddings.numpy())
+            valid_paths.extend(paths)
+
+        t_wait = time.perf_counter()
+        
+    if not all_embeddings:
+        return None, []
+
+    log_throughput_report(len(valid_paths), decode_seconds, settings.BUILD_NUM_WORKERS, stall_seconds, encode_seconds)
+    return np.vstack(all_embeddings), valid_paths
+
+
+def make_encode_transform(settings):
+    """Returns (transform, pixel_store) for the build's decode pipeline."""
+    if settings.PIXEL_SHARDS:
+        # Decoded misses must match the stored uint8 crops so batches stack
+        return get_uint8_transform(settings.IMAGE_SIZE, settings.PREPROCESS_MODE), PixelShardStore(settings).load()
+    transform = get_transforms(mode="train", image_size=settings.IMAGE_SIZE, preprocess_mode=settings.PREPROCESS_MODE)
+    return transform, None
+
+
+# --- Process-pool encoding (BUILD_ENCODE_WORKERS > 0) ---
+
+# Per-process state of a pool worker, set up once by _init_encode_worker
+_worker = {}
+
+
+def _init_encode_worker(settings):
+    _worker["settings"] = settings
+    _worker["encoder"] = ImageEncoder(settings)
+    _worker["transform"], _worker["pixel_store"] = make_encode_transform(settings)
+
+
+def _encode_shard(shard_id, paths, out_dir):
+    """Encodes one shard in a pool worker and writes shard_<id>.npy / .json to out_dir."""
+    t0 = time.perf_counter()
+    embeddings, encoded_paths = encode_paths(
+        paths, _worker["encoder"], _worker["transform"], _worker["settings"], _worker["pixel_store"]
+    )
+    stem = out_dir / f"shard_{shard_id:05d}"
+    if embeddings is not None:
+        np.save(stem.with_suffix(".npy"), embeddings)
+    with open(stem.with_suffix(".json"), "w", encoding="utf-8") as f:
+        json.dump(encoded_paths, f, ensure_ascii=False)
+    return shard_id, os.getpid(), len(encoded_paths), time.perf_counter() - t0
+
+
+class ShardedEncoder:
+    """
+    Encodes across BUILD_ENCODE_WORKERS processes, each with its own encoder and
+    BUILD_THREADS_PER_WORKER torch threads (one process with default threading
+    stops scaling after a handful of cores).
+
+    Shards are cut on BUILD_BATCH_SIZE boundaries, so every forward pass sees
+    the same batch whatever the worker count, and shard files are merged in
+    shard (= manifest) order: the output is byte-identical for any number of
+    workers with the same threads per worker. initializer(settings) sets up
+    each worker (_worker: encoder, transform, pixel store).
+    """
+
+    def __init__(self, settings, work_dir, initializer=None):
+        self.num_workers = settings.BUILD_ENCODE_WORKERS
+        self.batch_size = settings.BUILD_BATCH_SIZE
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        worker_settings = settings.model_copy(update={
+            "TORCH_NUM_THREADS": settings.BUILD_THREADS_PER_WORKER,
+            "TORCH_NUM_INTEROP_THREADS": 1,
+            # Workers decode their own shard; nested DataLoader processes would oversubscribe
+            "BUILD_NUM_WORKERS": 0,
+        })
+        # spawn: forking a process that already initialized torch/OpenMP can deadlock
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initializer or _init_encode_worker,
+            initargs=(worker_settings,),
+        )
+        self.worker_stats = {}  # pid -> [images, seconds]
+        logger.info(f"Encoding with {self.num_workers} processes x {settings.BUILD_THREADS_PER_WORKER} threads.")
+
+    def encode(self, paths):
+        """Same contract as encode_paths: (embeddings (N, D) or None, encoded_paths)."""
+        num_batches = -(-len(paths) // self.batch_size)
+        shard_len = -(-num_batches // self.num_workers) * self.batch_size
+        futures = [
+            self.pool.submit(_encode_shard, shard_id, paths[start:start + shard_len], self.work_dir)
+            for shard_id, start in enumerate(range(0, len(paths), shard_len))
+        ]
+
+        all_embeddings, all_paths = [], []
+        for future in futures:
+            shard_id, pid, count, seconds = future.result()
+            stats = self.worker_stats.setdefault(pid, [0, 0.0])
+            stats[0] += count
+            stats[1] += seconds
+
+            stem = self.work_dir / f"shard_{shard_id:05d}"
+            with open(stem.with_suffix(".json"), "r", encoding="utf-8") as f:
+                shard_paths = json.load(f)
+            if shard_paths:
+                all_embeddings.append(np.load(stem.with_suffix(".npy")))
+                stem.with_suffix(".npy").unlink()
+            stem.with_suffix(".json").unlink()
+            all_paths.extend(shard_paths)
+
+        if not all_embeddings:
+            return None, []
+        return np.vstack(all_embeddings), all_paths
+
+    def report(self):
+        logger.info("Per-worker throughput:")
+        for i, (pid, (count, seconds)) in enumerate(sorted(self.worker_stats.items())):
+            rate = count / seconds if seconds > 0 else 0.0
+            logger.info(f"  worker {i} (pid {pid}): {count} images, {rate:8.1f} img/s")
+        total = sum(c for c, _ in self.worker_stats.values())
+        busiest = max((t for _, t in self.worker_stats.values()), default=0.0)
+        if busiest > 0:
+            logger.info(f"  aggregate: ~{total / busiest:.1f} img/s")
+
+    def close(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+# PCA dimensions compared in the build's reduction trade-off report (plus REDUCE_DIM)
+REDUCTION_LADDER = (32, 64, 128, 256, 512)
+
+
+def reduction_tradeoff(embeddings, label_ids, reducer, dims, settings, num_queries=500):
+    """
+    Per PCA dimension: recall@TOP_K of the reduced-space neighbours against the
+    exact full-dimension ones, and 1-NN label accuracy, for held-out queries
+    over a sample of at most INDEX_TRAIN_SAMPLE vectors.
+    """
+    k = settings.TOP_K
+    n = len(embeddings)
+    rng = np.random.default_rng(0)
+    perm = rng.permutation(n)
+    nq = min(num_queries, n // 5)
+    if nq == 0:
+        return pd.DataFrame()
+    q_ids = np.sort(perm[:nq])
+    base_ids = np.sort(perm[nq:nq + settings.INDEX_TRAIN_SAMPLE])
+    queries = np.asarray(embeddings[q_ids], dtype=np.float32)
+    base = np.asarray(embeddings[base_ids], dtype=np.float32)
+    label_ids = np.asarray(label_ids)
+
+    def search(base_vecs, query_vecs):
+        return NumpyIndex.from_embeddings(base_vecs, "float32", settings.NUMPY_SEARCH_BLOCK).search(query_vecs, k)[1]
+
+    def row(dim, found, truth, explained):
+        return {
+            "dim": dim,
+            f"recall@{k}": recall_at_k(found, truth),
+            "nn_accuracy": float(np.mean(label_ids[base_ids[found[:, 0]]] == label_ids[q_ids])),
+            "explained_variance": explained,
+            "index_mb": n * dim * 4 / 1e6,
+        }
+
+    truth = search(base, queries)
+    rows = [row(embeddings.shape[1], truth, truth, 1.0)]
+    for dim in dims:
+        r = reducer.truncate(dim)
+        rows.append(row(dim, search(r.transform(base), r.transform(queries)), truth, r.explained_variance))
+    return pd.DataFrame(rows)
+
+
+def reduce_embeddings(writer, label_ids, settings):
+    """
+    Fits the PCA reducer on the staged vectors, logs the dimension trade-off
+    (saved to REPORTS_DIR/reduction_tradeoff.csv) and writes the reduced
+    vectors next to the staging store. Returns (reduced memmap, reducer).
+    """
+    source_dim = writer.embeddings.shape[1]
+    target = min(settings.REDUCE_DIM, source_dim)
+    dims = sorted({d for d in REDUCTION_LADDER if d < source_dim} | {target})
+    full = PCAReducer.fit(writer.embeddings, max(dims), whiten=settings.REDUCE_WHITEN,
+                          sample_size=settings.INDEX_TRAIN_SAMPLE, block_size=settings.NUMPY_SEARCH_BLOCK)
+
+    report = reduction_tradeoff(writer.embeddings, label_ids, full, dims, settings)
+    if not report.empty:
+        logger.info(f"PCA trade-off (whiten={settings.REDUCE_WHITEN}):\n{report.to_string(index=False)}")
+        report.to_csv(settings.REPORTS_DIR / "reduction_tradeoff.csv", index=False)
+
+    reducer = full.truncate(target)
+    reduced = np.lib.format.open_memmap(writer.folder / "reduced.npy", mode="w+", dtype=np.float32,
+                                        shape=(len(writer.embeddings), target))
+    reducer.transform_blocks(writer.embeddings, reduced, settings.NUMPY_SEARCH_BLOCK)
+    reduced.flush()
+    logger.info(f"Reduced {len(reduced)} vectors {source_dim}->{target} ({reducer.explained_variance:.1%} variance).")
+    return reduced, reducer
+
+
+def read_manifest_chunks(manifest_path, splits, chunk_size):
+    """Yields manifest rows of the given splits, chunk_size input rows at a time."""
+    for chunk in pd.read_csv(manifest_path, chunksize=chunk_size, usecols=["image_path", "split", "food_name"]):
+        yield chunk[chunk["split"].isin(splits)]
+
+
+def build_signature(manifest_path, splits, settings):
+    """Identifies a build: same manifest content, splits and embedding model -> resumable."""
+    h = hashlib.sha1()
+    with open(manifest_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(f"{sorted(splits)}|{EmbeddingCache.namespace(settings)}".encode("utf-8"))
+    return h.hexdigest()
+
 
 def main():
     settings = load_settings()
@@ -48,69 +359,131 @@ def main():
     if not manifest_path:
         logger.error("No manifest created. Exiting.")
         sys.exit(1)
-        
-    df = pd.read_csv(manifest_path)
     
     # Filter: Use 'train' and 'val' for index. 'test' is for eval.
     # Configurable?
     index_splits = ['train', 'val']
-    df_index = df[df['split'].isin(index_splits)].copy()
-    
-    logger.info(f"Using {len(df_index)} images from splits {index_splits} for indexing.")
-    
-    # 2. Encoder
-    encoder = ImageEncoder(settings)
-    transform = get_transforms(mode="train", image_size=settings.IMAGE_SIZE)
-    
-    # 3. Batch Process
-    dataset = ImageDataset(df_index['image_path'].tolist(), transform)
-    dataloader = DataLoader(dataset, batch_size=32, shuffle=False, num_workers=0) # workers=0 for compatibility
-    
-    all_embeddings = []
-    valid_paths = []
-    
-    logger.info("Encoding images...")
-    for imgs, paths in tqdm(dataloader):
-        # Filter out failed loads (empty paths)
-        # Note: parallel loading with 0 workers is safe, but with >0 might need robust collate
-        # Simplified:
-        valid_mask = [p != "" for p in paths]
-        if not any(valid_mask):
+    chunk_size = max(1, settings.BUILD_CHUNK_SIZE)
+    total = sum(len(chunk) for chunk in read_manifest_chunks(manifest_path, index_splits, chunk_size))
+    logger.info(f"Using {total} images from splits {index_splits} for indexing.")
+    if total == 0:
+        logger.error("No images to index.")
+        sys.exit(1)
+
+    # 2. Staging store: rows are streamed to disk, a crash resumes from the last chunk
+    writer = StoreWriter(settings.ARTIFACTS_DIR / "index_build", total,
+                         build_signature(manifest_path, index_splits, settings))
+    rows_done = writer.open()
+
+    # Embedding cache: only new/changed files need encoding
+    cache = EmbeddingCache(settings).load() if settings.EMBED_CACHE else None
+    live_keys = set()
+    encoder = transform = pixel_store = sharded = None
+    stats = {"hits": 0, "encoded": 0, "failed": 0, "known_bad": 0}
+
+    offset = 0
+    for chunk in read_manifest_chunks(manifest_path, index_splits, chunk_size):
+        chunk_start, offset = offset, offset + len(chunk)
+        if offset <= rows_done:
+            # Already in the staging store
+            if cache:
+                live_keys.update(cache.file_key(p) for p in chunk["image_path"])
             continue
-            
-        imgs = imgs[valid_mask]
-        current_valid_paths = [p for p, m in zip(paths, valid_mask) if m]
-        
-        embeddings = encoder.encode(imgs)
-        all_embeddings.append(embeddings.numpy())
-        valid_paths.extend(current_valid_paths)
-        
-    if not all_embeddings:
+        chunk = chunk.iloc[max(0, rows_done - chunk_start):]
+        image_paths = chunk["image_path"].tolist()
+
+        path_to_vec = {}
+        to_encode = image_paths
+        if cache:
+            keys = {p: cache.file_key(p) for p in image_paths}
+            live_keys.update(keys.values())
+            for p in image_paths:
+                vec = cache.get(keys[p])
+                if vec is not None:
+                    path_to_vec[p] = vec
+            to_encode = [p for p in image_paths if p not in path_to_vec and not cache.is_failed(keys[p])]
+            stats["hits"] += len(path_to_vec)
+            stats["known_bad"] += len(image_paths) - len(path_to_vec) - len(to_encode)
+
+        # 3. Encode misses
+        if to_encode:
+            if settings.BUILD_ENCODE_WORKERS > 0:
+                if sharded is None:
+                    sharded = ShardedEncoder(settings, settings.ARTIFACTS_DIR / "encode_shards")
+                new_embeddings, encoded_paths = sharded.encode(to_encode)
+            else:
+                if encoder is None:
+                    encoder = ImageEncoder(settings)
+                    transform, pixel_store = make_encode_transform(settings)
+                new_embeddings, encoded_paths = encode_paths(to_encode, encoder, transform, settings, pixel_store)
+            if new_embeddings is not None:
+                path_to_vec.update(zip(encoded_paths, new_embeddings))
+            stats["encoded"] += len(encoded_paths)
+            stats["failed"] += len(to_encode) - len(encoded_paths)
+
+            if cache:
+                for p in to_encode:
+                    if p in path_to_vec:
+                        cache.put(keys[p], path_to_vec[p])
+                    else:
+                        cache.mark_failed(keys[p])
+
+        # 4. Append in manifest order, metadata straight from the manifest columns
+        rows = [r for r in chunk.itertuples(index=False) if r.image_path in path_to_vec]
+        if rows:
+            writer.append(
+                np.stack([path_to_vec[r.image_path] for r in rows]).astype(np.float32),
+                [{"image_path": r.image_path, "food_name": r.food_name, "split": r.split} for r in rows],
+            )
+        writer.checkpoint(offset)
+        logger.info(f"Progress: {offset}/{total} images, {writer.written} embedded.")
+
+    if sharded is not None:
+        sharded.report()
+        sharded.close()
+
+    logger.info(
+        f"Embedding cache: {stats['hits']} hits, {stats['encoded']} encoded, {stats['failed']} failed, "
+        f"{stats['known_bad']} skipped as known-bad."
+    )
+    if cache:
+        cache.prune(live_keys)
+        cache.save()
+
+    if writer.written == 0:
         logger.error("No embeddings generated.")
         sys.exit(1)
         
-    final_embeddings = np.vstack(all_embeddings)
-    
-    # 4. Prepare Metadata
-    # Need to map back path -> food_name
-    # Efficient look up
-    path_to_row = df_index.set_index("image_path").to_dict("index")
-    
-    metadata = []
-    for p in valid_paths:
-        row = path_to_row[p]
-        metadata.append({
-            "image_path": p,
-            "food_name": row["food_name"],
-            "split": row["split"]
-        })
-        
-    # 5. Build & Save Index
+    # 5. Optional PCA: the index stores (and searches) the reduced vectors
+    metadata = writer.metadata()
+    vectors, reducer = writer.embeddings, None
+    if settings.REDUCE_DIM > 0:
+        vectors, reducer = reduce_embeddings(writer, metadata.label_ids, settings)
+
+    # 6. Build & Save Index, straight from the memory-mapped staging matrix
     index = RetrievalIndex(settings)
-    index.build(final_embeddings, metadata)
+    index.build(vectors, metadata)
     
-    save_dir = settings.ARTIFACTS_DIR / "index"
+    # Written to a staging folder, published as a new version once complete
+    save_dir = new_staging_dir(settings)
     index.save(save_dir)
+    if reducer is not None:
+        reducer.build_id = index.build_id
+        reducer.save(save_dir)
+
+    # 7. Class centroids + related-dish graph, tied to this build id so they can never go stale silently
+    centroids = ClassCentroids.from_embeddings(
+        vectors, index.label_ids, index.class_names, build_id=index.build_id,
+        num_prototypes=settings.CENTROID_PROTOTYPES, block_size=settings.NUMPY_SEARCH_BLOCK,
+    )
+    centroids.save(save_dir)
+    RelatedGraph.build(centroids, DISH_GROUPS, k=settings.RELATED_TOP_K).save(save_dir)
+    if settings.BUILD_BUNDLE:
+        bundle_index_dir(settings, save_dir)
+
+    # 8. Atomically point serving processes at the new version
+    publish(settings, save_dir, index.build_id, model=index.header.get("model", ""))
+    writer.cleanup()
     logger.info("Index build complete!")
 
 if __name__ == "__main__":
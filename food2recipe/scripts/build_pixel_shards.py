@@ -0,0 +1,41 @@
+# File: food2recipe/scripts/build_pixel_shards.py
+import argparse
+import pandas as pd
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.preprocessing.build_manifest import build_manifest
+from food2recipe.preprocessing.image_preprocess import get_uint8_transform
+from food2recipe.preprocessing.pixel_shards import PixelShardStore
+from food2recipe.scripts.build_index import make_dataloader
+
+logger = setup_logger("build_pixel_shards")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode + crop every manifest image once into uint8 pixel shards.")
+    parser.add_argument("--splits", nargs="+", default=None, help="Defaults to all splits in the manifest")
+    args = parser.parse_args()
+
+    settings = load_settings()
+    manifest_path = settings.ARTIFACTS_DIR / "manifest.csv"
+    if not manifest_path.exists():
+        manifest_path = build_manifest(settings)
+    df = pd.read_csv(manifest_path)
+    if args.splits:
+        df = df[df["split"].isin(args.splits)]
+
+    transform = get_uint8_transform(settings.IMAGE_SIZE, settings.PREPROCESS_MODE)
+
+    def decode_batches(paths):
+        for batch in make_dataloader(paths, transform, settings):
+            if batch is not None:
+                images, batch_paths, _ = batch
+                yield images, batch_paths
+
+    store = PixelShardStore(settings).load()
+    store.write(df[["image_path", "split"]].to_dict("records"), decode_batches)
+    logger.info(f"Pixel shards ready: {len(store.rows)} images in {store.folder}")
+
+
+if __name__ == "__main__":
+    main()
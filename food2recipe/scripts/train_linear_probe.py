@@ -0,0 +1,75 @@
+# File: food2recipe/scripts/train_linear_probe.py
+import sys
+import argparse
+import numpy as np
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.retrieval.index_faiss import RetrievalIndex
+from food2recipe.retrieval.linear_probe import LinearProbe
+from food2recipe.retrieval.index_versions import add_artifacts, resolve_index_dir
+from food2recipe.scripts.build_bundle import refresh_bundle
+
+logger = setup_logger("train_linear_probe")
+
+
+def sample_per_class(label_ids, max_per_class, seed=0):
+    """Sorted row ids with at most max_per_class rows of each class (0 = all rows)."""
+    if max_per_class <= 0:
+        return np.arange(len(label_ids))
+    rng = np.random.default_rng(seed)
+    keep = [
+        rows if len(rows) <= max_per_class else rng.choice(rows, max_per_class, replace=False)
+        for rows in np.split(np.argsort(label_ids, kind="stable"), np.cumsum(np.bincount(label_ids))[:-1])
+    ]
+    return np.sort(np.concatenate(keep))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a linear classifier head on the index embeddings.")
+    parser.add_argument("--C", type=float, default=1.0, help="Inverse L2 regularization strength")
+    parser.add_argument("--max-iter", type=int, default=1000)
+    parser.add_argument("--max-per-class", type=int, default=0, help="Cap on training rows per class (0 = all)")
+    parser.add_argument("--calibration-split", default="val",
+                        help="Index split held out to fit the softmax temperature")
+    args = parser.parse_args()
+
+    settings = load_settings()
+    index_path = resolve_index_dir(settings)
+    index = RetrievalIndex(settings)
+    try:
+        index.load(index_path)
+    except FileNotFoundError:
+        logger.error("Index not found. Please run 'python -m food2recipe.scripts.build_index' first.")
+        sys.exit(1)
+
+    embeddings = index.embeddings
+    if embeddings is None:
+        if not index.is_faiss:
+            logger.error("Index has no stored vectors.")
+            sys.exit(1)
+        embeddings = index.index.reconstruct_n(0, index.index.ntotal)
+
+    label_ids = np.asarray(index.label_ids)
+    rows = sample_per_class(label_ids, args.max_per_class)
+    vectors = np.asarray(embeddings[rows], dtype=np.float32)
+    split_ids = np.asarray(index.metadata.split_ids)[rows]
+    calibration = np.zeros(len(rows), dtype=bool)
+    if args.calibration_split in index.metadata.split_names:
+        calibration = split_ids == index.metadata.split_names.index(args.calibration_split)
+    logger.info(f"Training on {int((~calibration).sum())} vectors, calibrating on {int(calibration.sum())}.")
+
+    probe = LinearProbe.fit(
+        vectors, label_ids[rows], index.class_names,
+        build_id=index.build_id, calibration_mask=calibration, C=args.C, max_iter=args.max_iter,
+    )
+    if calibration.any():
+        preds = np.argmax(probe.logits(vectors[calibration]), axis=1)
+        logger.info(f"Calibration split accuracy: {np.mean(preds == label_ids[rows][calibration]):.4f}")
+    # Published as a new version next to the served one; a bundle in the folder
+    # is what serving reads, so it is repacked with the probe
+    folder = add_artifacts(settings, index_path, probe.save, finalize=lambda d: refresh_bundle(settings, d))
+    logger.info(f"Linear probe saved to {folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# File: food2recipe/serving/client.py
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+from food2recipe.core.logging_utils import setup_logger
+
+logger = setup_logger("inference_client")
+
+
+class ServerBusyError(RuntimeError):
+    """The inference server shed the request (HTTP 503)."""
+
+
+class InferenceClient:
+    """
+    Thin HTTP client for the micro-batching inference server.
+    predict() has the same signature and return format as RecipeRecommender.predict.
+    """
+
+    def __init__(self, base_url: str, timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def predict(self, image_file, confidence_threshold=None, top_k=None):
+        if isinstance(image_file, (bytes, bytearray)):
+            payload = bytes(image_file)
+        elif hasattr(image_file, "getvalue"):
+            # Streamlit UploadedFile / BytesIO
+            payload = image_file.getvalue()
+        elif hasattr(image_file, "read"):
+            payload = image_file.read()
+        else:
+            with open(image_file, "rb") as f:
+                payload = f.read()
+
+        params = {k: v for k, v in (("threshold", confidence_threshold), ("top_k", top_k)) if v is not None}
+        query = f"?{urllib.parse.urlencode(params)}" if params else ""
+        req = urllib.request.Request(
+            f"{self.base_url}/predict{query}",
+            data=payload,
+            headers={"Content-Type": "application/octet-stream"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return json.loads(resp.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode("utf-8", errors="replace")
+            if e.code == 503:
+                raise ServerBusyError("Inference server is busy, please retry.") from e
+            if e.code == 400:
+                raise ValueError(json.loads(detail).get("error", detail)) from e
+            raise RuntimeError(f"Inference server error {e.code}: {detail}") from e
+
+    def health(self) -> dict:
+        with urllib.request.urlopen(f"{self.base_url}/health", timeout=self.timeout) as resp:
+            return json.loads(resp.read().decode("utf-8"))
@@ -0,0 +1,168 @@
+# File: food2recipe/serving/inference_server.py
+import json
+import time
+import asyncio
+from urllib.parse import parse_qs
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.retrieval.inference_executor import QueueFullError, check_request_params
+
+logger = setup_logger("inference_server")
+
+
+class MicroBatcher:
+    """
+    asyncio front of the recommender's InferenceExecutor, so HTTP requests
+    and in-process callers share one bounded queue, one worker thread (model
+    work serialized, micro-batched by size / max wait) and one set of stats.
+
+    Awaiting submit() keeps the event loop free to accept (or reject) new
+    requests; if the client goes away, the cancelled request is skipped.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    async def submit(self, image_bytes: bytes, confidence_threshold=None, top_k=None):
+        """Queues one image and waits for its result. Raises QueueFullError if saturated."""
+        return await asyncio.wrap_future(self.executor.submit(image_bytes, confidence_threshold, top_k))
+
+    def stats(self) -> dict:
+        return self.executor.stats()
+
+
+class InferenceServer:
+    """
+    Minimal asyncio HTTP/1.1 server (stdlib only).
+
+    Endpoints:
+      - POST /predict[?threshold=0.6&top_k=5] : body is the raw image bytes,
+        returns the predict() result as JSON; parameters apply to this request only
+        (400 unless 1 <= top_k <= MAX_TOP_K and 0 <= threshold <= 1)
+      - GET  /health  : queue stats
+    Responds 503 with Retry-After when the queue is full.
+    """
+
+    def __init__(self, recommender, settings=None):
+        self.settings = settings or recommender.settings
+        self.recommender = recommender
+        self.batcher = None
+        self.max_body = int(self.settings.SERVER_MAX_UPLOAD_MB * 1024 * 1024)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            path, _, query = target.partition("?")
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+
+            if method == "GET" and path == "/health":
+                await self._respond(writer, 200, {**self.batcher.stats(), "caches": self.recommender.cache_stats(),
+                                               "index": self.recommender.generation_info()})
+                return
+
+            if method != "POST" or path != "/predict":
+                await self._respond(writer, 404, {"error": "not found"})
+                return
+
+            length = int(headers.get("content-length", 0))
+            if length <= 0:
+                await self._respond(writer, 400, {"error": "empty body"})
+                return
+            if length > self.max_body:
+                await self._respond(writer, 413, {"error": "image too large"})
+                return
+            try:
+                params = {k: v[-1] for k, v in parse_qs(query).items()}
+                threshold = float(params["threshold"]) if "threshold" in params else None
+                top_k = int(params["top_k"]) if "top_k" in params else None
+                check_request_params(threshold, top_k, self.settings.MAX_TOP_K)
+            except ValueError as e:
+                await self._respond(writer, 400, {"error": f"bad threshold / top_k: {e}"})
+                return
+            body = await reader.readexactly(length)
+
+            t0 = time.perf_counter()
+            try:
+                result = await self.batcher.submit(body, confidence_threshold=threshold, top_k=top_k)
+            except QueueFullError:
+                await self._respond(writer, 503, {"error": "server busy"}, extra_headers={"Retry-After": "1"})
+                return
+            except ValueError as e:
+                await self._respond(writer, 400, {"error": str(e)})
+                return
+
+            result["latency_ms"] = (time.perf_counter() - t0) * 1000.0
+            await self._respond(writer, 200, result)
+
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        except Exception as e:
+            logger.exception(f"Request failed: {e}")
+            try:
+                await self._respond(writer, 500, {"error": str(e)})
+            except Exception:
+                pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload, extra_headers=None):
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+                   500: "Internal Server Error", 503: "Service Unavailable"}
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        lines = [
+            f"HTTP/1.1 {status} {reasons.get(status, '')}",
+            "Content-Type: application/json; charset=utf-8",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+        ]
+        for k, v in (extra_headers or {}).items():
+            lines.append(f"{k}: {v}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host=None, port=None, sock=None):
+        """Serves until cancelled. sock: an already listening socket (pre-fork workers share one)."""
+        host = host or self.settings.SERVER_HOST
+        port = port or self.settings.SERVER_PORT
+
+        self.batcher = MicroBatcher(self.recommender.start_executor(
+            max_batch_size=self.settings.SERVER_MAX_BATCH_SIZE,
+            max_wait_ms=self.settings.SERVER_MAX_WAIT_MS,
+            max_queue_size=self.settings.SERVER_MAX_QUEUE_SIZE,
+        ))
+
+        if sock is not None:
+            server = await asyncio.start_server(self._handle, sock=sock)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            logger.info(f"Inference server listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    from food2recipe.retrieval.recommender import RecipeRecommender
+
+    settings = load_settings()
+    if settings.SERVER_WORKERS > 1:
+        from food2recipe.serving.prefork import PreforkServer
+        PreforkServer(settings).serve()
+        return
+
+    recommender = RecipeRecommender(settings)
+    recommender.load_resources()
+    asyncio.run(InferenceServer(recommender, settings).serve())
+
+
+if __name__ == "__main__":
+    main()
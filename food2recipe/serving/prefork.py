@@ -0,0 +1,151 @@
+# File: food2recipe/serving/prefork.py
+import gc
+import os
+import time
+import signal
+import socket
+import asyncio
+from food2recipe.core.settings import load_settings
+from food2recipe.core.logging_utils import setup_logger
+from food2recipe.serving.inference_server import InferenceServer
+
+logger = setup_logger("prefork")
+
+# Fields of /proc/<pid>/smaps_rollup reported by process_memory (kB in the file)
+_MEMORY_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty", "Swap")
+
+
+def parse_smaps_rollup(text: str) -> dict:
+    """{field: MB} from the contents of /proc/<pid>/smaps_rollup."""
+    usage = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(":")
+        if key in _MEMORY_FIELDS:
+            usage[key] = int(value.split()[0]) / 1024.0
+    return usage
+
+
+def process_memory(pid: int) -> dict:
+    """
+    RSS / PSS / shared / private memory of a process, in MB (Linux only).
+    PSS splits each shared page among the processes mapping it, so summing it
+    over the parent and the workers gives the real footprint of the group.
+    """
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        return parse_smaps_rollup(f.read())
+
+
+class PreforkServer:
+    """
+    Loads the recommender once in a parent process and forks SERVER_WORKERS
+    copies of the inference server that accept on one shared listening socket.
+
+    Model weights, the FAISS index and the columnar metadata are built before
+    the fork, and gc.freeze() moves every object alive at that point out of
+    the collector's reach, so the pages stay shared copy-on-write: workers only
+    pay for their own activations, caches and request buffers. Memory-mapped
+    index files are shared through the page cache either way.
+
+    The parent never runs a multi-threaded forward pass: a child forked after
+    the OpenMP pool has started blocks in its first parallel region. Encoder
+    warmup, torch threads and the index watcher are set up in each worker.
+    """
+
+    def __init__(self, settings=None, workers=None):
+        self.settings = settings or load_settings()
+        self.num_workers = max(1, workers or self.settings.SERVER_WORKERS)
+        # torch threads per worker: explicit setting, else an even split of the cores
+        self.threads_per_worker = self.settings.TORCH_NUM_THREADS or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self.recommender = None
+        self.sock = None
+        self.workers = {}  # pid -> start time
+        self._stopping = False
+
+    def load(self):
+        """Loads everything workers share. Threads started here would not survive the fork."""
+        from food2recipe.retrieval.recommender import RecipeRecommender
+
+        shared = self.settings.model_copy(update={"TORCH_NUM_THREADS": 1, "INDEX_WATCH_INTERVAL_S": 0})
+        self.recommender = RecipeRecommender(shared)
+        self.recommender.load_resources()
+        gc.collect()
+        gc.freeze()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._worker_main()
+            except BaseException:
+                logger.exception(f"Worker {os.getpid()} crashed")
+                code = 1
+            finally:
+                # Never return into the parent's serve loop
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+        return pid
+
+    def _worker_main(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the parent, which stops the workers
+
+        encoder = self.recommender.encoder
+        if encoder.session is None:
+            # ONNX sessions keep the single thread they were created with in the parent
+            import torch
+            torch.set_num_threads(self.threads_per_worker)
+        encoder.warmup()
+        if self.settings.INDEX_WATCH_INTERVAL_S > 0:
+            # A swapped-in version is loaded by each worker and is no longer shared
+            self.recommender.start_watcher(self.settings.INDEX_WATCH_INTERVAL_S)
+
+        logger.info(f"Worker {os.getpid()} ready ({self.threads_per_worker} torch threads)")
+        asyncio.run(InferenceServer(self.recommender, self.settings).serve(sock=self.sock))
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def serve(self, host=None, port=None):
+        host = host or self.settings.SERVER_HOST
+        port = port or self.settings.SERVER_PORT
+        if self.recommender is None:
+            self.load()
+
+        self.sock = socket.create_server((host, port), backlog=self.settings.SERVER_MAX_QUEUE_SIZE * self.num_workers)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for _ in range(self.num_workers):
+            self._spawn()
+        logger.info(f"Pre-fork server on http://{host}:{port} with {self.num_workers} workers "
+                    f"(parent {os.getpid()}, workers {sorted(self.workers)})")
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            logger.warning(f"Worker {pid} exited with status {status}; restarting it")
+            if time.monotonic() - started < 1.0:
+                time.sleep(1.0)  # Crash loop guard
+            self._spawn()
+
+        self.sock.close()
+        logger.info("Pre-fork server stopped")
+
+
+def main():
+    PreforkServer(load_settings()).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# File: food2recipe/tests/test_preprocess.py
+import io
+import tempfile
+import unittest
+import numpy as np
+import torch
+from PIL import Image
+from pathlib import Path
+from food2recipe.preprocessing.image_preprocess import get_transforms, load_and_transform_image, normalize_batch, open_image
+
+
+def _photo_like_jpeg(width, height, seed=0, exif_orientation=None):
+    """Smooth random image (upsampled noise) saved as JPEG, roughly like a photo."""
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 256, (height // 40, width // 40, 3), dtype=np.uint8))
+    image = small.resize((width, height), Image.BICUBIC)
+    buf = io.BytesIO()
+    if exif_orientation is not None:
+        exif = Image.Exif()
+        exif[0x0112] = exif_orientation
+        image.save(buf, "JPEG", quality=90, exif=exif)
+    else:
+        image.save(buf, "JPEG", quality=90)
+    buf.seek(0)
+    return buf
+
+
+class _StubEncoder:
+    """Deterministic stand-in for ImageEncoder: a fixed random projection of the pixels."""
+
+    def __init__(self, image_size):
+        rng = np.random.default_rng(0)
+        self.proj = torch.from_numpy(rng.standard_normal((3 * image_size * image_size, 16)).astype(np.float32))
+
+    def encode(self, images):
+        return torch.nn.functional.normalize(images.flatten(1) @ self.proj, dim=1)
+
+
+def _init_stub_encode_worker(settings):
+    # Runs in the spawned pool workers in place of build_index._init_encode_worker
+    from food2recipe.scripts import build_index
+    torch.set_num_threads(settings.TORCH_NUM_THREADS)
+    build_index._worker["settings"] = settings
+    build_index._worker["encoder"] = _StubEncoder(settings.IMAGE_SIZE)
+    build_index._worker["transform"], build_index._worker["pixel_store"] = build_index.make_encode_transform(settings)
+
+
+class PreprocessTest(unittest.TestCase):
+    def test_fast_matches_standard(self):
+        standard = get_transforms(image_size=224)
+        fast = get_transforms(image_size=224, preprocess_mode="fast")
+        # Fixed random projection as a stand-in encoder to bound embedding drift
+        proj = torch.randn(3 * 224 * 224, 128, generator=torch.Generator().manual_seed(0))
+
+        for seed, (w, h) in enumerate([(4000, 3000), (1200, 1600), (224, 300)]):
+            ref = load_and_transform_image(_photo_like_jpeg(w, h, seed), standard)
+            out = load_and_transform_image(_photo_like_jpeg(w, h, seed), fast)
+            self.assertEqual(out.dtype, torch.uint8)
+            out = normalize_batch(out[None])[0]
+            self.assertEqual(out.shape, ref.shape)
+
+            self.assertLess((out - ref).abs().mean().item(), 0.02)
+            cos = torch.nn.functional.cosine_similarity(ref.flatten() @ proj, out.flatten() @ proj, dim=0)
+            self.assertGreater(cos.item(), 0.999)
+
+    def test_exif_orientation_and_pixel_cap(self):
+        fast = get_transforms(image_size=32, preprocess_mode="fast")
+        # Orientation 6 = rotated 90 degrees: a landscape file displays as portrait
+        self.assertEqual(open_image(_photo_like_jpeg(400, 200, exif_orientation=6)).size, (400, 200))
+        self.assertEqual(open_image(_photo_like_jpeg(400, 200, exif_orientation=6), exif=True).size, (200, 400))
+        out = load_and_transform_image(_photo_like_jpeg(400, 200, exif_orientation=6), fast)
+        self.assertEqual(tuple(out.shape), (3, 32, 32))
+
+        with self.assertRaises(ValueError):
+            load_and_transform_image(_photo_like_jpeg(400, 200), fast, max_pixels=400 * 200 - 1)
+        with self.assertRaises(ValueError):
+            load_and_transform_image(_photo_like_jpeg(400, 200), get_transforms(image_size=32), max_pixels=1000)
+
+    def test_normalize_batch_matches_torchvision(self):
+        images = torch.randint(0, 256, (2, 3, 8, 8), dtype=torch.uint8)
+        expected = torch.stack([get_transforms(image_size=8).transforms[-1](img.float() / 255.0) for img in images])
+        torch.testing.assert_close(normalize_batch(images), expected, rtol=1e-5, atol=1e-5)
+        # Float batches (standard transforms) pass through untouched
+        self.assertIs(normalize_batch(expected), expected)
+
+
+
+class _FlakyDataset(torch.utils.data.Dataset):
+    """ImageDataset-shaped items; the listed indices fail like an unreadable file (None)."""
+
+    def __init__(self, n, failed):
+        self.n = n
+        self.failed = set(failed)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        if idx in self.failed:
+            return None
+        return torch.full((3, 4, 4), float(idx)), f"img_{idx}.jpg", 0.5
+
+
+class CollateSkipFailedTest(unittest.TestCase):
+    def test_failed_items_are_dropped(self):
+        from torch.utils.data import DataLoader
+        from food2recipe.scripts.build_index import collate_skip_failed
+
+        loader = DataLoader(_FlakyDataset(7, failed=[1, 3, 4, 5]), batch_size=3, collate_fn=collate_skip_failed)
+        batches = list(loader)
+        self.assertEqual(len(batches), 3)
+        imgs, paths, decode_seconds = batches[0]
+        self.assertEqual(paths, ["img_0.jpg", "img_2.jpg"])
+        self.assertEqual(imgs[:, 0, 0, 0].tolist(), [0.0, 2.0])
+        self.assertEqual(decode_seconds, 1.0)
+        self.assertIsNone(batches[1])  # Every item failed
+        self.assertEqual(batches[2][1], ["img_6.jpg"])
+
+    def test_encode_paths_skips_and_reports_unreadable_files(self):
+        from food2recipe.core.settings import load_settings
+        from food2recipe.scripts.build_index import encode_paths, make_encode_transform
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i in range(5):
+                path = Path(tmp) / f"img_{i}.jpg"
+                # img_2 and img_3 fill a whole batch of 2 with failures
+                path.write_bytes(b"not a jpeg" if i in (2, 3) else _photo_like_jpeg(96, 80, seed=i).getvalue())
+                paths.append(str(path))
+
+            settings = load_settings().model_copy(update={
+                "BUILD_NUM_WORKERS": 0, "BUILD_BATCH_SIZE": 2, "IMAGE_SIZE": 32, "PIXEL_SHARDS": False,
+            })
+            transform, _ = make_encode_transform(settings)
+            with self.assertLogs("build_index", "WARNING") as logs:
+                embeddings, encoded = encode_paths(paths, _StubEncoder(32), transform, settings)
+
+            self.assertEqual(encoded, [paths[0], paths[1], paths[4]])
+            self.assertEqual(embeddings.shape, (3, 16))
+            failed = [line for line in logs.output if "Error loading" in line]
+            self.assertEqual(len(failed), 2)
+            self.assertTrue(all(any(p in line for line in failed) for p in paths[2:4]))
+
+
+class ShardedEncoderTest(unittest.TestCase):
+    def test_output_independent_of_worker_count(self):
+        from food2recipe.core.settings import load_settings
+        from food2recipe.scripts.build_index import ShardedEncoder
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i in range(11):
+                path = Path(tmp) / f"img_{i:02d}.jpg"
+                # One unreadable file, in the middle of a shard
+                path.write_bytes(b"not a jpeg" if i == 5 else _photo_like_jpeg(96, 80, seed=i).getvalue())
+                paths.append(str(path))
+
+            results = {}
+            for workers in (1, 3):
+                settings = load_settings().model_copy(update={
+                    "BUILD_ENCODE_WORKERS": workers, "BUILD_THREADS_PER_WORKER": 1, "BUILD_BATCH_SIZE": 2,
+                    "IMAGE_SIZE": 32, "PIXEL_SHARDS": False,
+                })
+                encoder = ShardedEncoder(settings, Path(tmp) / f"work_{workers}", initializer=_init_stub_encode_worker)
+                try:
+                    results[workers] = encoder.encode(paths)
+                finally:
+                    encoder.close()
+
+            (emb_1, paths_1), (emb_3, paths_3) = results[1], results[3]
+            self.assertEqual(paths_1, [p for i, p in enumerate(paths) if i != 5])
+            self.assertEqual(paths_3, paths_1)
+            np.testing.assert_array_equal(emb_3, emb_1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,500 @@
+# File: food2recipe/tests/test_retrieval.py
+import tempfile
+import unittest
+import numpy as np
+from pathlib import Path
+from food2recipe.core.settings import load_settings
+from food2recipe.retrieval.index_faiss import RetrievalIndex, NumpyIndex
+from food2recipe.retrieval.recommender import RecipeRecommender
+from food2recipe.retrieval.prediction_cache import LRUCache, SemanticCache
+from food2recipe.retrieval.centroids import ClassCentroids
+from food2recipe.retrieval.related_graph import RelatedGraph
+from food2recipe.retrieval.linear_probe import LinearProbe
+from food2recipe.retrieval.reduction import PCAReducer
+
+
+def _random_index(use_faiss, n=100, d=16, num_classes=5, seed=0):
+    rng = np.random.default_rng(seed)
+    emb = rng.standard_normal((n, d)).astype(np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    metadata = [
+        {"image_path": f"img_{i}.jpg", "food_name": f"dish_{rng.integers(num_classes)}", "split": "train"}
+        for i in range(n)
+    ]
+    settings = load_settings().model_copy(update={"USE_FAISS": use_faiss})
+    index = RetrievalIndex(settings)
+    index.build(emb, metadata)
+    return index, emb
+
+
+class RetrievalTest(unittest.TestCase):
+    def test_search_batch_matches_single(self):
+        for use_faiss in (False, True):
+            index, emb = _random_index(use_faiss)
+            queries = emb[:8] + 0.01
+            D, I = index.search_batch(queries, k=5)
+            self.assertEqual(I.shape, (8, 5))
+            for q, d_row, i_row in zip(queries, D, I):
+                d, i = index.search(q[None, :], k=5)
+                np.testing.assert_array_equal(i, i_row)
+                np.testing.assert_allclose(d, d_row, rtol=1e-5)
+
+    def test_numpy_blocked_topk_matches_argsort(self):
+        _, emb = _random_index(False, n=1000, d=32)
+        queries = emb[:20]
+        exact = np.argsort(queries @ emb.T, axis=1)[:, ::-1][:, :10]
+
+        for block_size in (7, 128, 65536):
+            D, I = NumpyIndex.from_embeddings(emb, "float32", block_size).search(queries, 10)
+            np.testing.assert_array_equal(I, exact)
+            self.assertTrue(np.all(np.diff(D, axis=1) <= 0))
+
+        # Quantized storage should keep almost all of the exact neighbours
+        for dtype in ("float16", "int8"):
+            _, I = NumpyIndex.from_embeddings(emb, dtype, 128).search(queries, 10)
+            overlap = np.mean([len(np.intersect1d(a, b)) / 10 for a, b in zip(I, exact)])
+            self.assertGreater(overlap, 0.9)
+
+    def test_batch_aggregation_matches_vote(self):
+        index, emb = _random_index(False)
+        rec = RecipeRecommender(index.settings)
+        rec.index = index
+        rec.recipe_processor = type("Recipes", (), {"get_recipe": lambda self, k: None})()
+
+        D, I = index.search_batch(emb[:10], k=rec.settings.TOP_K)
+        results = rec._aggregate_batch(D, I)
+        for d_row, i_row, res in zip(D, I, results):
+            # Reference: first-seen order + stable sort, as a plain dict vote
+            score_map = {}
+            for score, idx in zip(d_row, i_row):
+                name = index.metadata[idx]["food_name"]
+                score_map[name] = score_map.get(name, 0.0) + float(score)
+            expected = sorted(score_map.items(), key=lambda x: x[1], reverse=True)
+            self.assertEqual([x["food_name"] for x in res["top_k_items"]], [n for n, _ in expected])
+            self.assertEqual(res["predicted_food"], expected[0][0])
+            self.assertAlmostEqual(res["confidence"], float(d_row[0]))
+
+
+    def test_cascade_fast_path_and_escalation(self):
+        index, emb = _random_index(False, n=200)
+        rec = RecipeRecommender(index.settings.model_copy(update={"PREDICTION_MODE": "cascade"}))
+        rec.index = index
+        rec.centroids = ClassCentroids.from_embeddings(emb, index.label_ids, index.class_names)
+        queries = emb[:20] + 0.01
+        centroid_best = np.argmax(queries @ rec.centroids.matrix.T, axis=1)
+
+        # Margin always met: centroid argmax, no search
+        rec.settings = rec.settings.model_copy(update={"CASCADE_MARGIN": -1.0})
+        votes = rec.classify(queries)
+        self.assertEqual([v[0] for v in votes], [index.class_names[c] for c in centroid_best])
+        self.assertEqual({v[3] for v in votes}, {"centroid"})
+        self.assertEqual(rec._default_threshold("centroid"), rec.settings.CENTROID_CONFIDENCE_THRESHOLD)
+        self.assertEqual(rec.cascade_stats, {"fast": 20, "escalated": 0})
+
+        # Margin never met: plain kNN votes
+        rec.settings = rec.settings.model_copy(update={"CASCADE_MARGIN": np.inf})
+        self.assertEqual(rec.classify(queries), rec.classify(queries, mode="knn"))
+        self.assertEqual(rec.cascade_stats["escalated"], 20)
+
+        # Escalation restricted to the best centroid class can only vote for it
+        rec.settings = rec.settings.model_copy(update={"CASCADE_TOP_M": 1})
+        votes = rec.classify(queries)
+        self.assertEqual([v[0] for v in votes], [index.class_names[c] for c in centroid_best])
+
+
+class FaissIndexTypesTest(unittest.TestCase):
+    def test_build_save_load_and_search_params(self):
+        import faiss
+        rng = np.random.default_rng(0)
+        emb = rng.standard_normal((2000, 16)).astype(np.float32)
+        emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+        metadata = [{"image_path": f"img_{i}.jpg", "food_name": f"dish_{i % 5}", "split": "train"} for i in range(2000)]
+        # PQ codes are lossy; the other types store the vectors
+        min_recall = {"ivf_flat": 0.99, "hnsw": 0.99, "ivf_pq": 0.7, "opq_pq": 0.7}
+
+        for index_type, expected in min_recall.items():
+            with self.subTest(index_type=index_type), tempfile.TemporaryDirectory() as tmp:
+                settings = load_settings().model_copy(update={
+                    "USE_FAISS": True, "INDEX_TYPE": index_type, "PQ_M": 4, "PQ_NBITS": 4,
+                })
+                built = RetrievalIndex(settings)
+                built.build(emb, metadata)
+                built.save(Path(tmp))
+                index = RetrievalIndex(settings)
+                index.load(Path(tmp))
+                self.assertTrue(index.is_faiss)
+
+                index.set_search_params(nprobe=8, ef_search=128)
+                ivf = faiss.try_extract_index_ivf(index.index)
+                if ivf is not None:
+                    self.assertEqual(ivf.nprobe, 8)
+                if index_type == "hnsw":
+                    self.assertEqual(faiss.downcast_index(index.index).hnsw.efSearch, 128)
+
+                # Self-recall@1: every stored vector finds itself
+                _, found = index.search_batch(emb[:500], k=1)
+                self.assertGreaterEqual(float(np.mean(found[:, 0] == np.arange(500))), expected)
+                # The loaded index answers like the one that was saved
+                built.set_search_params(nprobe=8, ef_search=128)
+                np.testing.assert_array_equal(found, built.search_batch(emb[:500], k=1)[1])
+
+
+class HotSwapTest(unittest.TestCase):
+    def test_swap_waits_for_in_flight_requests(self):
+        import tempfile
+        from pathlib import Path
+        from food2recipe.retrieval.index_versions import new_staging_dir, publish
+
+        with tempfile.TemporaryDirectory() as tmp:
+            index, emb = _random_index(False, n=30)
+            settings = index.settings.model_copy(update={"ARTIFACTS_DIR": Path(tmp)})
+
+            def publish_build(seed):
+                build, _ = _random_index(False, n=30, seed=seed)
+                staging = new_staging_dir(settings)
+                build.save(staging)
+                publish(settings, staging, build.build_id, model=build.header["model"])
+                return build.build_id
+
+            rec = RecipeRecommender(settings)
+            rec.encoder = object()  # Only checked for presence: load vectors, not just related dishes
+            first = publish_build(0)
+            self.assertTrue(rec.reload_if_changed())
+            self.assertFalse(rec.reload_if_changed())
+            self.assertEqual(rec.index.build_id, first)
+
+            # A request pinned on the first generation keeps it through a swap
+            old = rec._gen
+            old.active += 1
+            second = publish_build(1)
+            self.assertTrue(rec.reload_if_changed())
+            self.assertEqual(rec.index.build_id, second)
+            rec._local.gen = old
+            self.assertEqual(rec.index.build_id, first)
+            rec._local.gen = None
+
+            # No third generation while the retired one is still serving
+            third = publish_build(2)
+            self.assertFalse(rec.reload_if_changed())
+            old.active -= 1
+            self.assertTrue(rec.reload_if_changed())
+            self.assertEqual(rec.generation_info()["build_id"], third)
+            self.assertEqual(rec.generation_info()["swaps"], 3)
+
+    def test_added_artifacts_publish_a_new_version(self):
+        import os
+        from food2recipe.retrieval import index_versions
+
+        with tempfile.TemporaryDirectory() as tmp:
+            index, _ = _random_index(False, n=30)
+            settings = index.settings.model_copy(update={"ARTIFACTS_DIR": Path(tmp), "PREDICTION_MODE": "linear"})
+            staging = index_versions.new_staging_dir(settings)
+            index.save(staging)
+            served = index_versions.publish(settings, staging, index.build_id, model=index.header["model"])
+            manifest = (served / index_versions.MANIFEST_FILE).read_text(encoding="utf-8")
+
+            rec = RecipeRecommender(settings)
+            rec.encoder = object()
+            self.assertTrue(rec.reload_if_changed())
+            self.assertIsNone(rec.linear_probe)
+            version_before = rec._vote_version()
+
+            # train_linear_probe: the served folder stays as it was, the probe comes as a new version
+            probe = LinearProbe(np.ones((16, len(index.class_names)), np.float32),
+                                np.zeros(len(index.class_names), np.float32), index.class_names, build_id=index.build_id)
+            folder = index_versions.add_artifacts(settings, served, probe.save)
+            self.assertTrue(folder.name.startswith(f"{index.build_id}-"))
+            self.assertEqual(index_versions.current_version(settings), folder.name)
+            self.assertEqual(sorted(p.name for p in folder.iterdir()),
+                             sorted([p.name for p in served.iterdir()] + ["linear_probe.npz"]))
+            self.assertEqual((served / index_versions.MANIFEST_FILE).read_text(encoding="utf-8"), manifest)
+            self.assertEqual(os.stat(served / "embeddings.npy").st_ino, os.stat(folder / "embeddings.npy").st_ino)
+            self.assertEqual(index_versions.verify_manifest(folder, checksums=True)["build_id"], index.build_id)
+
+            # The watcher swaps it in; cached votes of the probe-less version are not reused
+            self.assertTrue(rec.reload_if_changed())
+            self.assertIsNotNone(rec.linear_probe)
+            self.assertNotEqual(rec._vote_version(), version_before)
+
+
+class InferenceExecutorTest(unittest.TestCase):
+    def test_micro_batches_with_per_request_params(self):
+        import threading
+        import time
+        from food2recipe.retrieval.inference_executor import InferenceExecutor, QueueFullError
+
+        calls = []
+        release = threading.Event()
+
+        def predict_batch(files, return_exceptions=False, confidence_threshold=None, top_k=None):
+            release.wait()
+            calls.append((list(files), top_k))
+            return [{"payload": f, "threshold": t, "top_k": top_k} for f, t in zip(files, confidence_threshold)]
+
+        executor = InferenceExecutor(predict_batch, max_batch_size=8, max_wait_ms=50, max_queue_size=6)
+        futures = [executor.submit(bytes([i]), confidence_threshold=i / 10, top_k=3 if i % 2 else None)
+                   for i in range(6)]
+        time.sleep(0.1)  # The worker holds the first batch, so the queue fills up again
+        with self.assertRaises(QueueFullError):
+            for i in range(7):
+                executor.submit(b"x")
+        release.set()
+        for i, fut in enumerate(futures):
+            res = fut.result(timeout=5)
+            self.assertEqual((res["payload"], res["threshold"], res["top_k"]), (bytes([i]), i / 10, 3 if i % 2 else None))
+        # Requests batched together, one predict_batch call per top_k
+        self.assertEqual(sorted(len(files) for files, _ in calls[:2]), [3, 3])
+        stats = executor.stats()
+        self.assertGreaterEqual(stats["rejected"], 1)
+        self.assertGreater(stats["wait_ms_max"], 0.0)
+
+    def test_per_request_top_k_and_threshold(self):
+        index, emb = _random_index(False)
+        rec = RecipeRecommender(index.settings)
+        rec.index = index
+        votes = rec.classify(emb[:4], top_k=1)
+        self.assertTrue(all(len(v[2]) == 1 for v in votes))
+        self.assertEqual(rec._thresholds([None, 0.9], 2), [None, 0.9])
+        self.assertNotEqual(rec._vote_version(1), rec._vote_version())
+
+        # Typos in PREDICTION_MODE fail instead of silently serving knn
+        with self.assertRaises(ValueError):
+            RecipeRecommender(index.settings.model_copy(update={"PREDICTION_MODE": "linera"}))
+        with self.assertRaises(ValueError):
+            type(index.settings)(PROFILE="serving", PREDICTION_MODE="linera")
+
+        # Rejected before any work: a negative kth would wrap around in argpartition
+        for kwargs in ({"top_k": -3}, {"top_k": rec.settings.MAX_TOP_K + 1}, {"confidence_threshold": [0.5, 2.0]},
+                       {"confidence_threshold": float("inf")}):
+            with self.subTest(**kwargs):
+                with self.assertRaises(ValueError):
+                    rec.predict_batch([b"x", b"y"], **kwargs)
+                with self.assertRaises(ValueError):
+                    rec.submit(b"x", **{k: v[-1] if isinstance(v, list) else v for k, v in kwargs.items()})
+        self.assertIsNone(rec._executor)
+
+    def test_start_executor_warns_about_ignored_limits(self):
+        rec = RecipeRecommender(load_settings())
+        executor = rec.start_executor(max_batch_size=4, max_wait_ms=2.0, max_queue_size=8)
+        with self.assertNoLogs("recommender", "WARNING"):
+            self.assertIs(rec.start_executor(max_batch_size=4, max_wait_ms=2.0), executor)
+            self.assertIs(rec.executor, executor)
+        # e.g. the server starting after a warmup submit(): its limits cannot apply any more
+        with self.assertLogs("recommender", "WARNING") as logs:
+            self.assertIs(rec.start_executor(max_batch_size=16, max_wait_ms=2.0, max_queue_size=64), executor)
+        ignored = logs.output[0].split("ignoring requested")[1]
+        self.assertIn("'max_batch_size': 16", ignored)
+        self.assertNotIn("max_wait_ms", ignored)
+
+
+class PredictionCacheTest(unittest.TestCase):
+    def test_lru_eviction_and_counters(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)  # a is now most recent
+        cache.put("c", 3)                    # evicts b
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_ttl_expiry_and_disabled(self):
+        cache = LRUCache(max_size=4, ttl_seconds=1e-9)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+        disabled = LRUCache(max_size=0)
+        disabled.put("a", 1)
+        self.assertIsNone(disabled.get("a"))
+
+    def test_semantic_cache_near_duplicates(self):
+        rng = np.random.default_rng(0)
+        vecs = rng.standard_normal((3, 16)).astype(np.float32)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        cache = SemanticCache(max_size=2, threshold=0.99)
+        cache.put(vecs[0], "a", version="v1")
+        cache.put(vecs[1], "b", version="v1")
+
+        near = vecs[0] + 0.001
+        near /= np.linalg.norm(near)
+        self.assertEqual(cache.lookup(np.stack([near, vecs[2]]), version="v1"), ["a", None])
+
+        cache.put(vecs[2], "c", version="v1")  # evicts b (least recently used)
+        self.assertEqual(cache.lookup(vecs[:3], version="v1"), ["a", None, "c"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        # Another version has its own entries and leaves v1's alone
+        self.assertEqual(cache.lookup(vecs[:1], version="v2"), [None])
+        self.assertEqual(cache.lookup(vecs[:1], version="v1"), ["a"])
+
+    def test_semantic_cache_survives_mixed_top_k(self):
+        index, emb = _random_index(False)
+        rec = RecipeRecommender(index.settings.model_copy(update={"SEMANTIC_CACHE_VERSIONS": 2}))
+        rec.index = index
+        cache = rec.semantic_cache
+        # The executor runs one predict_batch per top_k group, alternating versions
+        for top_k in (3, 5, 3, 5):
+            version = rec._vote_version(top_k)
+            if cache.lookup(emb[:4], version=version) == [None] * 4:
+                for e, vote in zip(emb[:4], rec.classify(emb[:4], top_k=top_k)):
+                    cache.put(e, vote, version=version)
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (8, 8))
+        self.assertEqual(len(cache.lookup(emb[:1], version=rec._vote_version(3))[0][2]), 3)
+
+        # Beyond max_versions the least recently used version goes
+        cache.put(emb[0], "x", version=rec._vote_version(7))
+        self.assertEqual(cache.stats()["version_evictions"], 1)
+        self.assertEqual(cache.lookup(emb[:1], version=rec._vote_version(5)), [None])
+        self.assertEqual(len(cache.lookup(emb[:1], version=rec._vote_version(3))[0][2]), 3)
+
+
+class CentroidTest(unittest.TestCase):
+    def test_vectorized_centroids_match_loop(self):
+        index, emb = _random_index(False, n=200, d=8)
+        centroids = ClassCentroids.from_embeddings(emb, index.label_ids, index.class_names, block_size=37)
+
+        for c, name in enumerate(index.class_names):
+            mean = emb[index.label_ids == c].mean(axis=0)
+            np.testing.assert_allclose(centroids.matrix[c], mean / np.linalg.norm(mean), rtol=1e-5, atol=1e-6)
+        self.assertEqual(int(centroids.counts.sum()), 200)
+
+    def test_prototypes_and_build_id_check(self):
+        import tempfile
+        from pathlib import Path
+
+        index, emb = _random_index(False, n=100, d=8)
+        centroids = ClassCentroids.from_embeddings(emb, index.label_ids, index.class_names, build_id="b1",
+                                                   num_prototypes=3)
+        self.assertEqual(sorted(set(centroids.prototype_labels)), list(range(len(index.class_names))))
+        np.testing.assert_allclose(np.linalg.norm(centroids.prototypes, axis=1), 1.0, rtol=1e-5)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            centroids.save(Path(tmp))
+            loaded = ClassCentroids.load(Path(tmp), build_id="b1")
+            np.testing.assert_array_equal(loaded.matrix, centroids.matrix)
+            self.assertEqual(len(loaded.prototypes), len(centroids.prototypes))
+            with self.assertRaises(ValueError):
+                ClassCentroids.load(Path(tmp), build_id="b2")
+            del loaded
+
+
+class LinearProbeTest(unittest.TestCase):
+    def test_probe_fit_calibrate_and_predict(self):
+        import tempfile
+        from pathlib import Path
+
+        # Well separated classes around random centers; class 3 has no images
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((4, 16)).astype(np.float32)
+        labels = rng.integers(0, 3, 300)
+        emb = centers[labels] + 0.3 * rng.standard_normal((300, 16)).astype(np.float32)
+        emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+        names = ["a", "b", "c", "d"]
+        calibration = np.arange(300) >= 240
+
+        probe = LinearProbe.fit(emb, labels, names, build_id="b1", calibration_mask=calibration)
+        probs = probe.predict_proba(emb[calibration])
+        np.testing.assert_allclose(probs.sum(axis=1), 1.0, rtol=1e-5)
+        self.assertTrue(np.all(probs[:, 3] == 0.0))
+        self.assertGreater(np.mean(np.argmax(probs, axis=1) == labels[calibration]), 0.95)
+        self.assertNotEqual(probe.temperature, 1.0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            probe.save(Path(tmp))
+            loaded = LinearProbe.load(Path(tmp), build_id="b1")
+            np.testing.assert_array_equal(loaded.predict_proba(emb[:5]), probe.predict_proba(emb[:5]))
+            with self.assertRaises(ValueError):
+                LinearProbe.load(Path(tmp), build_id="b2")
+
+        # Recommender linear mode: argmax class, probability as confidence
+        index, _ = _random_index(False, n=50, d=16, num_classes=4)
+        rec = RecipeRecommender(index.settings.model_copy(update={"PREDICTION_MODE": "linear"}))
+        rec.index = index
+        rec.linear_probe = LinearProbe(probe.weights, probe.bias, index.class_names, temperature=probe.temperature)
+        for vote, p in zip(rec.classify(emb[:10]), probe.predict_proba(emb[:10])):
+            self.assertEqual(vote[0], index.class_names[int(np.argmax(p))])
+            self.assertAlmostEqual(vote[1], float(p.max()), places=6)
+
+        # Probabilities are judged against their own threshold, not the kNN cosine one
+        rec.settings = rec.settings.model_copy(update={"CONFIDENCE_THRESHOLD": 1.0, "PROBE_CONFIDENCE_THRESHOLD": 0.0})
+        rec.recipe_processor = type("Recipes", (), {"get_recipe": lambda self, k: None})()
+        votes = rec.classify(emb[:3])
+        self.assertEqual({v[3] for v in votes}, {"probe"})
+        self.assertFalse(any(rec._finalize(v)["is_uncertain"] for v in votes))
+        self.assertTrue(all(rec._finalize(v, v[1] + 1e-6)["is_uncertain"] for v in votes))  # Explicit one wins
+
+
+class ReductionTest(unittest.TestCase):
+    def test_pca_fit_whiten_truncate_and_load(self):
+        import tempfile
+        from pathlib import Path
+
+        # Rank-4 data embedded in 16 dimensions
+        rng = np.random.default_rng(0)
+        basis = np.linalg.qr(rng.standard_normal((16, 4)))[0]
+        emb = (rng.standard_normal((500, 4)) * [4.0, 2.0, 1.0, 0.5]) @ basis.T + 0.1
+        emb = emb.astype(np.float32)
+
+        reducer = PCAReducer.fit(emb, 4, whiten=True, block_size=64)
+        self.assertEqual((reducer.source_dim, reducer.dim), (16, 4))
+        self.assertAlmostEqual(reducer.explained_variance, 1.0, places=4)
+        self.assertTrue(np.all(np.diff(reducer.variance_ratio) <= 0))
+
+        # Whitened projection has (near) identity covariance before re-normalization
+        projected = (emb - reducer.mean) @ reducer.components * reducer.scale
+        np.testing.assert_allclose(np.cov(projected.T, bias=True), np.eye(4), atol=1e-3)
+        out = reducer.transform(emb)
+        np.testing.assert_allclose(np.linalg.norm(out, axis=1), 1.0, rtol=1e-5)
+
+        # Truncation keeps the leading components
+        expected = projected[:, :2] / np.linalg.norm(projected[:, :2], axis=1, keepdims=True)
+        np.testing.assert_allclose(reducer.truncate(2).transform(emb), expected, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(reducer.transform_blocks(emb, np.zeros((500, 4), np.float32), 37), out)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            reducer.build_id = "b1"
+            reducer.save(Path(tmp))
+            np.testing.assert_array_equal(PCAReducer.load(Path(tmp), build_id="b1").transform(emb[:5]), out[:5])
+            with self.assertRaises(ValueError):
+                PCAReducer.load(Path(tmp), build_id="b2")
+
+
+class RelatedGraphTest(unittest.TestCase):
+    def test_graph_matches_per_class_loop(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((40, 8)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        names = [f"dish_{i}" for i in range(40)]
+        counts = np.ones(40, dtype=np.int64)
+        counts[5] = 0  # no images: never a neighbour
+        centroids = ClassCentroids(matrix, names, build_id="b1", counts=counts)
+
+        graph = RelatedGraph.build(centroids, {"Dish 1": "A", "Dish 2": "A", "Extra Dish": "A", "Dish 3": "B"},
+                                   k=4, block_size=7)
+        for i, name in enumerate(names):
+            if i == 5:
+                continue
+            expected = sorted((j for j in range(40) if j not in (i, 5)), key=lambda j: -float(matrix[i] @ matrix[j]))
+            self.assertEqual(graph.similar(name, 4), [names[j] for j in expected[:4]])
+        self.assertIsNone(graph.similar("dish_0", 5))  # more than stored: caller falls back
+
+        # Group keys are normalized like the index class names
+        self.assertEqual(graph.group_dishes("dish_1", 5), ["dish_2", "extra_dish"])
+        self.assertEqual(graph.group_name("extra_dish"), "A")
+        self.assertEqual(graph.group_dishes("dish_3", 5), [])
+        self.assertIsNone(graph.group_name("dish_0"))
+
+        import tempfile
+        from pathlib import Path
+        with tempfile.TemporaryDirectory() as tmp:
+            graph.save(Path(tmp))
+            loaded = RelatedGraph.load(Path(tmp), build_id="b1")
+            self.assertEqual(loaded.similar("dish_7", 3), graph.similar("dish_7", 3))
+            self.assertEqual(loaded.group_dishes("dish_2", 5), ["dish_1", "extra_dish"])
+            with self.assertRaises(ValueError):
+                RelatedGraph.load(Path(tmp), build_id="b2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+# File: food2recipe/tests/test_serving.py
+import time
+import socket
+import asyncio
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from food2recipe.core.settings import load_settings
+from food2recipe.serving.client import InferenceClient, ServerBusyError
+from food2recipe.retrieval.inference_executor import InferenceExecutor
+from food2recipe.serving.inference_server import InferenceServer, MicroBatcher
+
+
+class StubRecommender:
+    """predict_batch that records its batches; block() holds the worker until release()."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.batches = []
+        self.executor = None
+        self._gate = threading.Event()
+        self._gate.set()
+
+    def block(self):
+        self._gate.clear()
+
+    def release(self):
+        self._gate.set()
+
+    def predict_batch(self, image_files, return_exceptions=False, confidence_threshold=None, top_k=None):
+        self._gate.wait(10)
+        payloads = list(image_files)
+        self.batches.append(len(payloads))
+        return [ValueError("not an image") if p == b"bad" else
+                {"food_name": p.decode(), "batch": len(payloads), "threshold": t, "top_k": top_k}
+                for p, t in zip(payloads, confidence_threshold)]
+
+    def start_executor(self, **limits):
+        if self.executor is None:
+            self.executor = InferenceExecutor(self.predict_batch, **limits)
+        return self.executor
+
+    def cache_stats(self):
+        return {}
+
+    def generation_info(self):
+        return {"version": "test"}
+
+
+class ServerThread:
+    """InferenceServer on an ephemeral port, in its own event loop thread."""
+
+    def __init__(self, recommender, settings):
+        self.server = InferenceServer(recommender, settings)
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.url = f"http://127.0.0.1:{self.sock.getsockname()[1]}"
+        self.loop = asyncio.new_event_loop()
+        self._task = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        self._task = self.loop.create_task(self.server.serve(sock=self.sock))
+        try:
+            self.loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        self.loop.close()
+
+    def __enter__(self):
+        self._thread.start()
+        client = InferenceClient(self.url, timeout=5)
+        for _ in range(100):
+            try:
+                client.health()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("server did not start")
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join(10)
+        self.sock.close()
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.01)
+
+
+class MicroBatcherTest(unittest.TestCase):
+    def _run_batch(self, payloads, **batcher_args):
+        rec = StubRecommender(load_settings())
+
+        async def run():
+            batcher = MicroBatcher(rec.start_executor(**batcher_args))
+            t0 = time.perf_counter()
+            results = await asyncio.gather(*(batcher.submit(p) for p in payloads))
+            return results, time.perf_counter() - t0, batcher.stats()
+
+        return rec, *asyncio.run(run())
+
+    def test_dispatch_on_batch_size(self):
+        # A full batch goes out without waiting for max_wait_ms
+        rec, results, elapsed, stats = self._run_batch([b"a", b"b", b"c", b"d"], max_batch_size=4, max_wait_ms=5000)
+        self.assertEqual(rec.batches, [4])
+        self.assertLess(elapsed, 2.0)
+        self.assertEqual([r["food_name"] for r in results], ["a", "b", "c", "d"])
+        self.assertEqual((stats["requests"], stats["batches"], stats["avg_batch_size"]), (4, 1, 4.0))
+
+    def test_dispatch_on_max_wait(self):
+        # A partial batch goes out once the oldest request waited max_wait_ms
+        rec, results, elapsed, _ = self._run_batch([b"a", b"b", b"c"], max_batch_size=16, max_wait_ms=100)
+        self.assertEqual(rec.batches, [3])
+        self.assertGreaterEqual(elapsed, 0.09)
+        self.assertEqual([r["batch"] for r in results], [3, 3, 3])
+
+
+class InferenceServerTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = load_settings().model_copy(update={
+            "SERVER_MAX_BATCH_SIZE": 1, "SERVER_MAX_WAIT_MS": 1.0, "SERVER_MAX_QUEUE_SIZE": 2,
+            "SERVER_MAX_UPLOAD_MB": 0.001,
+        })
+        self.rec = StubRecommender(self.settings)
+
+    def test_predict_health_and_errors(self):
+        with ServerThread(self.rec, self.settings) as server:
+            client = InferenceClient(server.url, timeout=5)
+            result = client.predict(b"pho")
+            self.assertEqual(result["food_name"], "pho")
+            self.assertIn("latency_ms", result)
+            # Per-request parameters travel with the request
+            result = client.predict(b"pho", confidence_threshold=0.25, top_k=2)
+            self.assertEqual((result["threshold"], result["top_k"]), (0.25, 2))
+
+            health = client.health()
+            self.assertEqual((health["requests"], health["queue_capacity"]), (2, 2))
+            self.assertIn("wait_ms_p95", health)
+            self.assertEqual(health["index"], {"version": "test"})
+
+            with self.assertRaises(ValueError):
+                client.predict(b"bad")  # predict_batch error -> 400
+            with self.assertRaises(ValueError):
+                client.predict(b"")  # empty body -> 400
+            with self.assertRaisesRegex(RuntimeError, "413"):
+                client.predict(b"x" * 2048)  # over SERVER_MAX_UPLOAD_MB
+            # Out of range parameters never reach the queue
+            batches = len(self.rec.batches)
+            for params in ({"top_k": -3}, {"top_k": 0}, {"top_k": self.settings.MAX_TOP_K + 1},
+                           {"confidence_threshold": float("nan")}, {"confidence_threshold": 1.5}):
+                with self.subTest(**params), self.assertRaisesRegex(ValueError, "top_k|threshold"):
+                    client.predict(b"pho", **params)
+            self.assertEqual(len(self.rec.batches), batches)
+
+    def test_full_queue_answers_503(self):
+        with ServerThread(self.rec, self.settings) as server:
+            client = InferenceClient(server.url, timeout=10)
+            results = []
+
+            def predict(payload):
+                results.append(client.predict(payload))
+
+            self.rec.block()
+            # The first request is taken by the (blocked) worker, the next two fill the queue
+            threads = [threading.Thread(target=predict, args=(b"first",))]
+            threads[0].start()
+            _wait_for(lambda: client.health()["requests"] == 1 and client.health()["queue_depth"] == 0)
+            for payload in (b"second", b"third"):
+                threads.append(threading.Thread(target=predict, args=(payload,)))
+                threads[-1].start()
+            _wait_for(lambda: client.health()["queue_depth"] == 2)
+
+            with self.assertRaises(ServerBusyError):
+                client.predict(b"fourth")
+            request = urllib.request.Request(f"{server.url}/predict", data=b"fifth", method="POST")
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                urllib.request.urlopen(request, timeout=5)
+            self.assertEqual(ctx.exception.code, 503)
+            self.assertEqual(ctx.exception.headers["Retry-After"], "1")
+
+            self.rec.release()
+            for t in threads:
+                t.join(10)
+            self.assertEqual(sorted(r["food_name"] for r in results), ["first", "second", "third"])
+            self.assertEqual(client.health()["rejected"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
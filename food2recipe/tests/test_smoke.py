@@ -1,7 +1,12 @@
 # File: food2recipe/tests/test_smoke.py
+import json
+import tempfile
 import unittest
+import importlib.util
+from unittest import mock
 from pathlib import Path
-from food2recipe.core.settings import load_settings
+import torch
+from food2recipe.core.settings import Settings, load_settings
 from food2recipe.preprocessing.text_preprocess import RecipeProcessor
 from food2recipe.models.image_encoder import ImageEncoder
 
@@ -9,6 +14,33 @@ class SmokeTest(unittest.TestCase):
     def test_settings(self):
         settings = load_settings()
         self.assertIsNotNone(settings.DATA_DIR)
+        self.assertIs(load_settings(), settings)
+        with self.assertRaises(Exception):
+            settings.TOP_K = 1
+        self.assertEqual(settings.model_copy(update={"TOP_K": 1}).TOP_K, 1)
+
+    def test_serving_profile_needs_only_artifacts(self):
+        missing = Path("/nonexistent/food2recipe")
+        with self.assertRaises(FileNotFoundError):
+            Settings(IMAGES_DIR=missing, URLS_DIR=missing)
+        settings = Settings(PROFILE="serving", IMAGES_DIR=missing, URLS_DIR=missing, RECIPES_CSV=missing / "r.csv")
+        self.assertEqual(settings.IMAGES_DIR, missing)
+
+    def test_serving_imports_are_light(self):
+        # torch / faiss / pandas load on first use, not on import
+        from food2recipe.scripts.bench_imports import measure_import, heavy_imports
+        _, rows = measure_import("food2recipe.retrieval.recommender")
+        self.assertEqual(heavy_imports(rows), [])
+
+    def test_process_memory(self):
+        from food2recipe.serving.prefork import parse_smaps_rollup, process_memory
+        sample = "00400000-7ffd0000 ---p 00000000 00:00 0  [rollup]\nRss:  2048 kB\nPss:  1024 kB\nSwap: 0 kB\n"
+        self.assertEqual(parse_smaps_rollup(sample), {"Rss": 2.0, "Pss": 1.0, "Swap": 0.0})
+        if Path("/proc/self/smaps_rollup").exists():
+            import os
+            usage = process_memory(os.getpid())
+            self.assertGreater(usage["Rss"], 0)
+            self.assertLessEqual(usage["Pss"], usage["Rss"])
         
     def test_text_proc(self):
         # Only testing if valid init, not actual loading if CSV missing
@@ -25,5 +57,96 @@ class SmokeTest(unittest.TestCase):
         except ImportError:
             pass
 
+
+def _tiny_visual_model(encoder, backend):
+    # Stands in for the open_clip / timm weights, which would be downloaded
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Conv2d(3, 8, 8, stride=8), torch.nn.ReLU(),
+                               torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(8, 16)).eval()
+
+
+class TorchTuningTest(unittest.TestCase):
+    def _encoder(self, **overrides):
+        settings = load_settings().model_copy(update={
+            "MODEL_BACKEND": "timm", "IMAGE_SIZE": 32, "WARMUP_ITERS": 0, "COMPILE_MODE": "none",
+            "CHANNELS_LAST": False, "USE_BF16": False, "USE_INFERENCE_MODE": True, **overrides,
+        })
+        with mock.patch.object(ImageEncoder, "_load_torch_model", _tiny_visual_model):
+            return ImageEncoder(settings)
+
+    def test_tuned_paths_match_default(self):
+        images = torch.randn(4, 3, 32, 32)
+        reference = self._encoder().encode(images)
+        for overrides in ({"COMPILE_MODE": "trace"}, {"CHANNELS_LAST": True},
+                          {"COMPILE_MODE": "trace", "CHANNELS_LAST": True}, {"USE_INFERENCE_MODE": False}):
+            with self.subTest(**overrides):
+                emb = self._encoder(**overrides).encode(images)
+                self.assertFalse(emb.requires_grad)
+                self.assertGreater(float((emb * reference).sum(dim=1).min()), 0.9999)
+
+    def test_bf16_falls_back_without_cpu_support(self):
+        images = torch.randn(2, 3, 32, 32)
+        reference = self._encoder().encode(images)
+        with mock.patch("food2recipe.models.image_encoder.cpu_supports_bf16", return_value=False):
+            self.assertFalse(self._encoder(USE_BF16=True).use_bf16)
+        with mock.patch("food2recipe.models.image_encoder.cpu_supports_bf16", return_value=True):
+            enc = self._encoder(USE_BF16=True)
+        self.assertTrue(enc.use_bf16)
+        emb = enc.encode(images)
+        self.assertEqual(emb.dtype, torch.float32)  # Normalized in fp32
+        self.assertGreater(float((emb * reference).sum(dim=1).min()), 0.99)
+
+    def test_unknown_compile_mode(self):
+        with self.assertRaises(ValueError):
+            self._encoder(COMPILE_MODE="jit")
+
+    def test_warmup_runs_warmup_iters(self):
+        with mock.patch.object(ImageEncoder, "encode") as encode:
+            self._encoder(WARMUP_ITERS=3)
+        self.assertEqual(encode.call_count, 3)
+        self.assertEqual(tuple(encode.call_args[0][0].shape), (1, 3, 32, 32))
+
+
+@unittest.skipUnless(importlib.util.find_spec("onnx") and importlib.util.find_spec("onnxruntime"),
+                     "onnx / onnxruntime not installed (requirements-onnx.txt)")
+class OnnxBackendTest(unittest.TestCase):
+
+    def test_export_parity_and_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            settings = load_settings().model_copy(update={
+                "MODEL_BACKEND": "onnx", "ONNX_SOURCE_BACKEND": "timm", "ONNX_QUANTIZE": True,
+                "ARTIFACTS_DIR": Path(tmp), "IMAGE_SIZE": 32, "WARMUP_ITERS": 0,
+            })
+            with mock.patch.object(ImageEncoder, "_load_torch_model", _tiny_visual_model):
+                enc = ImageEncoder(settings)
+            fp32_path, int8_path = enc.onnx_paths()
+            parity = json.loads(fp32_path.with_suffix(".parity.json").read_text())
+            self.assertGreaterEqual(parity["fp32_min_cosine"], settings.ONNX_PARITY_MIN_COSINE)
+            # The int8 copy is kept only if it passed the same check
+            self.assertIn("int8_min_cosine", parity)
+            self.assertEqual(int8_path.exists(), parity["int8_min_cosine"] >= settings.ONNX_PARITY_MIN_COSINE)
+            self.assertIsNone(enc.model)
+
+            images = torch.randn(3, 3, 32, 32)
+            with torch.no_grad():
+                reference = torch.nn.functional.normalize(_tiny_visual_model(None, "timm")(images), dim=1)
+            self.assertGreater(float((enc.encode(images) * reference).sum(dim=1).min()), 0.95)
+
+            # Cached export: later starts never load the torch weights
+            with mock.patch.object(ImageEncoder, "_load_torch_model", side_effect=AssertionError("re-exported")):
+                self.assertIsNotNone(ImageEncoder(settings).session)
+
+    def test_export_failing_parity_is_discarded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            settings = load_settings().model_copy(update={
+                "MODEL_BACKEND": "onnx", "ONNX_SOURCE_BACKEND": "timm", "ARTIFACTS_DIR": Path(tmp),
+                "IMAGE_SIZE": 32, "WARMUP_ITERS": 0, "ONNX_PARITY_MIN_COSINE": 1.01,
+            })
+            with mock.patch.object(ImageEncoder, "_load_torch_model", _tiny_visual_model):
+                with self.assertRaises(RuntimeError):
+                    ImageEncoder(settings)
+            self.assertEqual(list((Path(tmp) / "onnx").glob("*.onnx")), [])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,257 @@
+# File: food2recipe/tests/test_storage.py
+import json
+import tempfile
+import unittest
+import numpy as np
+from pathlib import Path
+from food2recipe.core.settings import load_settings
+from food2recipe.models.embedding_cache import EmbeddingCache
+from food2recipe.models.embedding_store import StoreWriter, save_store, load_store
+from food2recipe.preprocessing.pixel_shards import PixelShardStore
+from food2recipe.retrieval import index_versions
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def test_roundtrip_prune_and_negative_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            settings = load_settings().model_copy(update={"ARTIFACTS_DIR": tmp})
+
+            files = []
+            for i in range(3):
+                f = tmp / f"img_{i}.jpg"
+                f.write_bytes(bytes([i]) * 10)
+                files.append(f)
+
+            cache = EmbeddingCache(settings)
+            keys = [cache.file_key(f) for f in files]
+            cache.put(keys[0], np.ones(4))
+            cache.put(keys[1], np.zeros(4))
+            cache.mark_failed(keys[2])
+            cache.save()
+
+            reloaded = EmbeddingCache(settings).load()
+            np.testing.assert_array_equal(reloaded.get(keys[0]), np.ones(4, dtype=np.float32))
+            self.assertTrue(reloaded.is_failed(keys[2]))
+
+            # Deleted file: its vector is dropped
+            reloaded.prune(keys[:1] + keys[2:])
+            self.assertIsNone(reloaded.get(keys[1]))
+
+            # Changed file -> new key -> cache miss
+            files[0].write_bytes(b"changed content")
+            self.assertIsNone(reloaded.get(reloaded.file_key(files[0])))
+
+
+class EmbeddingStoreTest(unittest.TestCase):
+    def test_columnar_roundtrip_is_memory_mapped(self):
+        records = [
+            {"image_path": "/data/Phở/1.jpg", "food_name": "pho", "split": "train"},
+            {"image_path": "/data/Banh mi/2.jpg", "food_name": "banh_mi", "split": "val"},
+            {"image_path": "", "food_name": "pho", "split": "train"},
+        ]
+        emb = np.random.default_rng(0).standard_normal((3, 8)).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            header = save_store(Path(tmp), emb, records, model="test")
+            loaded, meta, loaded_header = load_store(Path(tmp), mmap=True, verify=True)
+
+            self.assertIsInstance(loaded, np.memmap)
+            np.testing.assert_array_equal(loaded, emb)
+            self.assertEqual(meta.to_records(), records)
+            self.assertEqual(meta.class_names, ["banh_mi", "pho"])
+            self.assertEqual(loaded_header["checksum"], header["checksum"])
+            self.assertEqual(loaded_header["count"], 3)
+            del loaded, meta
+
+    def test_store_writer_resumes_from_checkpoint(self):
+        rng = np.random.default_rng(0)
+        emb = rng.standard_normal((6, 4)).astype(np.float32)
+        records = [{"image_path": f"/img/{i}.jpg", "food_name": f"dish_{i % 2}", "split": "train"} for i in range(6)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            staging = Path(tmp) / "staging"
+            writer = StoreWriter(staging, capacity=6, signature="build-a")
+            self.assertEqual(writer.open(), 0)
+            writer.append(emb[:3], records[:3])
+            writer.checkpoint(rows_done=3)
+            # Appended after the last checkpoint, i.e. lost in a crash
+            writer.append(emb[3:4], records[3:4])
+
+            resumed = StoreWriter(staging, capacity=6, signature="build-a")
+            self.assertEqual(resumed.open(), 3)
+            resumed.append(emb[3:], records[3:])
+            resumed.checkpoint(rows_done=6)
+            np.testing.assert_array_equal(resumed.embeddings, emb)
+            self.assertEqual(resumed.metadata().to_records(), records)
+
+            # Another build's staging folder is discarded
+            self.assertEqual(StoreWriter(staging, capacity=6, signature="build-b").open(), 0)
+
+
+class PixelShardStoreTest(unittest.TestCase):
+    def test_write_read_and_staleness(self):
+        import torch
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            settings = load_settings().model_copy(update={"ARTIFACTS_DIR": tmp, "IMAGE_SIZE": 4, "PIXEL_SHARD_SIZE": 2})
+
+            records = []
+            for i in range(5):
+                f = tmp / f"img_{i}.jpg"
+                f.write_bytes(bytes([i]) * 10)
+                records.append({"image_path": str(f), "split": "train" if i < 3 else "test"})
+
+            def fake_decode(paths):
+                # img_1 is "unreadable" and gets dropped, like the real decode pipeline does
+                kept = [p for p in paths if not p.endswith("img_1.jpg")]
+                images = torch.stack([torch.full((3, 4, 4), int(p[-5]), dtype=torch.uint8) for p in kept])
+                yield images, kept
+
+            PixelShardStore(settings).load().write(records, fake_decode)
+            store = PixelShardStore(settings).load()
+            self.assertEqual(len(store.rows), 4)
+            self.assertIsNone(store.get(records[1]["image_path"]))
+            self.assertEqual(int(store.get(records[4]["image_path"])[0, 0, 0]), 4)
+
+            paths = [r["image_path"] for r in records]
+            batches = list(store.iter_batches(paths, batch_size=3))
+            self.assertEqual([p for _, batch_paths in batches for p in batch_paths], paths[:1] + paths[2:])
+            self.assertEqual(batches[0][0].dtype, torch.uint8)
+
+            # Changed source file -> stale row -> not served
+            Path(paths[0]).write_bytes(b"changed content")
+            self.assertIsNone(store.lookup(paths[0]))
+
+
+class IndexVersionsTest(unittest.TestCase):
+    def test_publish_resolve_verify_and_prune(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            settings = load_settings().model_copy(update={"ARTIFACTS_DIR": Path(tmp), "INDEX_KEEP_VERSIONS": 2})
+            # No pointer yet: legacy single folder
+            self.assertEqual(index_versions.resolve_index_dir(settings), Path(tmp) / "index")
+
+            for i in range(3):
+                staging = index_versions.new_staging_dir(settings)
+                (staging / "embeddings.npy").write_bytes(bytes([i]) * 16)
+                index_versions.publish(settings, staging, f"build-{i}", model="m")
+                self.assertEqual(index_versions.resolve_index_dir(settings).name, f"build-{i}")
+
+            # Oldest pruned, no staging folders left behind
+            self.assertEqual(index_versions.list_versions(settings), ["build-1", "build-2"])
+            self.assertEqual(sorted(p.name for p in (Path(tmp) / "indexes").iterdir()),
+                             ["build-1", "build-2", "current"])
+
+            # Rolling back is just moving the pointer
+            index_versions.set_current(settings, "build-1")
+            folder = index_versions.resolve_index_dir(settings)
+            self.assertEqual(index_versions.verify_manifest(folder, checksums=True)["build_id"], "build-1")
+            (folder / "embeddings.npy").write_bytes(b"x")
+            with self.assertRaises(ValueError):
+                index_versions.verify_manifest(folder)
+            with self.assertRaises(FileNotFoundError):
+                index_versions.set_current(settings, "build-0")
+
+            # A tool adding artifacts to the older version does not make it the newest
+            manifest_path = folder / index_versions.MANIFEST_FILE
+            created_at = json.loads(manifest_path.read_text(encoding="utf-8"))["created_at"]
+            (folder / "linear_probe.npz").write_bytes(b"probe")
+            index_versions.refresh_manifest(folder)
+            self.assertEqual(json.loads(manifest_path.read_text(encoding="utf-8"))["created_at"], created_at)
+            self.assertEqual(index_versions.list_versions(settings), ["build-1", "build-2"])
+            index_versions.set_current(settings, "build-2")
+            index_versions.prune_versions(settings, 1)
+            self.assertEqual(index_versions.list_versions(settings), ["build-2"])
+
+
+class ServingBundleTest(unittest.TestCase):
+    def test_bundle_roundtrip_matches_folder(self):
+        from food2recipe.retrieval.index_faiss import RetrievalIndex
+        from food2recipe.retrieval.centroids import ClassCentroids
+        from food2recipe.retrieval.related_graph import RelatedGraph
+        from food2recipe.retrieval.reduction import PCAReducer
+        from food2recipe.retrieval.recommender import RecipeRecommender
+        from food2recipe.retrieval.bundle import Bundle, write_bundle
+
+        rng = np.random.default_rng(0)
+        emb = rng.standard_normal((60, 16)).astype(np.float32)
+        reducer = PCAReducer.fit(emb, 8)
+        emb = reducer.transform(emb)
+        metadata = [{"image_path": f"img_{i}.jpg", "food_name": f"dish_{i % 4}", "split": "train"} for i in range(60)]
+        recipes = {"dish_0": {"food_key": "dish_0", "title": "Phở bò", "ingredients": "bánh phở"}}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            settings = load_settings().model_copy(update={"USE_FAISS": False, "NUMPY_INDEX_DTYPE": "int8"})
+            built = RetrievalIndex(settings)
+            built.build(emb, metadata)
+            built.save(Path(tmp) / "index")
+            index = RetrievalIndex(settings)
+            index.load(Path(tmp) / "index")
+            reducer.build_id = index.build_id
+            centroids = ClassCentroids.from_embeddings(emb, index.label_ids, index.class_names, index.build_id,
+                                                       num_prototypes=2)
+            graph = RelatedGraph.build(centroids, {"dish_0": "soup", "dish_1": "soup"}, k=2)
+
+            path = Path(tmp) / "bundle.f2r"
+            write_bundle(path, index, centroids, graph, reducer=reducer, recipes=recipes)
+            with self.assertRaises(ValueError):
+                write_bundle(Path(tmp) / "stale.f2r", index, reducer=PCAReducer.fit(emb, 4))
+
+            bundle = Bundle(path)
+            loaded = RetrievalIndex(settings).load_bundle(bundle)
+            # Zero-copy: vectors and the quantized matrix are views of the one file mapping
+            self.assertTrue(np.shares_memory(loaded.embeddings, bundle._buf))
+            self.assertTrue(np.shares_memory(loaded.index.matrix, bundle._buf))
+            self.assertEqual(loaded.index.dtype, "int8")
+            for a, b in zip(loaded.search_batch(emb[:5] + 0.01, k=5), index.search_batch(emb[:5] + 0.01, k=5)):
+                np.testing.assert_array_equal(a, b)
+            self.assertEqual(loaded.metadata[7], index.metadata[7])
+            self.assertEqual(bundle.recipes(), recipes)
+            np.testing.assert_array_equal(bundle.centroids().prototypes, centroids.prototypes)
+            self.assertEqual(bundle.related_graph().group_dishes("dish_0", 5), ["dish_1"])
+            self.assertIsNone(bundle.linear_probe())
+
+            # Serving from the bundle alone: version is the build id, recipes come with it
+            settings = settings.model_copy(update={"BUNDLE_PATH": path})
+            rec = RecipeRecommender(settings)
+            rec._gen = rec._load_generation(rec._index_source())
+            self.assertEqual(rec.generation_info()["version"], index.build_id)
+            self.assertEqual(rec._gen.recipes["dish_0"]["title"], "Phở bò")
+            self.assertEqual(rec.reducer.tag, reducer.tag)
+            self.assertEqual(rec.classify(emb[:5]), rec._vote_batch(*index.search_batch(emb[:5], k=settings.TOP_K)))
+            self.assertFalse(rec.reload_if_changed())
+
+
+    def test_refresh_bundle_picks_up_new_artifacts(self):
+        from food2recipe.retrieval.index_faiss import RetrievalIndex
+        from food2recipe.retrieval.linear_probe import LinearProbe
+        from food2recipe.retrieval.bundle import BUNDLE_FILE, Bundle
+        from food2recipe.scripts.build_bundle import bundle_index_dir, refresh_bundle
+
+        rng = np.random.default_rng(0)
+        emb = rng.standard_normal((40, 8)).astype(np.float32)
+        metadata = [{"image_path": f"img_{i}.jpg", "food_name": f"dish_{i % 4}", "split": "train"} for i in range(40)]
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = Path(tmp)
+            settings = load_settings().model_copy(update={"USE_FAISS": False})
+            index = RetrievalIndex(settings)
+            index.build(emb, metadata)
+            index.save(folder)
+            self.assertFalse(refresh_bundle(settings, folder))  # No bundle: nothing to do
+
+            bundle_index_dir(settings, folder, include_recipes=False)
+            self.assertIsNone(Bundle(folder / BUNDLE_FILE).linear_probe())
+
+            # A probe trained after bundling (train_linear_probe) must reach the bundle
+            probe = LinearProbe(np.ones((8, 4), np.float32), np.zeros(4, np.float32), index.class_names,
+                                build_id=index.build_id)
+            probe.save(folder)
+            self.assertTrue(refresh_bundle(settings, folder))
+            bundle = Bundle(folder / BUNDLE_FILE)
+            np.testing.assert_array_equal(bundle.linear_probe().weights, probe.weights)
+            self.assertIsNone(bundle.recipes())
+
+
+if __name__ == "__main__":
+    unittest.main()
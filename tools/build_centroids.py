@@ -1,10 +1,6 @@
 
 import sys
-import numpy as np
-import pickle
 import argparse
-from tqdm import tqdm
-from collections import defaultdict
 from pathlib import Path
 
 # Add project root to path
@@ -16,82 +12,63 @@ if str(project_root) not in sys.path:
 from food2recipe.core.settings import load_settings
 from food2recipe.core.logging_utils import setup_logger
 from food2recipe.retrieval.index_faiss import RetrievalIndex
+from food2recipe.retrieval.centroids import ClassCentroids
+from food2recipe.retrieval.related_graph import RelatedGraph
+from food2recipe.retrieval.related_engine import DISH_GROUPS
+from food2recipe.retrieval.index_versions import add_artifacts, resolve_index_dir
+from food2recipe.scripts.build_bundle import refresh_bundle
 
 logger = setup_logger("build_centroids")
 
 def main():
+    """
+    Recomputes the centroids of the current index. build_index already writes
+    them; this is for indexes built before that, or to change --prototypes.
+    """
+    parser = argparse.ArgumentParser(description="Recompute class centroids for the current index.")
+    parser.add_argument("--prototypes", type=int, default=None, help="k-means prototypes per class (default: CENTROID_PROTOTYPES)")
+    args = parser.parse_args()
+
     settings = load_settings()
+    if args.prototypes is None:
+        args.prototypes = settings.CENTROID_PROTOTYPES
     
     # 1. Load Index
     logger.info("Loading index...")
     idx_wrapper = RetrievalIndex(settings)
-    index_path = settings.ARTIFACTS_DIR / "index"
+    index_path = resolve_index_dir(settings)
     try:
         idx_wrapper.load(index_path)
     except FileNotFoundError:
         logger.error("Index not found. Please run 'python -m food2recipe.scripts.build_index' first.")
         sys.exit(1)
 
-    metadata = idx_wrapper.metadata
-    
-    # 2. Extract Vectors and Group by Class
-    # We need to handle both FAISS and Numpy backends
-    
+    # 2. Source vectors: the stored matrix, or the FAISS copy for legacy indexes without one
     logger.info("Computing centroids...")
-    
-    # Detect dimension
-    if idx_wrapper.is_faiss:
-        # FAISS
-        try:
-            # Check if reconstruct is supported
-            # IndexFlatIP supports it
-            dim = idx_wrapper.index.d
-        except Exception:
-            logger.error("Could not determine dimension from FAISS index.")
+    embeddings = idx_wrapper.embeddings
+    if embeddings is None:
+        if not idx_wrapper.is_faiss:
+            logger.error("Index has no stored vectors.")
             sys.exit(1)
-    else:
-        # Numpy
-        dim = idx_wrapper.index.shape[1]
+        embeddings = idx_wrapper.index.reconstruct_n(0, idx_wrapper.index.ntotal)
 
-    class_vectors = defaultdict(list)
-    
-    ntotal = len(metadata)
-    
-    for i in tqdm(range(ntotal)):
-        meta = metadata[i]
-        food_name = meta['food_name']
-        
-        # Get vector
-        if idx_wrapper.is_faiss:
-            # FAISS reconstruct
-            # Note: reconstruct returns float32 array
-            vec = idx_wrapper.index.reconstruct(i)
-        else:
-            # Numpy
-            vec = idx_wrapper.index[i]
-            
-        class_vectors[food_name].append(vec)
+    # 3. Segment sums per class (vectorized), tied to the index build id
+    centroids = ClassCentroids.from_embeddings(
+        embeddings, idx_wrapper.label_ids, idx_wrapper.class_names, build_id=idx_wrapper.build_id,
+        num_prototypes=args.prototypes, block_size=settings.NUMPY_SEARCH_BLOCK,
+    )
+    logger.info(f"Computed centroids for {int((centroids.counts > 0).sum())} classes.")
 
-    # 3. Compute Mean
-    centroids = {}
-    for food_name, vecs in class_vectors.items():
-        # Stack and mean
-        mat = np.vstack(vecs)
-        # Normalize? Yes, usually better for cosine sim
-        mean_vec = np.mean(mat, axis=0)
-        # L2 normalize the centroid
-        norm = np.linalg.norm(mean_vec)
-        if norm > 1e-6:
-            mean_vec = mean_vec / norm
-            
-        centroids[food_name] = mean_vec
-        
-    logger.info(f"Computed centroids for {len(centroids)} classes.")
-    
-    # 4. Save
-    save_path = settings.ARTIFACTS_DIR / "class_centroids.npy"
-    np.save(save_path, centroids)
-    logger.info(f"Saved centroids to {save_path}")
+    # 4. Save with the related-dish graph derived from them, as a new version next to
+    # the served one; a bundle in the folder is what serving reads, so it is repacked
+    graph = RelatedGraph.build(centroids, DISH_GROUPS, k=settings.RELATED_TOP_K)
+
+    def save(folder):
+        centroids.save(folder)
+        graph.save(folder)
+
+    folder = add_artifacts(settings, index_path, save, finalize=lambda d: refresh_bundle(settings, d))
+    logger.info(f"Centroids saved to {folder}")
 
 if __name__ == "__main__":
     main()